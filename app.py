@@ -1,23 +1,131 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session
-from dbhelper import * 
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, Response, send_file, g
+from dbhelper import (db_connection, get_db_health, get_pool_stats, check_user_exists, insert_user,
+                      update_user, delete_user, validate_user, get_student_by_id, get_all_users_formatted,
+                      record_scan, record_scan_batch, insert_attendance_batch_to_file,
+                      delete_attendance_record, get_recent_attendance, seed_recent_attendance,
+                      get_attendance_page, get_attendance_changes, start_journal_drainer,
+                      DatabaseError, ATTENDANCE_PAGE_SIZE, ATTENDANCE_CHANGES_LIMIT)
+from attendance_events import open_stream, get_event_hub, TooManySubscribers, ROSTER_CHANNEL
+from recent_attendance import recent_attendance, RECENT_ATTENDANCE_SIZE
+from recent_scans import recent_scans, valid_scan_key
+from student_cache import student_cache
+from attendance_writer import queue_scan, writer_stats
+from student_assets import qr_payload, ensure_qr_code, make_qr_code, qr_code_key, qr_code_png, photo_path
+from photo_pipeline import submit_photo, get_photo_pipeline
+from photo_index import photo_index, PHOTO_PLACEHOLDER
+from attendance_reports import (start_rollup_refresher, parse_date_range, daily_report, hourly_report,
+                                course_report, students_report, student_report)
+from attendance_export import AttendanceExport, build_export_query, ExportBusy, ExportUnavailable
+from migrations import ensure_schema
+from metrics import metrics, start_metrics_writer, collect_all, reset_metrics_dir, render as render_metrics
+from app_logging import setup_logging
+from query_profiler import query_profiler
 from datetime import datetime
 import json
+import io
+import logging
 from io import BytesIO
 import base64
-from PIL import Image
 import os
-import qrcode 
+import threading
+import time
+import traceback
+import uuid
+
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 app.secret_key = os.environ.get('SECRET_KEY', '@#$@#$@#$')
 
-# Initialize database
-initialize_database()
-
-os.makedirs('static/qrcode', exist_ok=True)
-os.makedirs('static/image', exist_ok=True)
-os.makedirs('static/qr_codes', exist_ok=True)  # Add this
+# /qr/<idno>.png?v=<key> responses are immutable
+QR_CACHE_MAX_AGE = 365 * 24 * 3600
+# Five student fields, generously
+QR_PREVIEW_MAX_LENGTH = 400
+# /api/photo/<idno> redirects; short so new uploads show up soon
+PHOTO_REDIRECT_MAX_AGE = 60
+# Scans per /scan_qr/batch request (the kiosk sends 50)
+SCAN_BATCH_MAX = 200
+# Statements listed by /admin/queries
+QUERY_PROFILE_TOP = 20
+QUERY_PROFILE_ORDERS = ('total', 'mean', 'max', 'calls')
+
+# Importing this module only defines routes: no database, threads or
+# files. start_worker() does the rest once per process, after fork, so
+# gunicorn can preload the app in its master (see gunicorn_config.py)
+_started_pid = None
+_start_lock = threading.Lock()
+
+def start_worker():
+    """Per-process startup: schema check, caches and background threads.
+
+    Called by gunicorn's post_fork hook, by __main__, and otherwise by the
+    first request. Returns the seconds taken (0.0 if already started).
+    """
+    global _started_pid
+    
+    pid = os.getpid()
+    if _started_pid == pid:
+        return 0.0
+    
+    with _start_lock:
+        if _started_pid == pid:
+            return 0.0
+        started = time.monotonic()
+        
+        # Logs go through a queue to a writer thread; metrics snapshots
+        # are shared with the other workers for /metrics
+        setup_logging()
+        start_metrics_writer()
+        
+        # Schema version check only: the gunicorn master (or
+        # `python migrations.py`) migrates
+        ensure_schema()
+        
+        # Latest-attendance buffer: seed once, then follow changes from every worker
+        seed_recent_attendance()
+        get_event_hub().add_listener(recent_attendance.apply_change)
+        get_event_hub().add_listener(recent_scans.apply_change)
+        # Roster edits from any worker or the import CLI
+        get_event_hub().add_listener(student_cache.apply_roster_change, ROSTER_CHANNEL)
+        get_event_hub().add_listener(photo_index.apply_roster_change, ROSTER_CHANNEL)
+        
+        # Replay scans journaled during database outages once it is back
+        start_journal_drainer()
+        
+        # Keep the report rollups current (one worker at a time does the work)
+        start_rollup_refresher()
+        
+        # Know which photos exist so the kiosk needs no path probing
+        photo_index.build()
+        
+        _started_pid = pid
+        elapsed = time.monotonic() - started
+    
+    log.info("✓ Worker %d started in %.2fs", pid, elapsed)
+    return elapsed
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def ensure_worker_started():
+    # One int comparison per request once started
+    if _started_pid != os.getpid():
+        start_worker()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        # The URL rule, not the path, so /qr/<idno>.png is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('attendance_http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method)
+        metrics.inc('attendance_http_requests_total', route=route, method=request.method,
+                    status=str(response.status_code))
+    return response
 
 # Add Student Form
 @app.route("/add")
@@ -27,30 +135,27 @@ def add_user():
 @app.route("/debug-db")
 def debug_db():
     """Debug database issues"""
-    from dbhelper import get_db_connection
-    
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if users table exists
-        cursor.execute("""
-            SELECT table_name 
-            FROM information_schema.tables 
-            WHERE table_schema = 'public' AND table_name = 'users'
-        """)
-        table_exists = cursor.fetchone()
-        
-        # Count users
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        
-        # Get column info
-        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users'")
-        columns = [row[0] for row in cursor.fetchall()]
-        
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Check if users table exists
+            cursor.execute("""
+                SELECT table_name 
+                FROM information_schema.tables 
+                WHERE table_schema = 'public' AND table_name = 'users'
+            """)
+            table_exists = cursor.fetchone()
+            
+            # Count users
+            cursor.execute("SELECT COUNT(*) FROM users")
+            user_count = cursor.fetchone()[0]
+            
+            # Get column info
+            cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'users'")
+            columns = [row[0] for row in cursor.fetchall()]
+            
+            cursor.close()
         
         return f"""
         <h1>Database Debug</h1>
@@ -76,33 +181,18 @@ def delete_attendance():
         if not idno or not time_logged:
             return jsonify({"success": False, "error": "Missing data"})
         
-        # Connect to database
-        conn = get_db_connection()
-        if not conn:
+        deleted_count = delete_attendance_record(idno, time_logged)
+        if deleted_count is None:
             return jsonify({"success": False, "error": "Database connection failed"})
         
-        cursor = conn.cursor()
-        
-        # Delete the attendance record
-        cursor.execute("""
-            DELETE FROM attendance 
-            WHERE idno = %s AND time_logged = %s
-        """, (idno, time_logged))
-        
-        conn.commit()
-        
-        deleted_count = cursor.rowcount
-        cursor.close()
-        conn.close()
-        
         if deleted_count > 0:
-            print(f"Deleted attendance for {idno} at {time_logged}")
+            log.info("Deleted attendance for %s at %s", idno, time_logged)
             return jsonify({"success": True, "message": "Attendance deleted"})
         else:
             return jsonify({"success": False, "error": "Record not found"})
             
     except Exception as e:
-        print(f"Error deleting attendance: {e}")
+        log.error("Error deleting attendance: %s", e)
         return jsonify({"success": False, "error": str(e)})
 
 # Add Student Action
@@ -115,7 +205,7 @@ def add_student():
         course = request.form['course']
         level = request.form['level']
         
-        print(f"Adding student: {idno}")
+        log.info("Adding student: %s", idno)
         
         # Check if exists
         if check_user_exists(idno):
@@ -130,38 +220,24 @@ def add_student():
         image_data = request.form.get('image_data')
         if image_data and 'data:image' in image_data:
             try:
-                from io import BytesIO
-                import base64
-                from PIL import Image
-                
-                image_data = image_data.split(',')[1]
-                image = Image.open(BytesIO(base64.b64decode(image_data)))
-                image.save(f"static/image/{idno}.jpg")
-                print(f"✓ Image saved for {idno}")
+                submit_photo(idno, decode_image_data(image_data), photo_index.refresh)
+                log.debug("✓ Image queued for %s", idno)
             except Exception as e:
-                print(f"Image save error: {e}")
+                log.error("Image save error: %s", e)
         
-        # Save QR code if provided
-        qr_code_url = request.form.get('qr_code_url')
-        if qr_code_url:
-            try:
-                import requests
-                import os
-                
-                # Download QR code
-                response = requests.get(qr_code_url)
-                os.makedirs('static/qrcode', exist_ok=True)
-                
-                with open(f'static/qrcode/{idno}.png', 'wb') as f:
-                    f.write(response.content)
-                print(f"✓ QR Code saved for {idno}")
-            except Exception as e:
-                print(f"QR Code save error: {e}")
+        # Render and save the QR code here; the form preview is drawn in
+        # memory and never written to disk
+        try:
+            make_qr_code({'idno': idno, 'lastname': lastname, 'firstname': firstname,
+                          'course': course, 'level': level})
+            log.debug("✓ QR Code saved for %s", idno)
+        except Exception as e:
+            log.error("QR Code save error: %s", e)
         
         return redirect(url_for('userlist'))
         
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error adding student: %s", e)
         return render_template("student.html",
                              pagetitle="STUDENT",
                              error=f"Error: {str(e)}")
@@ -228,7 +304,7 @@ def attendance():
 def scan_qr():
     try:
         qr_data = request.get_json()
-        print(f"QR Data received: {qr_data}")  # Debug
+        log.debug("QR Data received: %s", qr_data)
         
         if not qr_data:
             return jsonify({"success": False, "error": "No data received"})
@@ -246,42 +322,268 @@ def scan_qr():
         level = student_info.get('level', '')
         
         # Use provided timestamp or create one
-        time_logged = student_info.get('time_logged', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        
-        print(f"Saving attendance for: {idno} at {time_logged}")
-        
-        # Check if student exists first
-        student = get_student_by_id(idno)
-        
-        if student:
-            # Student exists in database - use that data
-            insert_attendance(
-                student['idno'],
-                student['lastname'],
-                student['firstname'],
-                student['course'],
-                student['level'],
-                time_logged
-            )
-        else:
-            # Student not in database - use QR code data
-            insert_attendance(
-                idno,
-                lastname,
-                firstname,
-                course,
-                level,
-                time_logged
-            )
-        
-        print(f"✓ Attendance saved for {idno}")
-        return jsonify({"success": True, "message": "Attendance recorded"})
+        time_logged = student_info.get('time_logged') or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            datetime.strptime(str(time_logged), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return jsonify({"success": False, "error": "time_logged must be YYYY-MM-DD HH:MM:SS"}), 400
+        time_logged = str(time_logged)
+        
+        # Idempotency key: a retry of the same scan sends the same key
+        scan_key = qr_data.get('scan_key') or request.headers.get('Idempotency-Key')
+        if scan_key is not None and not valid_scan_key(scan_key):
+            return jsonify({"success": False, "error": "Invalid scan_key"}), 400
+        scan_key = scan_key or uuid.uuid4().hex
+        
+        # Retries, double taps and repeat detections: answer with the
+        # original record, without touching the database
+        original, reservation = recent_scans.begin(idno, scan_key, time_logged)
+        if original is not None:
+            log.info("Duplicate scan for %s answered from memory", idno)
+            return jsonify({"success": True, "duplicate": True, "message": "Already recorded",
+                            "record": original})
+        
+        log.debug("Saving attendance for: %s at %s", idno, time_logged)
+        
+        record = None
+        try:
+            # Write-behind mode: acknowledge once queued for the batch writer
+            record = queue_scan(idno, lastname, firstname, course, level, time_logged, scan_key)
+            
+            if not record:
+                # Resolve the roster row and insert in a single statement
+                record = record_scan(idno, lastname, firstname, course, level, time_logged, scan_key)
+        finally:
+            duplicate = bool(record and record.pop('duplicate', False))
+            recent_scans.finish(reservation, record)
+        
+        if not record:
+            return jsonify({"success": False, "error": "Could not save attendance"})
+        
+        if duplicate:
+            return jsonify({"success": True, "duplicate": True, "message": "Already recorded",
+                            "record": record})
+        
+        log.debug("✓ Attendance saved for %s", idno)
+        return jsonify({"success": True, "message": "Attendance recorded", "record": record})
         
     except Exception as e:
-        print(f"Error in scan_qr: {e}")
-        import traceback
-        print(traceback.format_exc())
+        log.exception("Error in scan_qr: %s", e)
         return jsonify({"success": False, "error": str(e)})
+@app.route("/scan_qr/batch", methods=["POST"])
+def scan_qr_batch():
+    """Record scans queued by a kiosk, e.g. after a network outage.
+
+    Body: {"scans": [{"scan_key": ..., "student_info": {idno, lastname,
+    firstname, course, level, time_logged}}, ...]}, at most
+    SCAN_BATCH_MAX. New scans are written in one transaction. "results"
+    has one entry per scan, in request order, with a status of recorded,
+    duplicate, journaled (database down, saved for replay), invalid (do
+    not resend) or retry (resend later).
+    """
+    data = request.get_json(silent=True) or {}
+    scans = data.get('scans')
+    if not isinstance(scans, list):
+        return jsonify({"success": False, "error": "scans must be a list"}), 400
+    if len(scans) > SCAN_BATCH_MAX:
+        return jsonify({"success": False, "error": f"At most {SCAN_BATCH_MAX} scans per batch"}), 400
+    
+    results = [None] * len(scans)
+    entries = []
+    positions = []
+    for position, scan in enumerate(scans):
+        scan = scan if isinstance(scan, dict) else {}
+        info = scan.get('student_info') if isinstance(scan.get('student_info'), dict) else scan
+        scan_key = scan.get('scan_key')
+        error = None
+        if not valid_scan_key(scan_key):
+            error = "Invalid scan_key"
+        elif not info.get('idno'):
+            error = "No student ID"
+        else:
+            time_logged = info.get('time_logged') or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                datetime.strptime(str(time_logged), "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                error = "time_logged must be YYYY-MM-DD HH:MM:SS"
+        if error:
+            results[position] = {"scan_key": scan_key if isinstance(scan_key, str) else None,
+                                 "status": "invalid", "error": error}
+            continue
+        
+        entries.append({
+            'scan_key': scan_key,
+            'idno': str(info['idno']),
+            'lastname': str(info.get('lastname') or ''),
+            'firstname': str(info.get('firstname') or ''),
+            'course': str(info.get('course') or ''),
+            'level': str(info.get('level') or ''),
+            'time_logged': str(time_logged)
+        })
+        positions.append(position)
+    
+    # Repeats inside the batch answer with their first scan's result
+    kept, repeats = recent_scans.collapse(entries)
+    
+    pending = []
+    try:
+        for index in kept:
+            entry = entries[index]
+            original, reservation = recent_scans.begin(entry['idno'], entry['scan_key'], entry['time_logged'])
+            if original is not None:
+                results[positions[index]] = {"scan_key": entry['scan_key'], "status": "duplicate",
+                                             "record": original}
+            else:
+                pending.append((index, reservation))
+        
+        written = None
+        journaled = False
+        if pending:
+            try:
+                written = record_scan_batch([entries[index] for index, _ in pending])
+            except Exception as e:
+                log.error("✗ Error writing scan batch of %d: %s", len(pending), e)
+                journaled = insert_attendance_batch_to_file([entries[index] for index, _ in pending])
+        
+        for index, reservation in pending:
+            entry = entries[index]
+            record = None
+            if journaled:
+                record = {field: entry[field] for field in
+                          ('idno', 'lastname', 'firstname', 'course', 'level', 'time_logged')}
+                result = {"scan_key": entry['scan_key'], "status": "journaled", "record": record}
+            elif written and entry['scan_key'] in written:
+                record, duplicate = written[entry['scan_key']]
+                result = {"scan_key": entry['scan_key'], "status": "duplicate" if duplicate else "recorded",
+                          "record": record}
+            else:
+                result = {"scan_key": entry['scan_key'], "status": "retry"}
+            results[positions[index]] = result
+            recent_scans.finish(reservation, record)
+    finally:
+        # Anything not answered (an exception above) must not stay reserved
+        for index, reservation in pending:
+            if results[positions[index]] is None:
+                recent_scans.finish(reservation, None)
+    
+    for index, original in repeats.items():
+        first = results[positions[original]]
+        result = {"scan_key": entries[index]['scan_key'], "status": "duplicate", "record": first.get('record')}
+        if first['status'] == 'retry':
+            result = {"scan_key": entries[index]['scan_key'], "status": "retry"}
+        results[positions[index]] = result
+    
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    log.info("✓ Scan batch of %d: %s", len(scans), counts)
+    return jsonify({"success": True, "results": results, "counts": counts})
+
+@app.route("/api/students/import", methods=["POST"])
+def api_students_import():
+    """Bulk enroll students from an uploaded CSV or JSONL file.
+
+    Send the file as multipart field 'file' (format from its extension)
+    or as the raw body with ?format=csv|jsonl. ?assets=0 skips QR code
+    and photo generation. Photos must be data:image URLs here; the
+    student_import.py CLI also reads photo files.
+    """
+    if not session.get('logged_in'):
+        return jsonify({"success": False, "error": "Login required"}), 401
+    
+    # Pulls in multiprocessing; only admins importing need it
+    from student_import import import_students, detect_format
+    
+    upload = request.files.get('file')
+    if upload:
+        fmt = request.args.get('format') or detect_format(upload.filename or '')
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    else:
+        fmt = request.args.get('format', 'csv')
+        stream = io.StringIO(request.get_data(as_text=True), newline='')
+    
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({"success": False, "error": "format must be csv or jsonl"}), 400
+    
+    try:
+        report = import_students(stream, fmt, assets=request.args.get('assets', '1') != '0',
+                                 allow_photo_paths=False)
+    except UnicodeDecodeError:
+        return jsonify({"success": False, "error": "File must be UTF-8 text"}), 400
+    except DatabaseError as e:
+        log.error("✗ Student import failed: %s", e)
+        return jsonify({"success": False, "error": "Database unavailable, nothing was imported"}), 503
+    
+    report['success'] = True
+    return jsonify(report)
+
+def send_qr_code(key, path):
+    """PNG response with a strong content ETag.
+
+    path may also be a file object (previews are not cached on disk).
+    URLs carrying the current ?v=<key> never change, so browsers may keep
+    them for a year; other requests revalidate and usually get a 304.
+    """
+    source = os.path.abspath(path) if isinstance(path, str) else path
+    response = send_file(source, mimetype='image/png', etag=key, conditional=True)
+    if request.args.get('v') == key:
+        response.headers['Cache-Control'] = f'public, max-age={QR_CACHE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+@app.route("/qr/<idno>.png")
+def qr_code(idno):
+    """QR image for a registered student, rendered once per payload"""
+    student = get_student_by_id(idno)
+    if not student:
+        return jsonify({"success": False, "error": "Student not found"}), 404
+    
+    key, path = ensure_qr_code(qr_payload(student))
+    return send_qr_code(key, path)
+
+@app.route("/qr/preview.png")
+def qr_code_preview():
+    """QR image for ?data=idno,lastname,... (add-student form preview).
+
+    Drawn in memory: any visitor can vary data, so nothing is written to
+    the QR cache; the ETag still spares a redraw on revalidation.
+    """
+    payload = request.args.get('data', '')
+    if not payload or len(payload) > QR_PREVIEW_MAX_LENGTH:
+        return jsonify({"success": False, "error": "Invalid QR data"}), 400
+    
+    key = qr_code_key(payload)
+    if request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+    return send_qr_code(key, BytesIO(qr_code_png(payload)))
+
+@app.route("/api/photo/<idno>")
+def api_photo(idno):
+    """Redirect to a student's photo, or to the placeholder.
+
+    ?variant=thumb (default, for the kiosk) | display | original. The
+    target URL carries the file's mtime, so it can be cached for long;
+    the redirect itself is cached briefly.
+    """
+    variant = request.args.get('variant', 'thumb')
+    if variant not in ('thumb', 'display', 'original'):
+        return jsonify({"success": False, "error": "Unknown variant"}), 400
+    
+    photo = photo_index.lookup(idno, None if variant == 'original' else variant)
+    if photo:
+        path, version = photo
+        url = url_for('static', filename=os.path.relpath(path, 'static').replace(os.sep, '/'), v=version)
+    else:
+        url = url_for('static', filename=os.path.relpath(PHOTO_PLACEHOLDER, 'static'))
+    
+    response = redirect(url)
+    response.headers['Cache-Control'] = f'public, max-age={PHOTO_REDIRECT_MAX_AGE}'
+    return response
+
 # API Routes
 @app.route("/api/students")
 def api_students():
@@ -297,22 +599,250 @@ def api_student(idno):
 
 @app.route("/api/attendance")
 def api_attendance():
-    attendance = get_all_attendance()
-    return jsonify(attendance)
+    """One page of attendance; pass next_cursor back as ?cursor= for the next"""
+    try:
+        page = get_attendance_page(
+            limit=request.args.get('limit', ATTENDANCE_PAGE_SIZE, type=int),
+            cursor=request.args.get('cursor') or None,
+            idno=request.args.get('idno') or None,
+            course=request.args.get('course') or None,
+            date_from=request.args.get('date_from') or None,
+            date_to=request.args.get('date_to') or None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(page)
+
+@app.route("/api/attendance/changes")
+def api_attendance_changes():
+    """Attendance inserts/deletes since a change token from /api/attendance"""
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({'error': 'since must be a change token'}), 400
+    
+    limit = request.args.get('limit', ATTENDANCE_CHANGES_LIMIT, type=int)
+    return jsonify(get_attendance_changes(since, limit))
+
+@app.route("/api/attendance/export")
+def api_attendance_export():
+    """Download attendance as ?format=csv (default) or xlsx.
+
+    Filters: date_from, date_to (inclusive YYYY-MM-DD), course, level,
+    idno. Rows stream from a server-side cursor, so any size works.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        return jsonify({'error': 'format must be csv or xlsx'}), 400
+    
+    try:
+        sql, params = build_export_query(
+            date_from=request.args.get('date_from') or None,
+            date_to=request.args.get('date_to') or None,
+            course=request.args.get('course') or None,
+            level=request.args.get('level') or None,
+            idno=request.args.get('idno') or None
+        )
+        export = AttendanceExport(sql, params, fmt)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '10'}
+    except ExportUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    
+    filename = f"attendance_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    mimetype = ('text/csv' if fmt == 'csv'
+                else 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return Response(export, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    })
+
+def report_response(report):
+    """JSON for a report, or 503 while the database is unavailable"""
+    if report is None:
+        return jsonify({'error': 'Reports need the database'}), 503
+    return jsonify(report)
+
+def report_day():
+    value = request.args.get('date')
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else datetime.now().date()
+
+@app.route("/api/reports/daily")
+def api_report_daily():
+    """Scans and distinct students per day (?from=&to=&course=&level=)"""
+    try:
+        start, end = parse_date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return report_response(daily_report(start, end, request.args.get('course') or None,
+                                        request.args.get('level') or None))
+
+@app.route("/api/reports/hourly")
+def api_report_hourly():
+    """Scans per hour of ?date= (default today)"""
+    try:
+        day = report_day()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return report_response(hourly_report(day, request.args.get('course') or None,
+                                         request.args.get('level') or None))
+
+@app.route("/api/reports/courses")
+def api_report_courses():
+    """Scans and student-days per course and level (?from=&to=)"""
+    try:
+        start, end = parse_date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return report_response(course_report(start, end))
+
+@app.route("/api/reports/students")
+def api_report_students():
+    """First-in/last-out per student on ?date= (default today)"""
+    try:
+        day = report_day()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return report_response(students_report(day, request.args.get('course') or None,
+                                           request.args.get('level') or None))
+
+@app.route("/api/reports/students/<idno>")
+def api_report_student(idno):
+    """One student's first-in/last-out per day (?from=&to=)"""
+    try:
+        start, end = parse_date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return report_response(student_report(idno, start, end))
+
+@app.route("/api/attendance/stream")
+def api_attendance_stream():
+    """Server-Sent Events: every attendance insert/delete as it happens"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    try:
+        stream = open_stream(last_event_id)
+    except TooManySubscribers as e:
+        # The page falls back to polling /api/attendance/changes
+        return jsonify({'error': str(e)}), 503
+    
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route("/api/db/stats")
+def api_db_stats():
+    """Pool, live stream and cache stats for the worker serving this request"""
+    stats = get_pool_stats()
+    stats['stream'] = get_event_hub().stats()
+    stats['student_cache'] = student_cache.stats()
+    stats['writer'] = writer_stats()
+    stats['breaker'] = get_db_health()
+    stats['photos'] = get_photo_pipeline().stats()
+    stats['photo_index'] = photo_index.stats()
+    stats['recent_scans'] = recent_scans.stats()
+    stats['queries'] = query_profiler.stats()
+    return jsonify(stats)
+
+def query_profile_args():
+    top = max(1, min(request.args.get('top', QUERY_PROFILE_TOP, type=int), 200))
+    order = request.args.get('order', 'total')
+    return top, order if order in QUERY_PROFILE_ORDERS else 'total'
+
+@app.route("/api/db/queries", methods=["GET", "DELETE"])
+def api_db_queries():
+    """Query profile of the worker serving this request (QUERY_PROFILE=1).
+
+    ?top=N statements by ?order=total|mean|max|calls time, plus recent slow
+    statements; DELETE starts the profile over.
+    """
+    if not session.get('logged_in'):
+        return jsonify({"success": False, "error": "Login required"}), 401
+    
+    if request.method == "DELETE":
+        query_profiler.reset()
+        return jsonify({"success": True})
+    
+    top, order = query_profile_args()
+    return jsonify({
+        'profiler': query_profiler.stats(),
+        'statements': query_profiler.top(top, order),
+        'slow': query_profiler.slow_log()
+    })
+
+@app.route("/admin/queries")
+def admin_queries():
+    if not session.get('logged_in'):
+        return redirect(url_for('admin'))
+    
+    top, order = query_profile_args()
+    return render_template("query_profile.html", pagetitle="QUERY PROFILE", order=order,
+                           orders=QUERY_PROFILE_ORDERS, profiler=query_profiler.stats(),
+                           statements=query_profiler.top(top, order), slow=query_profiler.slow_log())
+
+def collect_worker_metrics():
+    """Gauges and cache counters for /metrics, from the same stats as /api/db/stats"""
+    pool = get_pool_stats()
+    database = get_db_health()
+    cache = student_cache.stats()
+    scans = recent_scans.stats()
+    return [
+        ('attendance_db_pool_connections', {'state': 'in_use'}, pool['in_use']),
+        ('attendance_db_pool_connections', {'state': 'idle'}, pool['idle']),
+        ('attendance_db_pool_waiting', {}, pool['waiting']),
+        ('attendance_db_circuit_open', {}, int(database['state'] != 'closed')),
+        ('attendance_journal_bytes', {}, database['journal_bytes']),
+        ('attendance_write_queue_depth', {}, writer_stats().get('queue_depth', 0)),
+        ('attendance_student_cache_lookups_total', {'result': 'hit'}, cache['hits']),
+        ('attendance_student_cache_lookups_total', {'result': 'negative_hit'}, cache['negative_hits']),
+        ('attendance_student_cache_lookups_total', {'result': 'miss'}, cache['misses']),
+        ('attendance_scans_total', {'result': 'accepted'}, scans['accepted']),
+        ('attendance_scans_total', {'result': 'duplicate'}, scans['duplicates']),
+        ('attendance_scans_total', {'result': 'debounced'}, scans['debounced']),
+    ]
+
+metrics.add_collector(collect_worker_metrics)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus text metrics summed over every gunicorn worker"""
+    return Response(render_metrics(collect_all()), mimetype='text/plain; version=0.0.4')
+
+@app.route("/health")
+def health():
+    """Liveness plus database circuit state.
+
+    Always 200 while the app can serve: scans still work from the journal
+    during a database outage, so a platform health check should not
+    restart the service for it.
+    """
+    database = get_db_health()
+    return jsonify({
+        'status': 'ok' if database['state'] == 'closed' else 'degraded',
+        'database': database
+    })
 
 # ✅ Add this NEW route for getting LATEST attendance only:
 @app.route("/get_latest_attendance")
 def get_latest_attendance():
-    """Get only the latest attendance record"""
+    """Get the latest attendance record (or the latest ?n= records)"""
     try:
-        attendance_records = get_all_attendance()
+        n = max(1, min(request.args.get('n', 1, type=int), RECENT_ATTENDANCE_SIZE))
+        attendance_records = get_recent_attendance(n)
         
-        if attendance_records and len(attendance_records) > 0:
-            # Return only the most recent one
-            latest = attendance_records[0]
+        if attendance_records:
+            # 'record' is the most recent one
             return jsonify({
                 'success': True,
-                'record': latest
+                'record': attendance_records[0],
+                'records': attendance_records
             })
         else:
             return jsonify({
@@ -342,6 +872,15 @@ def update_student_route(idno):
     return jsonify({"success": False})
 
 # Image and QR Code Handling
+def decode_image_data(image_data):
+    """Bytes of a base64 data: URL, checked to be an image Pillow can read"""
+    from PIL import Image
+    
+    data = base64.b64decode(image_data.split(',')[-1])
+    # Reads only the header, so this is cheap
+    Image.open(BytesIO(data))
+    return data
+
 @app.route('/save_image', methods=['POST'])
 def save_image():
     data = request.get_json()
@@ -352,16 +891,13 @@ def save_image():
         return jsonify({"success": False, "error": "Missing data"})
 
     try:
-        # Decode the base64 image
-        image_data = image_data.split(',')[1]
-        image = Image.open(BytesIO(base64.b64decode(image_data)))
-
-        # Define the image filename
-        image_filename = f"static/image/{idno}.jpg"
-
-        # Save the image
-        image.save(image_filename)
-        return jsonify({"success": True, "image_url": image_filename})
+        # Resized and saved in the background; the URLs work once it is done
+        submit_photo(idno, decode_image_data(image_data), photo_index.refresh)
+        return jsonify({
+            "success": True,
+            "image_url": photo_path(idno, 'display'),
+            "thumb_url": photo_path(idno, 'thumb')
+        })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
@@ -409,6 +945,8 @@ def index():
     return render_template("attendance_checker.html", pagetitle="ATTENDANCE CHECKER")
 
 if __name__ == "__main__":
+    reset_metrics_dir()
+    start_worker()
     app.run(debug=True, host="0.0.0.0")
 
 
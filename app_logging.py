@@ -0,0 +1,94 @@
+# app_logging.py - Leveled, sampled logging off the request path
+#
+# Modules log through logging.getLogger(__name__). setup_logging() routes
+# every record through a bounded in-memory queue to one writer thread per
+# process, so a request never waits on stdout; when the queue is full the
+# record is dropped and counted instead. DEBUG and INFO records are kept
+# at LOG_SAMPLE_RATE; warnings and errors always are.
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import metrics
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Share of DEBUG/INFO records written (1.0 keeps all of them)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'
+
+_listener = None
+_listener_pid = None
+_setup_lock = threading.Lock()
+
+
+class SampleFilter(logging.Filter):
+    """Keep `rate` of the records below WARNING"""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate:
+            return True
+        metrics.inc('attendance_log_records_dropped_total', reason='sampled')
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks and leaves formatting to the writer thread"""
+
+    def prepare(self, record):
+        # The message is built by the listener; only exceptions must be
+        # rendered here, while the traceback still exists
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('attendance_log_records_dropped_total', reason='queue_full')
+
+
+def setup_logging(level=LOG_LEVEL, sample_rate=LOG_SAMPLE_RATE, stream=None):
+    """Send the root logger through the queue (once per process, again after fork)"""
+    global _listener, _listener_pid
+
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _setup_lock:
+        if _listener_pid == pid:
+            return
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(logging.Formatter(LOG_FORMAT))
+        records = queue.Queue(LOG_QUEUE_SIZE)
+        handler = DroppingQueueHandler(records)
+        handler.addFilter(SampleFilter(sample_rate))
+
+        root = logging.getLogger()
+        # A listener inherited through fork has no thread in this process
+        for old in [h for h in root.handlers if isinstance(h, DroppingQueueHandler)]:
+            root.removeHandler(old)
+        root.addHandler(handler)
+        root.setLevel(level)
+
+        _listener = QueueListener(records, writer)
+        _listener.start()
+        _listener_pid = pid
+
+
+@atexit.register
+def _flush_logging():
+    # Write out what is still queued
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
@@ -0,0 +1,107 @@
+# attendance_backfill.py - Copy attendance_legacy into the attendance fact table
+#
+#   python attendance_backfill.py [--chunk N] [--pause SECONDS]
+#   python attendance_backfill.py --status
+#
+# Migration 9 turned attendance into a view over attendance_scans plus the
+# legacy rows not copied yet. This copies those rows over CHUNK at a time,
+# each chunk in its own short transaction, so scans and reports keep
+# running. Safe to stop and rerun: the watermark in attendance_backfill
+# moves with every chunk. Finishes by applying the pending migrations,
+# which drop attendance_legacy.
+import argparse
+import os
+import sys
+import time
+
+from dbhelper import open_connection
+from migrations import migrate, check_schema
+from app_logging import setup_logging
+
+BACKFILL_CHUNK = int(os.environ.get('BACKFILL_CHUNK', '5000'))
+# Breathing room between chunks for the scans waiting on them
+BACKFILL_PAUSE = float(os.environ.get('BACKFILL_PAUSE', '0.05'))
+
+
+def backfill_status(cursor):
+    """(rows copied, rows left), or None once attendance_legacy is gone"""
+    cursor.execute("SELECT to_regclass('attendance_legacy'), to_regclass('attendance_backfill')")
+    if None in cursor.fetchone():
+        return None
+    cursor.execute("""
+        SELECT b.rows_copied, (SELECT COUNT(*) FROM attendance_legacy l WHERE l.id > b.copied_through)
+        FROM attendance_backfill b
+    """)
+    return cursor.fetchone()
+
+
+def backfill(chunk=BACKFILL_CHUNK, pause=BACKFILL_PAUSE):
+    """Copy every remaining legacy row; returns the number of rows read"""
+    conn = open_connection()
+    try:
+        cursor = conn.cursor()
+        status = backfill_status(cursor)
+        conn.commit()
+        if status is None:
+            print("✓ Nothing to backfill: attendance_legacy is gone")
+            return 0
+
+        copied, left = status
+        print(f"Backfilling {left} legacy attendance rows ({copied} already copied), {chunk} per chunk")
+        total = 0
+        started = time.monotonic()
+        while True:
+            cursor.execute("SELECT attendance_backfill_chunk(%s)", (chunk,))
+            moved = cursor.fetchone()[0]
+            conn.commit()
+            if not moved:
+                break
+            total += moved
+            if total % (chunk * 20) < chunk:
+                rate = total / max(time.monotonic() - started, 0.001)
+                print(f"  {total}/{left} rows, {rate:.0f} rows/s")
+            time.sleep(pause)
+        cursor.close()
+    finally:
+        conn.close()
+
+    print(f"✓ Backfilled {total} rows in {time.monotonic() - started:.1f}s")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy attendance_legacy into attendance_scans in chunks")
+    parser.add_argument('--chunk', type=int, default=BACKFILL_CHUNK, help="Rows per transaction")
+    parser.add_argument('--pause', type=float, default=BACKFILL_PAUSE, help="Seconds to sleep between chunks")
+    parser.add_argument('--status', action='store_true', help="Show progress without copying")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    if args.status:
+        conn = open_connection()
+        try:
+            status = backfill_status(conn.cursor())
+        finally:
+            conn.close()
+        if status is None:
+            print("✓ Backfill complete")
+            return 0
+        print(f"{status[0]} rows copied, {status[1]} left")
+        return 1 if status[1] else 0
+
+    status = check_schema()
+    if status is None:
+        print("✗ Database unavailable")
+        return 1
+    if 9 in status['pending']:
+        print("✗ Migration 9 is not applied yet: run python migrations.py first")
+        return 1
+
+    backfill(max(1, args.chunk), max(0.0, args.pause))
+    applied = migrate()
+    print(f"✓ Schema migrated ({len(applied)} migrations applied)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
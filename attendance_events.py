@@ -0,0 +1,349 @@
+# attendance_events.py - Live attendance changes fanned out to SSE monitors
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from dbhelper import open_connection, get_attendance_changes, get_change_horizon, ROSTER_CHANNEL
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'attendance_changes'
+# ROSTER_CHANNEL carries {"idnos": [...]} or {"all": true} for roster edits
+# (migration 16) and {"photos": [...]} from notify_photo_changes
+
+# Per-worker limits: each open stream holds one gunicorn thread
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', '2'))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', '15'))
+SSE_QUEUE_SIZE = 1000
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+
+class TooManySubscribers(Exception):
+    """Raised when this worker already serves SSE_MAX_SUBSCRIBERS streams"""
+
+
+class Subscription:
+    """One stream's queue of change events; None marks the end of the stream"""
+
+    __slots__ = ('queue', 'closed')
+
+    def __init__(self):
+        self.queue = queue.Queue(SSE_QUEUE_SIZE)
+        self.closed = False
+
+    def get(self, timeout):
+        """Next event, or raise queue.Empty after `timeout` seconds"""
+        return self.queue.get(timeout=timeout)
+
+
+class AttendanceEventHub:
+    """LISTENs on the attendance_changes channel and fans events out.
+
+    The log_attendance_change trigger NOTIFYs every insert/delete, so every
+    gunicorn worker sees every change with a single idle connection and no
+    polling queries. Events go to SSE subscriptions and to listener callbacks.
+    The same connection follows roster_changes for listener callbacks only.
+    """
+
+    def __init__(self, connect=open_connection, channel=CHANNEL, roster_channel=ROSTER_CHANNEL):
+        self._connect = connect
+        self._channel = channel
+        self._roster_channel = roster_channel
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._listeners = {channel: [], roster_channel: []}
+        self._thread = None
+        self._stopped = threading.Event()
+        self.connected = False
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        """Open a new subscription; raises TooManySubscribers when full"""
+        with self._lock:
+            if len(self._subscriptions) >= SSE_MAX_SUBSCRIBERS:
+                raise TooManySubscribers("Too many live monitors on this worker")
+            subscription = Subscription()
+            self._subscriptions.add(subscription)
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def add_listener(self, callback, channel=CHANNEL):
+        """Call callback(event) for every change on channel seen by this worker.
+
+        ROSTER_CHANNEL listeners also get {"all": true} on every (re)connect,
+        since edits made while disconnected were missed.
+        """
+        with self._lock:
+            self._listeners[channel].append(callback)
+        self.start()
+
+    def _notify_listeners(self, channel, event):
+        with self._lock:
+            listeners = list(self._listeners[channel])
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                log.error("Attendance listener error: %s", e)
+
+    def publish(self, event):
+        """Hand one change event to every subscription and listener"""
+        self._notify_listeners(self._channel, event)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            if subscription.closed:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+                self.delivered += 1
+            except queue.Full:
+                # A stalled client; end its stream so it reconnects and
+                # catches up from Last-Event-ID
+                subscription.closed = True
+                self.dropped += 1
+                self.unsubscribe(subscription)
+
+    def start(self):
+        """Start the LISTEN thread once per worker"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='attendance-listen', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self._subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.closed = True
+            try:
+                subscription.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def stats(self):
+        with self._lock:
+            subscribers = len(self._subscriptions)
+        return {
+            'connected': self.connected,
+            'subscribers': subscribers,
+            'max_subscribers': SSE_MAX_SUBSCRIBERS,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+
+    def _run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self._channel}")
+                cursor.execute(f"LISTEN {self._roster_channel}")
+                cursor.close()
+                self.connected = True
+                backoff = 1
+                log.info("✓ Listening for attendance changes (pid %d)", os.getpid())
+                self._notify_listeners(self._roster_channel, {'all': True})
+
+                while not self._stopped.is_set():
+                    # Wake up now and then to notice stop() and dead sockets
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            continue
+                        if notify.channel == self._roster_channel:
+                            self._notify_listeners(notify.channel, event)
+                        else:
+                            self.publish(event)
+
+            except Exception as e:
+                log.error("✗ Attendance listener lost its connection: %s", e)
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+def get_event_hub():
+    """This worker's event hub (recreated after fork)"""
+    global _hub, _hub_pid
+
+    pid = os.getpid()
+    if _hub is not None and _hub_pid == pid:
+        return _hub
+
+    with _hub_lock:
+        if _hub is None or _hub_pid != pid:
+            _hub = AttendanceEventHub()
+            _hub_pid = pid
+        return _hub
+
+
+def format_sse(event, token):
+    """Serialize one change event as a text/event-stream message.
+
+    The id is the stream's resume token rather than the event's seq: live
+    events arrive in commit order, so a later seq can come first.
+    """
+    return f"id: {token}\nevent: {event['op']}\ndata: {json.dumps(event)}\n\n"
+
+
+class _ResumeToken:
+    """Highest seq a stream can resume from without missing a change.
+
+    It only moves over seqs this stream has sent, or to the change horizon
+    after a catch-up read; a seq at or below it is never sent again.
+    """
+
+    __slots__ = ('seq', '_sent')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self._sent = set()  # sent seqs above self.seq
+
+    @property
+    def behind(self):
+        """True while a sent seq is waiting on a lower one"""
+        return bool(self._sent)
+
+    def send(self, seq):
+        """Record seq as sent; False when it was sent already"""
+        if seq <= self.seq or seq in self._sent:
+            return False
+        self._sent.add(seq)
+        while self.seq + 1 in self._sent:
+            self.seq += 1
+            self._sent.remove(self.seq)
+        return True
+
+    def settle(self, horizon):
+        """Jump to horizon once every visible change up to it was sent"""
+        if horizon is not None and horizon > self.seq:
+            self.seq = horizon
+            self._sent = {seq for seq in self._sent if seq > horizon}
+
+
+def _catch_up(token):
+    """SSE messages for unsent changes after token, or None when it is too old"""
+    messages = []
+    since = token.seq
+    while True:
+        delta = get_attendance_changes(since, settle=False)
+        if delta['reset']:
+            return None
+        for change in delta['changes']:
+            if token.send(change['seq']):
+                messages.append(format_sse(change, token.seq))
+        since = delta['token']
+        if not delta['more']:
+            break
+
+    sent = token.seq
+    token.settle(delta.get('settled'))
+    if token.seq != sent:
+        # An id-only message moves the browser's Last-Event-ID
+        messages.append(f"id: {token.seq}\n\n")
+    return messages
+
+
+def open_stream(last_event_id=None, heartbeat=SSE_HEARTBEAT):
+    """Subscribe and return a generator of SSE messages for one monitor.
+
+    Subscribing happens here, before the response starts, so the route can
+    answer 503 when the worker is full. The generator first replays changes
+    after last_event_id, then streams live events with a keepalive comment
+    every `heartbeat` seconds. While a live event is ahead of a missing
+    seq, the stream re-reads the change log every `heartbeat` seconds to
+    pick up late commits and step over rolled-back seqs.
+    """
+    hub = get_event_hub()
+    subscription = hub.subscribe()
+
+    def generate():
+        try:
+            # Ask the browser to wait 5s between reconnects
+            yield "retry: 5000\n\n"
+
+            if last_event_id is None:
+                token = _ResumeToken(get_change_horizon() or 0)
+            else:
+                token = _ResumeToken(last_event_id)
+                messages = _catch_up(token)
+                if messages is None:
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                yield from messages
+            caught_up = time.monotonic()
+
+            while not subscription.closed:
+                try:
+                    event = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    event = None
+                else:
+                    if event is None:
+                        break
+                    if token.send(event['seq']):
+                        yield format_sse(event, token.seq)
+
+                if token.behind and time.monotonic() - caught_up >= heartbeat:
+                    messages = _catch_up(token)
+                    if messages is None:
+                        yield "event: reset\ndata: {}\n\n"
+                        break
+                    yield from messages
+                    caught_up = time.monotonic()
+                elif not token.behind:
+                    caught_up = time.monotonic()
+        finally:
+            hub.unsubscribe(subscription)
+
+    return _Stream(generate(), hub, subscription)
+
+
+class _Stream:
+    """SSE body that frees its subscription even if never iterated"""
+
+    def __init__(self, generator, hub, subscription):
+        self._generator = generator
+        self._hub = hub
+        self._subscription = subscription
+
+    def __iter__(self):
+        return self._generator
+
+    def close(self):
+        self._generator.close()
+        self._hub.unsubscribe(self._subscription)
@@ -0,0 +1,304 @@
+# attendance_export.py - Stream attendance as CSV or XLSX with flat memory
+import csv
+import io
+import logging
+import os
+import re
+import threading
+import zipfile
+from datetime import datetime, timedelta
+# html.escape is already loaded by werkzeug; xml.sax.saxutils pulls in urllib.request
+from html import escape
+
+from dbhelper import open_connection
+from circuit_breaker import db_breaker
+
+log = logging.getLogger(__name__)
+
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', '5000'))
+# Each export holds a gunicorn thread and a database connection
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', '1'))
+EXPORT_COLUMNS = ('id', 'idno', 'lastname', 'firstname', 'course', 'level', 'time_logged')
+# A worksheet holds 1,048,576 rows; each one starts with the header row
+XLSX_SHEET_ROWS = 1048575
+
+# Per worker; forked workers start with a fresh count
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+class ExportBusy(Exception):
+    """Raised when this worker already runs EXPORT_MAX_CONCURRENT exports"""
+
+
+class ExportUnavailable(Exception):
+    """Raised when the database cannot be reached for an export"""
+
+
+def build_export_query(date_from=None, date_to=None, course=None, level=None, idno=None):
+    """SQL and params for the filtered export, newest first.
+
+    date_from/date_to are inclusive YYYY-MM-DD dates (ValueError if not).
+    """
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("time_logged >= %s")
+        params.append(datetime.strptime(date_from, '%Y-%m-%d'))
+    if date_to:
+        conditions.append("time_logged < %s")
+        params.append(datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1))
+    if course:
+        conditions.append("course = %s")
+        params.append(course)
+    if level:
+        conditions.append("level = %s")
+        params.append(level)
+    if idno:
+        conditions.append("idno = %s")
+        params.append(idno)
+
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    sql = f"""
+        SELECT {', '.join(EXPORT_COLUMNS)}
+        FROM attendance
+        {where}
+        ORDER BY time_logged DESC, id DESC
+    """
+    return sql, params
+
+
+class AttendanceExport:
+    """Iterable response body for one export.
+
+    Uses its own connection rather than a pooled one, so a long download
+    never takes a connection from scan requests, and a server-side
+    (named) cursor so only EXPORT_FETCH_SIZE rows are in memory at a
+    time. close() - called by the WSGI server when the download finishes
+    or the client goes away - closes the cursor and connection at once,
+    even if streaming never started.
+    """
+
+    def __init__(self, sql, params, fmt='csv', fetch_size=EXPORT_FETCH_SIZE):
+        if not _export_slots.acquire(blocking=False):
+            raise ExportBusy("Another export is running on this worker, try again shortly")
+        self._closed = False
+        self._conn = None
+        try:
+            if not db_breaker.allow():
+                raise ExportUnavailable("Database unavailable")
+            try:
+                self._conn = open_connection()
+            except Exception as e:
+                db_breaker.record_failure(e)
+                raise ExportUnavailable(f"Database unavailable: {e}")
+            db_breaker.record_success()
+
+            self._conn.set_session(readonly=True)
+            self._cursor = self._conn.cursor(name='attendance_export')
+            self._cursor.itersize = fetch_size
+            self._cursor.execute(sql, params)
+        except Exception:
+            self._release()
+            raise
+        self.fetch_size = fetch_size
+        self.format = fmt
+        self.rows = 0
+        self._generator = self._stream()
+
+    def __iter__(self):
+        return self._generator
+
+    def close(self):
+        """Stop streaming and release the connection (safe to call twice)"""
+        if getattr(self, '_generator', None) is not None:
+            self._generator.close()
+        self._release()
+
+    def _stream(self):
+        try:
+            yield from (self._xlsx() if self.format == 'xlsx' else self._csv())
+        finally:
+            self._release()
+
+    def _release(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._conn is not None:
+            try:
+                # Ends the transaction and frees the server-side cursor
+                self._conn.close()
+            except Exception:
+                pass
+        _export_slots.release()
+        if getattr(self, 'rows', None) is not None:
+            log.info("Attendance export closed after %d rows", self.rows)
+
+    def _chunks(self):
+        while True:
+            rows = self._cursor.fetchmany(self.fetch_size)
+            if not rows:
+                return
+            self.rows += len(rows)
+            yield rows
+
+    def _csv(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in self._chunks():
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def _xlsx(self):
+        out = _StreamBuffer()
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in _XLSX_PARTS.items():
+                archive.writestr(name, content)
+
+            # A new worksheet every XLSX_SHEET_ROWS rows; the workbook parts
+            # that list them are written once the count is known
+            sheets = 0
+            sheet = None
+            number = XLSX_SHEET_ROWS
+            for rows in self._chunks():
+                while rows:
+                    if number == XLSX_SHEET_ROWS:
+                        if sheet is not None:
+                            sheet.write(_SHEET_TAIL)
+                            sheet.close()
+                        sheets += 1
+                        sheet = self._xlsx_sheet(archive, sheets)
+                        number = 0
+                    part = rows[:XLSX_SHEET_ROWS - number]
+                    rows = rows[len(part):]
+                    sheet.write(b''.join(_xlsx_row(number + i, row) for i, row in enumerate(part, 2)))
+                    number += len(part)
+                yield out.take()
+            if sheet is None:
+                sheets = 1
+                sheet = self._xlsx_sheet(archive, sheets)
+            sheet.write(_SHEET_TAIL)
+            sheet.close()
+
+            for name, content in _xlsx_workbook_parts(sheets).items():
+                archive.writestr(name, content)
+        yield out.take()
+
+    @staticmethod
+    def _xlsx_sheet(archive, index):
+        sheet = archive.open(f'xl/worksheets/sheet{index}.xml', 'w', force_zip64=True)
+        sheet.write(_SHEET_HEAD)
+        sheet.write(_xlsx_row(1, EXPORT_COLUMNS))
+        return sheet
+
+
+class _StreamBuffer:
+    """Write-only sink for zipfile; take() returns what was written since"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+# Minimal SpreadsheetML package: sheets with inline strings, and a
+# date-time style for time_logged
+_XLSX_PARTS = {
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+        '<fonts count="1"><font/></fonts>'
+        '<fills count="1"><fill/></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="2"><xf/><xf numFmtId="164" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>'
+    ),
+}
+
+
+def _xlsx_workbook_parts(sheets):
+    """Content types, package and workbook parts for sheet1..sheet<sheets>"""
+    numbers = range(1, sheets + 1)
+    return {
+        '[Content_Types].xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + ''.join(f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+                      'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                      for n in numbers) +
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '</Types>'
+        ),
+        '_rels/.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ),
+        'xl/workbook.xml': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + ''.join(f'<sheet name="Attendance{f" {n}" if n > 1 else ""}" sheetId="{n}" r:id="rId{n}"/>'
+                      for n in numbers) +
+            '</sheets></workbook>'
+        ),
+        'xl/_rels/workbook.xml.rels': (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(f'<Relationship Id="rId{n}" '
+                      'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      f'Target="worksheets/sheet{n}.xml"/>' for n in numbers) +
+            f'<Relationship Id="rId{sheets + 1}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+            'Target="styles.xml"/>'
+            '</Relationships>'
+        ),
+    }
+
+
+_SHEET_HEAD = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+_SHEET_TAIL = b'</sheetData></worksheet>'
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+# Characters XML 1.0 does not allow, even escaped
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+
+def _xlsx_cell(value):
+    if isinstance(value, datetime):
+        serial = (value - _EXCEL_EPOCH) / timedelta(days=1)
+        return f'<c s="1"><v>{serial:.8f}</v></c>'
+    if isinstance(value, int):
+        return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t>{escape(_XML_INVALID.sub("", str(value)), quote=False)}</t></is></c>'
+
+
+def _xlsx_row(number, values):
+    return (f'<row r="{number}">' + ''.join(_xlsx_cell(value) for value in values) + '</row>').encode('utf-8')
@@ -0,0 +1,215 @@
+# attendance_journal.py - Append-only scan journal used when PostgreSQL is down
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows dev machines: thread locking only, single process
+    fcntl = None
+
+ATTENDANCE_JOURNAL = os.environ.get('ATTENDANCE_JOURNAL', 'attendance_journal.jsonl')
+REPLAY_SUFFIX = '.replaying'
+# Lines the database refused (or that are not JSON), kept for a person to look at
+REJECTED_SUFFIX = '.rejected'
+
+log = logging.getLogger(__name__)
+
+
+def _lock(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class AttendanceJournal:
+    """Line-delimited JSON journal of scans, safe across threads and workers.
+
+    Appends take an exclusive flock so lines from different gunicorn
+    workers never interleave. fsync is batched (group commit): a thread
+    whose lines were already covered by another thread's fsync returns
+    without syncing again.
+    """
+
+    def __init__(self, path=ATTENDANCE_JOURNAL):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._file = None
+        self._written = 0
+        self._synced = 0
+        self.appends = 0
+        self.fsyncs = 0
+
+    def append(self, entries):
+        """Durably append a list of entry dicts; returns once fsynced"""
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+
+        with self._lock:
+            while True:
+                f = self._current_file()
+                _lock(f)
+                # A drain may have renamed the file while we waited for the lock
+                if self._is_current(f):
+                    break
+                _unlock(f)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                _unlock(f)
+            self._written += 1
+            self.appends += 1
+            ticket = self._written
+
+        self._sync(ticket)
+
+    def truncate(self):
+        """Empty the journal (caller guarantees every entry is stored elsewhere)"""
+        # Same lock order as _sync: sync lock first
+        with self._sync_lock, self._lock:
+            f = self._current_file()
+            _lock(f)
+            try:
+                f.truncate(0)
+                os.fsync(f.fileno())
+            finally:
+                _unlock(f)
+            self._synced = self._written
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _sync(self, ticket):
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return
+            with self._lock:
+                target = self._written
+                f = self._file
+            os.fsync(f.fileno())
+            self.fsyncs += 1
+            self._synced = target
+
+    def _current_file(self):
+        """Open file for self.path, reopening after a rename by the drainer"""
+        if self._file is not None and not self._is_current(self._file):
+            # Make what we wrote to the renamed file durable before letting go
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _is_current(self, f):
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino
+        except OSError:
+            return False
+
+
+def iter_journal(path):
+    """Stream entries from a journal file, skipping a torn last line"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def _read_lines(path):
+    """(line, entry) for each line of a journal file; entry is None when unparseable"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = None
+            yield line, entry if isinstance(entry, dict) else None
+
+
+def drain_journal(path, store_batch, batch_size=500, unavailable=(OSError,)):
+    """Move journaled entries into the database with store_batch(entries).
+
+    The journal is renamed aside first so new scans go to a fresh file
+    while the old one is replayed. Entries carry a scan_key and
+    store_batch must ignore keys already stored, so a drain interrupted
+    halfway can simply run again. An exception in `unavailable` (the
+    database went away) stops the drain and leaves the file for the next
+    run; any other failure is the data's, so the batch is retried entry
+    by entry and the entries that still fail, like lines that do not
+    parse, are moved to path + REJECTED_SUFFIX. Returns the number of
+    entries replayed.
+    """
+    replay_path = path + REPLAY_SUFFIX
+
+    if not os.path.exists(replay_path):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+        with open(path, 'a', encoding='utf-8') as f:
+            _lock(f)
+            try:
+                os.replace(path, replay_path)
+            finally:
+                _unlock(f)
+
+    rejected = []
+
+    def store(batch):
+        try:
+            store_batch([entry for _, entry in batch])
+            return len(batch)
+        except unavailable:
+            raise
+        except Exception as e:
+            if len(batch) == 1:
+                log.warning("✗ Journal entry rejected: %s", e)
+                rejected.extend(line for line, _ in batch)
+                return 0
+        return sum(store([item]) for item in batch)
+
+    count = 0
+    batch = []
+    for line, entry in _read_lines(replay_path):
+        if entry is None:
+            rejected.append(line)
+            continue
+        batch.append((line, entry))
+        if len(batch) >= batch_size:
+            count += store(batch)
+            batch = []
+    if batch:
+        count += store(batch)
+
+    if rejected:
+        # Written (and synced) before the replay file goes away
+        with open(path + REJECTED_SUFFIX, 'a', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in rejected))
+            f.flush()
+            os.fsync(f.fileno())
+        log.warning("✗ Moved %d journal entries to %s", len(rejected), path + REJECTED_SUFFIX)
+
+    os.remove(replay_path)
+    return count
+
+
+attendance_journal = AttendanceJournal()
@@ -0,0 +1,245 @@
+# attendance_partitions.py - Monthly attendance partitions and retention
+#
+#   python attendance_partitions.py            create the coming months' partitions
+#   python attendance_partitions.py --archive  also archive months past retention
+#   python attendance_partitions.py --status   list partitions
+#
+# attendance_scans is range-partitioned by month (migration 15). Workers
+# run maintain_partitions() from the rollup refresher, so the next
+# PARTITION_MONTHS_AHEAD months always exist. With
+# ATTENDANCE_RETENTION_MONTHS set, whole months older than that are
+# detached, written to ATTENDANCE_ARCHIVE_DIR as gzipped CSV and dropped:
+# no bulk DELETE, and no attendance_changes rows, so the report rollups
+# keep counting archived months.
+#
+# Scans from before partitioning stay in one partition,
+# attendance_scans_history, bounded where migration 13 put its CHECK:
+# it is not archived month by month but in one piece, once its newest
+# month is past retention.
+import argparse
+import csv
+import gzip
+import logging
+import os
+import re
+import sys
+from datetime import datetime
+
+import psycopg2.errors
+
+from dbhelper import db_connection, open_connection
+from attendance_export import EXPORT_COLUMNS
+from app_logging import setup_logging
+
+log = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', '3'))
+# 0 keeps every month
+ATTENDANCE_RETENTION_MONTHS = int(os.environ.get('ATTENDANCE_RETENTION_MONTHS', '0'))
+ATTENDANCE_ARCHIVE_DIR = os.environ.get('ATTENDANCE_ARCHIVE_DIR', 'attendance_archive')
+ARCHIVE_FETCH_SIZE = 5000
+# DETACH gives up after this long behind running scans and is retried on
+# the next maintenance run, instead of queueing every new scan behind it
+DETACH_LOCK_TIMEOUT_MS = int(os.environ.get('DETACH_LOCK_TIMEOUT_MS', '300'))
+ARCHIVE_COLUMNS = EXPORT_COLUMNS + ('scan_key', 'source', 'flags')
+
+# pg_try_advisory_lock key: one worker maintains partitions at a time
+PARTITION_LOCK_ID = 715005
+
+_BOUND = re.compile(r"FROM \((?:'([^']+)'|MINVALUE)\) TO \((?:'([^']+)'|MAXVALUE)\)")
+# Partition names, attached or left detached by an interrupted archive
+_PARTITION_NAME = r'^attendance_scans_(y[0-9]{4}m[0-9]{2}|history)$'
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def list_partitions(cursor):
+    """[(name, lower, upper, estimated rows)] oldest first; None bounds are open"""
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'attendance_scans'::regclass
+    """)
+    partitions = []
+    for name, bound, rows in cursor.fetchall():
+        match = _BOUND.search(bound)
+        lower, upper = (_timestamp(match.group(1)), _timestamp(match.group(2))) if match else (None, None)
+        partitions.append((name, lower, upper, max(rows, 0)))
+    # The default partition (no bounds) last
+    return sorted(partitions, key=lambda p: (p[2] is None, p[2] or datetime.max))
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('attendance_scans')")
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def retained_since(cursor):
+    """First day still stored in attendance_scans, or None if nothing was archived"""
+    if not is_partitioned(cursor):
+        return None
+    bounded = [p for p in list_partitions(cursor) if p[1] or p[2]]
+    if not bounded or bounded[0][1] is None:
+        return None
+    return bounded[0][1].date()
+
+
+def ensure_partitions(cursor, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Create this month's and the next months_ahead months' partitions; returns the count"""
+    cursor.execute("""
+        SELECT COUNT(*) FILTER (WHERE attendance_create_partition(month::date))
+        FROM generate_series(date_trunc('month', LOCALTIMESTAMP),
+                             date_trunc('month', LOCALTIMESTAMP) + %s * INTERVAL '1 month',
+                             INTERVAL '1 month') month
+    """, (months_ahead,))
+    return cursor.fetchone()[0]
+
+
+def archive_partitions(retention_months=ATTENDANCE_RETENTION_MONTHS, archive_dir=ATTENDANCE_ARCHIVE_DIR):
+    """Detach, archive and drop every month older than retention; returns the files"""
+    if retention_months <= 0:
+        return []
+
+    conn = open_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT date_trunc('month', LOCALTIMESTAMP) - %s * INTERVAL '1 month'",
+                       (retention_months,))
+        cutoff = cursor.fetchone()[0]
+        expired = [name for name, _, upper, _ in list_partitions(cursor)
+                   if upper is not None and upper <= cutoff]
+        # Detached by an earlier run that failed before dropping them
+        cursor.execute("""
+            SELECT relname FROM pg_class
+            WHERE relkind = 'r' AND NOT relispartition AND relname ~ %s
+        """, (_PARTITION_NAME,))
+        leftovers = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+
+        files = []
+        for name in expired + leftovers:
+            if name in expired:
+                # Brief ACCESS EXCLUSIVE on attendance_scans; no rows move
+                cursor.execute("SET LOCAL lock_timeout = %s", (DETACH_LOCK_TIMEOUT_MS,))
+                try:
+                    cursor.execute(f'ALTER TABLE attendance_scans DETACH PARTITION "{name}"')
+                except psycopg2.errors.LockNotAvailable:
+                    conn.rollback()
+                    log.warning("Attendance partition %s is busy; detaching on the next run", name)
+                    continue
+                conn.commit()
+                log.info("Detached attendance partition %s", name)
+            files.append(_archive(conn, name, archive_dir))
+            cursor.execute(f'DROP TABLE "{name}"')
+            conn.commit()
+        cursor.close()
+        return files
+    finally:
+        conn.close()
+
+
+def _archive(conn, name, archive_dir):
+    """Write a detached partition to <archive_dir>/<name>.csv.gz"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    partial = path + '.partial'
+
+    cursor = conn.cursor(name=f'archive_{name}')
+    cursor.itersize = ARCHIVE_FETCH_SIZE
+    cursor.execute(f"""
+        SELECT f.id, s.idno, s.lastname, s.firstname, s.course, s.level, f.scanned_at,
+               f.scan_key, COALESCE(src.name, f.source_id::text), f.flags
+        FROM "{name}" f
+        JOIN attendance_students s ON s.student_id = f.student_id
+        LEFT JOIN attendance_sources src ON src.source_id = f.source_id
+        ORDER BY f.scanned_at, f.id
+    """)
+    rows = 0
+    with gzip.open(partial, 'wt', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(ARCHIVE_COLUMNS)
+        while True:
+            chunk = cursor.fetchmany(ARCHIVE_FETCH_SIZE)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            rows += len(chunk)
+        out.flush()
+        os.fsync(out.fileno())
+    cursor.close()
+    conn.commit()
+    os.replace(partial, path)
+
+    log.info("✓ Archived %d attendance rows from %s to %s", rows, name, path)
+    return path
+
+
+def maintain_partitions():
+    """Refresher hook: create upcoming partitions, archive expired ones.
+
+    Skipped while another worker holds the lock or before migration 15.
+    """
+    try:
+        with db_connection(autocommit=True) as conn:
+            if not conn:
+                return
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (PARTITION_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                return
+            try:
+                if not is_partitioned(cursor):
+                    return
+                created = ensure_partitions(cursor)
+                if created:
+                    log.info("✓ Created %d attendance partitions", created)
+                archive_partitions()
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (PARTITION_LOCK_ID,))
+                cursor.close()
+    except Exception as e:
+        log.error("✗ Partition maintenance failed: %s", e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain monthly attendance partitions")
+    parser.add_argument('--status', action='store_true', help="List partitions without changing anything")
+    parser.add_argument('--archive', action='store_true',
+                        help="Archive months older than --retention (default ATTENDANCE_RETENTION_MONTHS)")
+    parser.add_argument('--retention', type=int, default=ATTENDANCE_RETENTION_MONTHS, help="Months to keep")
+    parser.add_argument('--ahead', type=int, default=PARTITION_MONTHS_AHEAD, help="Future months to create")
+    parser.add_argument('--dir', default=ATTENDANCE_ARCHIVE_DIR, help="Archive directory")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    conn = open_connection()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        if not is_partitioned(cursor):
+            print("✗ attendance_scans is not partitioned yet: run python migrations.py")
+            return 1
+        if not args.status:
+            print(f"✓ Created {ensure_partitions(cursor, max(0, args.ahead))} partitions")
+        for name, lower, upper, rows in list_partitions(cursor):
+            span = f"{lower or '-inf'} .. {upper or '+inf'}" if lower or upper else "default"
+            print(f"  {name:32} {span:45} ~{rows} rows")
+        cursor.close()
+    finally:
+        conn.close()
+
+    if args.archive:
+        if args.retention <= 0:
+            print("✗ Set --retention (or ATTENDANCE_RETENTION_MONTHS) to archive")
+            return 1
+        files = archive_partitions(args.retention, args.dir)
+        print(f"✓ Archived {len(files)} partitions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
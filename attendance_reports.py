@@ -0,0 +1,380 @@
+# attendance_reports.py - Rollup tables for attendance reports
+#
+# attendance_rollup_hourly      scans per day/hour/course/level
+# attendance_rollup_student_day first-in/last-out and scans per student per day
+#
+# Both are kept current from the attendance_changes log (every insert and
+# delete, numbered by seq), so reports never scan the attendance table.
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from dbhelper import db_connection, prune_attendance_changes, change_horizon
+from attendance_partitions import maintain_partitions, retained_since
+
+log = logging.getLogger(__name__)
+
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get('ROLLUP_REFRESH_INTERVAL', '15'))
+ROLLUP_BATCH_SIZE = 50000
+# pg_try_advisory_xact_lock key: one refresher at a time across workers
+ROLLUP_LOCK_ID = 715001
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_DAYS = 366
+REPORT_STUDENT_LIMIT = 1000
+# The refresher also trims the change log and maintains the monthly
+# attendance partitions this often
+CHANGES_PRUNE_INTERVAL = 3600
+
+# Change rows in (%(after)s, %(upto)s]
+_CHANGES = "attendance_changes WHERE seq > %(after)s AND seq <= %(upto)s"
+
+
+def refresh_rollups(batch_size=ROLLUP_BATCH_SIZE):
+    """Apply new attendance changes to the rollups.
+
+    Returns the number of changes applied, or None when the database is
+    unavailable or another worker is already refreshing. The first run
+    (or one that fell behind the retained change log) rebuilds from the
+    attendance table instead.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return None
+
+        cursor.execute("SELECT last_seq FROM rollup_state WHERE name = 'attendance'")
+        row = cursor.fetchone()
+        last_seq = row[0] if row else None
+
+        cursor.execute("SELECT MIN(seq) FROM attendance_changes")
+        oldest = cursor.fetchone()[0]
+        if last_seq is None or (oldest is not None and oldest > last_seq + 1):
+            count = _rebuild(cursor)
+            conn.commit()
+            cursor.close()
+            log.info("✓ Attendance rollups rebuilt from %d rows", count)
+            return count
+
+        applied = 0
+        while True:
+            upto, count = _next_batch(cursor, last_seq, batch_size)
+            if not count:
+                break
+            _apply(cursor, {'after': last_seq, 'upto': upto})
+            applied += count
+            last_seq = upto
+            if count < batch_size:
+                break
+
+        cursor.execute("""
+            UPDATE rollup_state SET last_seq = %s, refreshed_at = CURRENT_TIMESTAMP
+            WHERE name = 'attendance'
+        """, (last_seq,))
+        conn.commit()
+        cursor.close()
+
+    return applied
+
+
+def _next_batch(cursor, after, batch_size):
+    """Upper seq and size of the next batch of settled changes.
+
+    The batch stops at the change horizon, so a seq that is still
+    uncommitted (or missing) is never stepped over.
+    """
+    cursor.execute("""
+        SELECT MAX(seq), COUNT(*) FROM (
+            SELECT seq FROM attendance_changes
+            WHERE seq > %(after)s AND seq <= %(settled)s
+            ORDER BY seq
+            LIMIT %(limit)s
+        ) batch
+    """, {'after': after, 'settled': change_horizon.settled(cursor), 'limit': batch_size})
+    return cursor.fetchone()
+
+
+def _apply(cursor, span):
+    """Add one batch of inserts (+1) and deletes (-1) to the rollups"""
+    cursor.execute(f"""
+        INSERT INTO attendance_rollup_hourly (day, hour, course, level, scans)
+        SELECT time_logged::date, EXTRACT(HOUR FROM time_logged)::smallint, course, level,
+               SUM(CASE op WHEN 'I' THEN 1 ELSE -1 END)
+        FROM {_CHANGES}
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (day, hour, course, level)
+        DO UPDATE SET scans = attendance_rollup_hourly.scans + EXCLUDED.scans
+    """, span)
+
+    # LEAST/GREATEST are idempotent, so inserts can extend first-in/last-out
+    # directly; deletes are handled below
+    cursor.execute(f"""
+        INSERT INTO attendance_rollup_student_day (day, idno, course, level, first_in, last_out, scans)
+        SELECT time_logged::date, idno,
+               (array_agg(course ORDER BY seq DESC))[1],
+               (array_agg(level ORDER BY seq DESC))[1],
+               MIN(time_logged) FILTER (WHERE op = 'I'),
+               MAX(time_logged) FILTER (WHERE op = 'I'),
+               SUM(CASE op WHEN 'I' THEN 1 ELSE -1 END)
+        FROM {_CHANGES}
+        GROUP BY 1, 2
+        ON CONFLICT (day, idno) DO UPDATE SET
+            course = EXCLUDED.course,
+            level = EXCLUDED.level,
+            first_in = LEAST(attendance_rollup_student_day.first_in, EXCLUDED.first_in),
+            last_out = GREATEST(attendance_rollup_student_day.last_out, EXCLUDED.last_out),
+            scans = attendance_rollup_student_day.scans + EXCLUDED.scans
+    """, span)
+
+    # A delete can remove the first or last scan of the day: recompute those
+    # from attendance (idx_attendance_idno_time), then drop emptied rows
+    cursor.execute(f"""
+        UPDATE attendance_rollup_student_day r
+        SET first_in = a.first_in, last_out = a.last_out
+        FROM (
+            SELECT k.day, k.idno, MIN(a.time_logged) AS first_in, MAX(a.time_logged) AS last_out
+            FROM (SELECT DISTINCT time_logged::date AS day, idno FROM {_CHANGES} AND op = 'D') k
+            LEFT JOIN attendance a
+                   ON a.idno = k.idno AND a.time_logged >= k.day AND a.time_logged < k.day + 1
+            GROUP BY k.day, k.idno
+        ) a
+        WHERE r.day = a.day AND r.idno = a.idno
+    """, span)
+    cursor.execute(f"""
+        DELETE FROM attendance_rollup_student_day
+        WHERE scans <= 0
+          AND (day, idno) IN (SELECT time_logged::date, idno FROM {_CHANGES} AND op = 'D')
+    """, span)
+    cursor.execute(f"""
+        DELETE FROM attendance_rollup_hourly
+        WHERE scans <= 0
+          AND day IN (SELECT time_logged::date FROM {_CHANGES} AND op = 'D')
+    """, span)
+
+
+def _rebuild(cursor):
+    """Recompute the rollups from attendance; returns the row count"""
+    # Waits for in-flight scans and holds new ones until commit, so the
+    # rollups and last_seq describe exactly the same rows
+    cursor.execute("LOCK TABLE attendance IN SHARE MODE")
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM attendance_changes")
+    last_seq = cursor.fetchone()[0]
+
+    # Archived months (attendance_partitions) only live on in the rollups:
+    # keep the days before the oldest stored one
+    since = retained_since(cursor)
+    if since:
+        cursor.execute("SELECT LEAST(%s, MIN(time_logged)::date) FROM attendance", (since,))
+        since = cursor.fetchone()[0]
+    cursor.execute("DELETE FROM attendance_rollup_hourly WHERE day >= %s", (since or date.min,))
+    cursor.execute("DELETE FROM attendance_rollup_student_day WHERE day >= %s", (since or date.min,))
+    cursor.execute("""
+        INSERT INTO attendance_rollup_hourly (day, hour, course, level, scans)
+        SELECT time_logged::date, EXTRACT(HOUR FROM time_logged)::smallint, course, level, COUNT(*)
+        FROM attendance
+        GROUP BY 1, 2, 3, 4
+    """)
+    cursor.execute("""
+        INSERT INTO attendance_rollup_student_day (day, idno, course, level, first_in, last_out, scans)
+        SELECT time_logged::date, idno,
+               (array_agg(course ORDER BY time_logged DESC, id DESC))[1],
+               (array_agg(level ORDER BY time_logged DESC, id DESC))[1],
+               MIN(time_logged), MAX(time_logged), COUNT(*)
+        FROM attendance
+        GROUP BY 1, 2
+    """)
+    cursor.execute("SELECT COALESCE(SUM(scans), 0) FROM attendance_rollup_hourly")
+    count = cursor.fetchone()[0]
+
+    cursor.execute("""
+        UPDATE rollup_state SET last_seq = %s, refreshed_at = CURRENT_TIMESTAMP
+        WHERE name = 'attendance'
+    """, (last_seq,))
+    return count
+
+
+def start_rollup_refresher(interval=ROLLUP_REFRESH_INTERVAL):
+    """Background thread that keeps the rollups current"""
+    def run():
+        next_prune = time.monotonic()
+        while True:
+            try:
+                refresh_rollups()
+            except Exception as e:
+                log.error("✗ Rollup refresh failed: %s", e)
+            if time.monotonic() >= next_prune:
+                prune_attendance_changes()
+                maintain_partitions()
+                next_prune = time.monotonic() + CHANGES_PRUNE_INTERVAL
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='rollup-refresher', daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_date_range(date_from=None, date_to=None, default_days=REPORT_DEFAULT_DAYS):
+    """(start, end) dates from YYYY-MM-DD strings; raises ValueError"""
+    end = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else date.today()
+    start = (datetime.strptime(date_from, '%Y-%m-%d').date() if date_from
+             else end - timedelta(days=default_days - 1))
+    if start > end:
+        raise ValueError("from is after to")
+    if (end - start).days >= REPORT_MAX_DAYS:
+        raise ValueError(f"Date range is limited to {REPORT_MAX_DAYS} days")
+    return start, end
+
+
+def _filters(course, level):
+    sql = ""
+    params = []
+    if course:
+        sql += " AND course = %s"
+        params.append(course)
+    if level:
+        sql += " AND level = %s"
+        params.append(level)
+    return sql, params
+
+
+def _as_of(cursor):
+    cursor.execute("SELECT last_seq, refreshed_at FROM rollup_state WHERE name = 'attendance'")
+    row = cursor.fetchone()
+    return {'seq': row[0], 'refreshed_at': str(row[1]) if row[1] else None} if row else None
+
+
+def _report(build):
+    """Run build(cursor) on a pooled connection; None without a database"""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        result = build(cursor)
+        result['as_of'] = _as_of(cursor)
+        cursor.close()
+        conn.rollback()
+        return result
+
+
+def daily_report(start, end, course=None, level=None):
+    """Scans and distinct students per day"""
+    def build(cursor):
+        where, params = _filters(course, level)
+        cursor.execute(f"""
+            SELECT day, SUM(scans) FROM attendance_rollup_hourly
+            WHERE day BETWEEN %s AND %s{where}
+            GROUP BY day
+        """, [start, end] + params)
+        scans = dict(cursor.fetchall())
+        cursor.execute(f"""
+            SELECT day, COUNT(*) FROM attendance_rollup_student_day
+            WHERE day BETWEEN %s AND %s{where}
+            GROUP BY day
+        """, [start, end] + params)
+        students = dict(cursor.fetchall())
+
+        days = []
+        day = start
+        while day <= end:
+            days.append({'date': str(day), 'scans': int(scans.get(day, 0)),
+                         'students': students.get(day, 0)})
+            day += timedelta(days=1)
+        return {'from': str(start), 'to': str(end), 'days': days}
+
+    return _report(build)
+
+
+def hourly_report(day, course=None, level=None):
+    """Scans per hour of one day"""
+    def build(cursor):
+        where, params = _filters(course, level)
+        cursor.execute(f"""
+            SELECT hour, SUM(scans) FROM attendance_rollup_hourly
+            WHERE day = %s{where}
+            GROUP BY hour
+        """, [day] + params)
+        scans = dict(cursor.fetchall())
+        return {'date': str(day),
+                'hours': [{'hour': hour, 'scans': int(scans.get(hour, 0))} for hour in range(24)]}
+
+    return _report(build)
+
+
+def course_report(start, end):
+    """Scans and student-days per course and level"""
+    def build(cursor):
+        cursor.execute("""
+            SELECT course, level, SUM(scans) FROM attendance_rollup_hourly
+            WHERE day BETWEEN %s AND %s
+            GROUP BY course, level
+            ORDER BY course, level
+        """, (start, end))
+        rows = cursor.fetchall()
+        cursor.execute("""
+            SELECT course, level, COUNT(*) FROM attendance_rollup_student_day
+            WHERE day BETWEEN %s AND %s
+            GROUP BY course, level
+        """, (start, end))
+        student_days = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+        return {'from': str(start), 'to': str(end), 'courses': [{
+            'course': row[0],
+            'level': row[1],
+            'scans': int(row[2]),
+            'student_days': student_days.get((row[0], row[1]), 0)
+        } for row in rows]}
+
+    return _report(build)
+
+
+def students_report(day, course=None, level=None, limit=REPORT_STUDENT_LIMIT):
+    """First-in/last-out of every student seen on one day"""
+    def build(cursor):
+        where, params = _filters(course, level)
+        cursor.execute(f"""
+            SELECT r.idno, u.lastname, u.firstname, r.course, r.level, r.first_in, r.last_out, r.scans
+            FROM (
+                SELECT * FROM attendance_rollup_student_day
+                WHERE day = %s{where}
+                ORDER BY first_in, idno
+                LIMIT %s
+            ) r
+            LEFT JOIN users u ON u.idno = r.idno
+            ORDER BY r.first_in, r.idno
+        """, [day] + params + [limit + 1])
+        rows = cursor.fetchall()
+        return {'date': str(day), 'more': len(rows) > limit, 'students': [{
+            'idno': row[0],
+            'lastname': row[1],
+            'firstname': row[2],
+            'course': row[3],
+            'level': row[4],
+            'first_in': str(row[5]) if row[5] else None,
+            'last_out': str(row[6]) if row[6] else None,
+            'scans': row[7]
+        } for row in rows[:limit]]}
+
+    return _report(build)
+
+
+def student_report(idno, start, end):
+    """One student's first-in/last-out per day"""
+    def build(cursor):
+        cursor.execute("""
+            SELECT day, first_in, last_out, scans FROM attendance_rollup_student_day
+            WHERE idno = %s AND day BETWEEN %s AND %s
+            ORDER BY day DESC
+        """, (idno, start, end))
+        return {'idno': idno, 'from': str(start), 'to': str(end), 'days': [{
+            'date': str(row[0]),
+            'first_in': str(row[1]) if row[1] else None,
+            'last_out': str(row[2]) if row[2] else None,
+            'scans': row[3]
+        } for row in cursor.fetchall()]}
+
+    return _report(build)
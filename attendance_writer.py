@@ -0,0 +1,230 @@
+# attendance_writer.py - Optional write-behind batching for scans
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from dbhelper import insert_attendance_batch, insert_attendance_batch_to_file
+from attendance_journal import AttendanceJournal, ATTENDANCE_JOURNAL
+from student_cache import student_cache, MISS
+
+log = logging.getLogger(__name__)
+
+# 'sync' (default) writes each scan in its own INSERT; 'batch' queues scans
+# and a background thread writes them in multi-row INSERTs
+ATTENDANCE_WRITE_MODE = os.environ.get('ATTENDANCE_WRITE_MODE', 'sync')
+ATTENDANCE_BATCH_SIZE = int(os.environ.get('ATTENDANCE_BATCH_SIZE', '200'))
+ATTENDANCE_BATCH_INTERVAL = float(os.environ.get('ATTENDANCE_BATCH_INTERVAL', '0.5'))
+ATTENDANCE_QUEUE_SIZE = int(os.environ.get('ATTENDANCE_QUEUE_SIZE', '10000'))
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def spool_path(pid):
+    """Per-worker spool next to the journal; replayed if the worker dies"""
+    directory = os.path.dirname(os.path.abspath(ATTENDANCE_JOURNAL))
+    return os.path.join(directory, f"attendance_spool.{pid}.jsonl")
+
+
+class AttendanceWriter:
+    """Background flusher that writes queued scans in batches.
+
+    Each scan is appended to this worker's spool file (fsynced) before it
+    is acknowledged, so a crash loses nothing: replay_attendance_journal
+    loads spools of dead workers. A batch is written when
+    ATTENDANCE_BATCH_SIZE scans are waiting or ATTENDANCE_BATCH_INTERVAL
+    seconds after the first one arrived, whichever comes first. Batches
+    that cannot reach the database go to the journal, the same as a failed
+    synchronous insert. The spool is emptied whenever the queue drains.
+    """
+
+    def __init__(self, batch_size=ATTENDANCE_BATCH_SIZE, interval=ATTENDANCE_BATCH_INTERVAL,
+                 queue_size=ATTENDANCE_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(queue_size)
+        self._spool = AttendanceJournal(spool_path(os.getpid()))
+        # Held while queueing and while deciding the spool can be emptied
+        self._submit_lock = threading.Lock()
+        self._pending = 0      # spool appends not yet queued
+        self._in_flight = 0    # batches being written
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.failed_batches = 0
+        self.rejected = 0
+        self.last_batch_size = 0
+        self.flush_total = 0.0
+        self.flush_max = 0.0
+        self._thread.start()
+
+    def submit(self, entry):
+        """Durably queue a scan entry dict; False when full or shutting down"""
+        with self._submit_lock:
+            if self._stopping.is_set():
+                return False
+            if self._queue.qsize() + self._pending >= self._queue.maxsize:
+                with self._stats_lock:
+                    self.rejected += 1
+                return False
+            self._pending += 1
+
+        # fsync outside the lock so concurrent scans share one group commit
+        try:
+            self._spool.append([entry])
+        except Exception as e:
+            log.error("✗ Could not spool scan: %s", e)
+            with self._submit_lock:
+                self._pending -= 1
+            return False
+
+        with self._submit_lock:
+            self._queue.put_nowait(entry)
+            self._pending -= 1
+        return True
+
+    def stop(self, timeout=10):
+        """Flush what is queued and stop the thread"""
+        with self._submit_lock:
+            self._stopping.set()
+        self._thread.join(timeout)
+        if not self._thread.is_alive() and self._queue.empty():
+            self._spool.close()
+            os.remove(self._spool.path)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'mode': ATTENDANCE_WRITE_MODE,
+                'queue_depth': self._queue.qsize(),
+                'batches': self.batches,
+                'rows': self.rows,
+                'failed_batches': self.failed_batches,
+                'rejected': self.rejected,
+                'last_batch_size': self.last_batch_size,
+                'avg_batch_size': round(self.rows / self.batches, 2) if self.batches else 0.0,
+                'flush_avg_ms': round(self.flush_total / self.batches * 1000, 3) if self.batches else 0.0,
+                'flush_max_ms': round(self.flush_max * 1000, 3),
+            }
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            with self._submit_lock:
+                self._in_flight += 1
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0 or self._stopping.is_set():
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+
+            with self._submit_lock:
+                self._in_flight -= 1
+                if self._in_flight == 0 and self._pending == 0 and self._queue.empty():
+                    # Everything spooled is now in the database or the journal
+                    self._spool.truncate()
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            insert_attendance_batch(batch)
+        except Exception as e:
+            log.error("✗ Error writing attendance batch of %d: %s", len(batch), e)
+            with self._stats_lock:
+                self.failed_batches += 1
+            # One journal append and fsync for the whole batch
+            insert_attendance_batch_to_file(batch)
+            return
+
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            self.batches += 1
+            self.rows += len(batch)
+            self.last_batch_size = len(batch)
+            self.flush_total += elapsed
+            self.flush_max = max(self.flush_max, elapsed)
+
+
+def get_writer():
+    """This worker's writer, or None in sync mode"""
+    global _writer, _writer_pid
+
+    if ATTENDANCE_WRITE_MODE != 'batch':
+        return None
+
+    pid = os.getpid()
+    if _writer is not None and _writer_pid == pid:
+        return _writer
+
+    with _writer_lock:
+        if _writer is None or _writer_pid != pid:
+            _writer = AttendanceWriter()
+            _writer_pid = pid
+        return _writer
+
+
+def queue_scan(idno, lastname, firstname, course, level, time_logged, scan_key=None):
+    """Queue a scan for the batch writer and return the record to show.
+
+    The record uses cached roster data when available (the INSERT resolves
+    the roster again on the server). Returns None in sync mode or when
+    the queue is full, so the caller should fall back to record_scan. A
+    scan_key already in the table is skipped when the batch is written.
+    """
+    writer = get_writer()
+    if writer is None:
+        return None
+
+    entry = {
+        'scan_key': scan_key or uuid.uuid4().hex,
+        'idno': idno,
+        'lastname': lastname,
+        'firstname': firstname,
+        'course': course,
+        'level': level,
+        'time_logged': time_logged
+    }
+    if not writer.submit(entry):
+        return None
+
+    student = student_cache.get(idno)
+    if student is not MISS and student is not None:
+        record = student._asdict()
+    else:
+        record = {'idno': idno, 'lastname': lastname, 'firstname': firstname,
+                  'course': course, 'level': level}
+    record['time_logged'] = time_logged
+    record['queued'] = True
+    return record
+
+
+def shutdown_writer():
+    """Flush and stop this worker's writer (gunicorn worker_exit hook)"""
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.stop()
+        log.info("Attendance writer flushed: %s", _writer.stats())
+
+
+def writer_stats():
+    writer = get_writer()
+    return writer.stats() if writer else {'mode': ATTENDANCE_WRITE_MODE}
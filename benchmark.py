@@ -0,0 +1,618 @@
+# benchmark.py - Scan and listing benchmarks against a throwaway database
+#
+#   python benchmark.py generate [--students N] [--days D] [--scans-per-day S]
+#   python benchmark.py run [--suite micro|load|all] [--quick] [--url URL] [--save FILE] [--compare FILE]
+#   python benchmark.py compare OLD.json NEW.json
+#
+# Uses BENCH_DATABASE_URL, never DATABASE_URL: generate wipes users and
+# attendance. App logging runs at WARNING unless LOG_LEVEL is set. Load scenarios drive the app in this process with
+# gunicorn_config.threads client threads (about one gthread worker), or a
+# running server with --url. Results give throughput, p50/p95/p99 latency
+# and peak RSS; --save writes them as a JSON baseline and --compare exits
+# 1 when a p95 or throughput is more than BENCH_REGRESSION_PCT worse.
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+BENCH_DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+BENCH_REGRESSION_PCT = float(os.environ.get('BENCH_REGRESSION_PCT', '20'))
+BENCH_SEED = 715
+
+# Synthetic school: scans cluster in the minutes after each class start
+COURSES = ('BSIT', 'BSCS', 'BSIS', 'BSBA', 'BSED', 'BSN')
+LEVELS = ('1', '2', '3', '4')
+CLASS_STARTS = ('07:30', '10:00', '13:00', '16:00')
+
+
+def _use_bench_database():
+    if not BENCH_DATABASE_URL:
+        sys.exit("✗ Set BENCH_DATABASE_URL to a throwaway PostgreSQL database")
+    os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+    # Before the app starts: per-scan INFO lines would drown the results
+    from app_logging import setup_logging
+    setup_logging(level=os.environ.get('LOG_LEVEL', 'WARNING'))
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence anything printed while measuring"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Stats dict from per-request seconds over elapsed wall seconds"""
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': round(len(ordered) / elapsed, 1) if elapsed > 0 else None,
+        'p50_ms': ms(_percentile(ordered, 50)),
+        'p95_ms': ms(_percentile(ordered, 95)),
+        'p99_ms': ms(_percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+    }
+
+
+# --- Synthetic data -------------------------------------------------------
+
+def generate(students=2000, days=180, scans_per_day=4000, seed=BENCH_SEED):
+    """Replace users and attendance with a synthetic school; returns row counts"""
+    from migrations import migrate
+    from dbhelper import open_connection
+
+    migrate()
+    conn = open_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            TRUNCATE users, attendance_scans, attendance_students, attendance_changes,
+                     attendance_rollup_hourly, attendance_rollup_student_day RESTART IDENTITY
+        """)
+        cursor.execute("SELECT setseed(%s)", (1 / seed,))
+        cursor.execute("""
+            INSERT INTO users (idno, lastname, firstname, course, level)
+            SELECT 'B' || lpad(n::text, 6, '0'), 'Last' || n, 'First' || n,
+                   (%(courses)s::text[])[1 + n %% array_length(%(courses)s::text[], 1)],
+                   (%(levels)s::text[])[1 + (n / 7) %% array_length(%(levels)s::text[], 1)]
+            FROM generate_series(1, %(students)s) n
+        """, {'students': students, 'courses': list(COURSES), 'levels': list(LEVELS)})
+        cursor.execute("""
+            INSERT INTO attendance_students (idno, lastname, firstname, course, level)
+            SELECT idno, lastname, firstname, course, level FROM users ORDER BY id
+        """)
+
+        first_day = datetime.now().date() - timedelta(days=days)
+        cursor.execute("""
+            SELECT attendance_create_partition(month::date)
+            FROM generate_series(date_trunc('month', %s::date), date_trunc('month', LOCALTIMESTAMP),
+                                 INTERVAL '1 month') month
+        """, (first_day,))
+        # A bulk load, not scans: keep it out of attendance_changes like a
+        # partition move; the rollups are rebuilt below
+        cursor.execute("SELECT set_config('attendance.moving_partitions', 'on', TRUE)")
+        cursor.execute("""
+            INSERT INTO attendance_scans (student_id, scanned_at, source_id, flags)
+            SELECT 1 + floor(random() * %(students)s)::int,
+                   date_trunc('second', d
+                     + (%(starts)s::interval[])[1 + floor(random() * array_length(%(starts)s::interval[], 1))::int]
+                     + power(random(), 3) * INTERVAL '30 minutes'),
+                   2, 0
+            FROM generate_series(%(first_day)s::timestamp, %(first_day)s::timestamp + (%(days)s - 1) * INTERVAL '1 day',
+                                 INTERVAL '1 day') d,
+                 generate_series(1, %(per_day)s) n
+            ORDER BY 2
+        """, {'students': students, 'starts': list(CLASS_STARTS), 'first_day': first_day,
+              'days': days, 'per_day': scans_per_day})
+        scans = cursor.rowcount
+        cursor.execute("UPDATE rollup_state SET last_seq = NULL WHERE name = 'attendance'")
+        conn.commit()
+
+        conn.autocommit = True
+        cursor.execute("ANALYZE")
+        cursor.close()
+    finally:
+        conn.close()
+
+    from attendance_reports import refresh_rollups
+    refresh_rollups()
+    return {'students': students, 'days': days, 'scans': scans}
+
+
+def dataset_stats():
+    from dbhelper import db_connection
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM users),
+                   (SELECT COUNT(*) FROM attendance),
+                   (SELECT MIN(time_logged)::text FROM attendance),
+                   (SELECT MAX(time_logged)::text FROM attendance)
+        """)
+        users, scans, first, last = cursor.fetchone()
+        cursor.close()
+    return {'students': users, 'scans': scans, 'first': first, 'last': last}
+
+
+class ScanFeed:
+    """Unique scan payloads from the roster, as kiosks would send them.
+
+    Each student's scans are SCAN_SPACING apart in time_logged, so the
+    debounce never turns a benchmark scan into a duplicate; dup_rate of
+    them re-send an earlier scan_key like a kiosk retry.
+    """
+    SCAN_SPACING = timedelta(minutes=5)
+
+    def __init__(self, roster, dup_rate=0.0, seed=BENCH_SEED):
+        self.roster = list(roster)
+        self.dup_rate = dup_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._start = _after_last_scan()
+        self._sent = []
+
+    def next(self):
+        with self._lock:
+            if self._sent and self._random.random() < self.dup_rate:
+                return self._random.choice(self._sent)
+            student = self.roster[self._count % len(self.roster)]
+            when = self._start + (self._count // len(self.roster)) * self.SCAN_SPACING
+            self._count += 1
+            scan = dict(student, time_logged=when.strftime('%Y-%m-%d %H:%M:%S'),
+                        scan_key=uuid.uuid4().hex)
+            self._sent.append(scan)
+            if len(self._sent) > 1000:
+                self._sent.pop(0)
+            return scan
+
+
+def _after_last_scan():
+    """A time_logged clear of every stored scan, so a new feed (or run) never
+    lands in the debounce window of an earlier one"""
+    from dbhelper import db_connection
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GREATEST(MAX(time_logged), LOCALTIMESTAMP) FROM attendance")
+        last = cursor.fetchone()[0]
+        cursor.close()
+    return last.replace(microsecond=0) + timedelta(hours=1)
+
+
+def load_roster():
+    from dbhelper import db_connection
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT idno, lastname, firstname, course, level FROM users ORDER BY idno")
+        roster = [dict(zip(('idno', 'lastname', 'firstname', 'course', 'level'), row))
+                  for row in cursor.fetchall()]
+        cursor.close()
+    if not roster:
+        sys.exit("✗ No students: run python benchmark.py generate first")
+    return roster
+
+
+# --- dbhelper micro-benchmarks ----------------------------------------------
+
+def _time_calls(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def micro_benchmarks(quick=False):
+    """One thread, one call at a time: the cost of each dbhelper function"""
+    import dbhelper
+    from student_cache import student_cache
+
+    roster = load_roster()
+    feed = ScanFeed(roster)
+    scale = 0.2 if quick else 1.0
+    n = lambda count: max(5, int(count * scale))
+    rng = random.Random(BENCH_SEED)
+    some_idno = lambda: rng.choice(roster)['idno']
+
+    first = dbhelper.get_attendance_page(limit=50)
+    page = first
+    for _ in range(20):
+        if not page['next_cursor']:
+            break
+        page = dbhelper.get_attendance_page(limit=50, cursor=page['next_cursor'])
+    deep_cursor = page['next_cursor'] or first['next_cursor']
+    last_day = (dataset_stats()['last'] or datetime.now().isoformat())[:10]
+    token = first.get('change_token', 0)
+    with _quiet():
+        student_cache.warm(dbhelper.get_all_users_formatted())
+
+    def uncached_student():
+        student_cache.clear()
+        dbhelper.get_student_by_id(some_idno())
+
+    def scan():
+        s = feed.next()
+        dbhelper.record_scan(s['idno'], s['lastname'], s['firstname'], s['course'], s['level'],
+                             s['time_logged'], scan_key=s['scan_key'])
+
+    def scan_batch():
+        dbhelper.record_scan_batch([feed.next() for _ in range(50)])
+
+    def replay_batch():
+        dbhelper.insert_attendance_batch([feed.next() for _ in range(50)], debounce=0)
+
+    def all_pages():
+        page = dbhelper.get_attendance_page(limit=dbhelper.ATTENDANCE_PAGE_MAX)
+        while page['next_cursor']:
+            page = dbhelper.get_attendance_page(limit=dbhelper.ATTENDANCE_PAGE_MAX, cursor=page['next_cursor'])
+
+    cases = [
+        ('get_student_by_id.cached', lambda: dbhelper.get_student_by_id(some_idno()), n(2000)),
+        ('get_student_by_id.uncached', uncached_student, n(300)),
+        ('check_user_exists', lambda: dbhelper.check_user_exists(some_idno()), n(300)),
+        ('get_all_users_formatted', dbhelper.get_all_users_formatted, n(30)),
+        ('get_attendance_page.first', lambda: dbhelper.get_attendance_page(limit=50), n(300)),
+        ('get_attendance_page.deep', lambda: dbhelper.get_attendance_page(limit=50, cursor=deep_cursor), n(300)),
+        ('get_attendance_page.idno', lambda: dbhelper.get_attendance_page(limit=50, idno=some_idno()), n(300)),
+        ('get_attendance_page.course', lambda: dbhelper.get_attendance_page(limit=50, course='BSIT'), n(300)),
+        ('get_attendance_page.day', lambda: dbhelper.get_attendance_page(limit=50, date_from=last_day,
+                                                                         date_to=last_day), n(300)),
+        ('get_attendance_changes', lambda: dbhelper.get_attendance_changes(token, settle=False), n(300)),
+        ('get_recent_attendance', lambda: dbhelper.get_recent_attendance(20), n(2000)),
+        ('record_scan', scan, n(500)),
+        ('record_scan_batch.50', scan_batch, n(50)),
+        ('insert_attendance_batch.50', replay_batch, n(50)),
+        ('get_attendance_page.all', all_pages, 1 if quick else 3),
+    ]
+    results = {}
+    for name, fn, iterations in cases:
+        with _quiet():
+            results[name] = _time_calls(fn, iterations, warmup=0 if name == 'get_attendance_page.all' else 3)
+        print(f"  {name:32} p50 {results[name]['p50_ms']:9.2f} ms  p95 {results[name]['p95_ms']:9.2f} ms")
+    return results
+
+
+# --- Load scenarios -----------------------------------------------------------
+
+class InProcessClient:
+    """The Flask app in this process, serving threads requests at a time
+    like one gthread worker; the rest wait their turn"""
+
+    def __init__(self, threads):
+        import app
+        app.start_worker()
+        self._app = app.app
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._app.test_client()
+        return self._local.client
+
+    def get(self, path):
+        with self._slots:
+            return self._client().get(path).status_code
+
+    def post(self, path, body):
+        with self._slots:
+            return self._client().post(path, json=body).status_code
+
+
+class HttpClient:
+    """A running server (keep-alive connection per thread)"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self._host, self._port = parts.hostname, parts.port or 80
+        self._local = threading.local()
+
+    def _request(self, method, path, body=None):
+        for attempt in (1, 2):
+            if not hasattr(self._local, 'conn'):
+                self._local.conn = http.client.HTTPConnection(self._host, self._port, timeout=30)
+            try:
+                headers = {'Content-Type': 'application/json'} if body is not None else {}
+                self._local.conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                                         headers=headers)
+                response = self._local.conn.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                self._local.conn.close()
+                del self._local.conn
+                if attempt == 2:
+                    raise
+
+    def get(self, path):
+        return self._request('GET', path)
+
+    def post(self, path, body):
+        return self._request('POST', path, body)
+
+
+class _Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def timed(self, name, call, scheduled=None):
+        # Open-loop requests count from when they were due, so a backlog
+        # shows up as latency instead of silently slowing the arrivals
+        started = scheduled if scheduled is not None else time.perf_counter()
+        try:
+            ok = call() < 400
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def results(self, elapsed):
+        return {name: summarize(values, elapsed, self.errors.get(name, 0))
+                for name, values in self.latencies.items()}
+
+
+def _closed_loop(recorder, threads, duration, requests):
+    """threads callers, each sending requests() back to back for duration seconds"""
+    deadline = time.perf_counter() + duration
+
+    def run():
+        while time.perf_counter() < deadline:
+            name, call = requests()
+            recorder.timed(name, call)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def _open_loop(recorder, arrivals, requests, pool=64):
+    """Send requests() at the given offsets (seconds) no matter how slow answers are"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=pool) as executor:
+        for offset in sorted(arrivals):
+            due = started + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            name, call = requests()
+            executor.submit(recorder.timed, name, call, due)
+    return time.perf_counter() - started
+
+
+def _class_start_arrivals(count, window, rng):
+    """Arrival offsets bunched at the start of window, like a class bell"""
+    return [window * rng.random() ** 3 for _ in range(count)]
+
+
+def load_scenarios(client, threads, quick=False):
+    roster = load_roster()
+    rng = random.Random(BENCH_SEED)
+    duration = 3 if quick else 15
+    results = {}
+
+    def scan_request(feed):
+        def request():
+            scan = feed.next()
+            body = {'student_info': {k: scan[k] for k in ('idno', 'lastname', 'firstname',
+                                                          'course', 'level', 'time_logged')},
+                    'scan_key': scan['scan_key']}
+            return '/scan_qr', lambda: client.post('/scan_qr', body)
+        return request
+
+    def listing_request():
+        roll = rng.random()
+        if roll < 0.6:
+            path = '/api/attendance?limit=50'
+        elif roll < 0.8:
+            path = f"/api/attendance?limit=50&idno={rng.choice(roster)['idno']}"
+        else:
+            path = f"/api/attendance?limit=50&course={rng.choice(COURSES)}"
+        return '/api/attendance', lambda: client.get(path)
+
+    scenarios = [
+        ('scan_steady', lambda r: _closed_loop(r, threads, duration, scan_request(ScanFeed(roster, 0.05)))),
+        ('scan_class_start', lambda r: _open_loop(
+            r, _class_start_arrivals(min(len(roster), 400 if quick else 2000), duration, rng),
+            scan_request(ScanFeed(roster, 0.05)))),
+        ('attendance_listing', lambda r: _closed_loop(r, threads, duration, listing_request)),
+        ('students', lambda r: _closed_loop(
+            r, threads, duration, lambda: ('/api/students', lambda: client.get('/api/students')))),
+        ('latest_attendance', lambda r: _closed_loop(
+            r, threads, duration,
+            lambda: ('/get_latest_attendance', lambda: client.get('/get_latest_attendance?n=20')))),
+    ]
+
+    # Class start with monitors polling and an admin paging alongside
+    def mixed(recorder):
+        feed = ScanFeed(roster, 0.05)
+        stop = time.perf_counter() + duration
+        pollers = [threading.Thread(target=lambda: [
+            recorder.timed('/get_latest_attendance', lambda: client.get('/get_latest_attendance?n=20'))
+            or time.sleep(0.2) for _ in iter(lambda: time.perf_counter() < stop, False)])
+            for _ in range(4)]
+        pager = threading.Thread(target=lambda: [
+            recorder.timed(*listing_request()) or time.sleep(0.5)
+            for _ in iter(lambda: time.perf_counter() < stop, False)])
+        for thread in pollers + [pager]:
+            thread.start()
+        elapsed = _open_loop(recorder, _class_start_arrivals(min(len(roster), 400 if quick else 2000),
+                                                             duration, rng), scan_request(feed))
+        for thread in pollers + [pager]:
+            thread.join()
+        return max(elapsed, duration)
+
+    scenarios.append(('mixed_class_start', mixed))
+
+    for name, scenario in scenarios:
+        recorder = _Recorder()
+        with _quiet():
+            elapsed = scenario(recorder)
+        results[name] = recorder.results(elapsed)
+        for endpoint, stats in results[name].items():
+            print(f"  {name:20} {endpoint:24} {stats['throughput'] or 0:8.1f} req/s  "
+                  f"p50 {stats['p50_ms']:8.2f}  p95 {stats['p95_ms']:8.2f}  p99 {stats['p99_ms']:8.2f} ms"
+                  f"{'  errors ' + str(stats['errors']) if stats['errors'] else ''}")
+    return results
+
+
+# --- Baselines ----------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(results):
+    """{'micro/record_scan': stats, 'load/scan_steady/scan_qr': stats, ...}"""
+    flat = {f"micro/{name}": stats for name, stats in results.get('micro', {}).items()}
+    for scenario, endpoints in results.get('load', {}).items():
+        for endpoint, stats in endpoints.items():
+            flat[f"load/{scenario}{endpoint}"] = stats
+    return flat
+
+
+def compare(old, new, threshold=BENCH_REGRESSION_PCT):
+    """Print p95 and throughput changes; returns the regressed keys"""
+    old_flat, new_flat = _flatten(old), _flatten(new)
+    regressions = []
+    print(f"Comparing {old.get('meta', {}).get('commit')} -> {new.get('meta', {}).get('commit')} "
+          f"(regression threshold {threshold:.0f}%)")
+    for key in sorted(set(old_flat) & set(new_flat)):
+        before, after = old_flat[key], new_flat[key]
+        notes = []
+        if before.get('p95_ms') and after.get('p95_ms') is not None:
+            change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            notes.append(f"p95 {before['p95_ms']:.2f} -> {after['p95_ms']:.2f} ms ({change:+.0f}%)")
+            if change > threshold:
+                regressions.append(key)
+        # Throughput only means something for the load scenarios
+        if key.startswith('load/') and before.get('throughput') and after.get('throughput') is not None:
+            change = (after['throughput'] - before['throughput']) / before['throughput'] * 100
+            notes.append(f"{before['throughput']:.0f} -> {after['throughput']:.0f} req/s ({change:+.0f}%)")
+            if -change > threshold and key not in regressions:
+                regressions.append(key)
+        print(f"  {'✗' if key in regressions else ' '} {key:56} {'  '.join(notes)}")
+    if old.get('peak_rss_mb') and new.get('peak_rss_mb'):
+        print(f"  peak RSS {old['peak_rss_mb']:.0f} -> {new['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def run(suite='all', quick=False, url=None):
+    from gunicorn_config import threads
+
+    results = {'meta': {
+        'commit': _git_commit(),
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'target': url or 'in-process',
+        'threads': threads,
+        'quick': quick,
+        'dataset': dataset_stats(),
+    }}
+    print(f"Dataset: {results['meta']['dataset']}")
+    if suite in ('micro', 'all'):
+        print("dbhelper micro-benchmarks (one thread):")
+        results['micro'] = micro_benchmarks(quick)
+    if suite in ('load', 'all'):
+        print(f"Load scenarios ({results['meta']['target']}, {threads} threads):")
+        with _quiet():
+            client = HttpClient(url) if url else InProcessClient(threads)
+        results['load'] = load_scenarios(client, threads, quick)
+    results['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    print(f"Peak RSS {results['peak_rss_mb']} MB" + (" (this process, not the server)" if url else ""))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scan and listing hot paths")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help="Replace the benchmark database's data with a synthetic school")
+    gen.add_argument('--students', type=int, default=2000)
+    gen.add_argument('--days', type=int, default=180, help="Days of history")
+    gen.add_argument('--scans-per-day', type=int, default=4000)
+    gen.add_argument('--seed', type=int, default=BENCH_SEED)
+
+    bench = commands.add_parser('run', help="Run the benchmarks")
+    bench.add_argument('--suite', choices=('micro', 'load', 'all'), default='all')
+    bench.add_argument('--quick', action='store_true', help="Shorter runs, for a smoke test")
+    bench.add_argument('--url', help="Load-test a running server instead of the app in this process")
+    bench.add_argument('--save', help="Write the results to this JSON file")
+    bench.add_argument('--compare', help="Baseline JSON to compare against (exit 1 on regression)")
+
+    cmp_parser = commands.add_parser('compare', help="Compare two saved results")
+    cmp_parser.add_argument('old')
+    cmp_parser.add_argument('new')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.old) as f_old, open(args.new) as f_new:
+            return 1 if compare(json.load(f_old), json.load(f_new)) else 0
+
+    _use_bench_database()
+    if args.command == 'generate':
+        started = time.perf_counter()
+        with _quiet():
+            counts = generate(args.students, args.days, args.scans_per_day, args.seed)
+        print(f"✓ Generated {counts['scans']} scans for {counts['students']} students over "
+              f"{counts['days']} days in {time.perf_counter() - started:.1f}s")
+        return 0
+
+    results = run(args.suite, args.quick, args.url)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"✓ Saved {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    # Exit without waiting on the app's daemon threads
+    code = main()
+    sys.stdout.flush()
+    os._exit(code)
@@ -0,0 +1,122 @@
+# circuit_breaker.py - Fail fast while the database is unreachable
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Consecutive connection failures before the breaker opens
+DB_BREAKER_THRESHOLD = int(os.environ.get('DB_BREAKER_THRESHOLD', '3'))
+# Seconds to stay open after tripping before the first probe
+DB_BREAKER_COOLDOWN = float(os.environ.get('DB_BREAKER_COOLDOWN', '15'))
+# Seconds between later probes while the database stays down
+DB_BREAKER_PROBE_INTERVAL = float(os.environ.get('DB_BREAKER_PROBE_INTERVAL', '5'))
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker shared by every thread in a worker.
+
+    closed     calls go through; `threshold` failures in a row open it
+    open       calls are refused at once until the cooldown has passed
+    half_open  exactly one caller (the probe) is let through; success
+               closes the breaker, failure reopens it for `probe_interval`
+    """
+
+    def __init__(self, name, threshold=DB_BREAKER_THRESHOLD, cooldown=DB_BREAKER_COOLDOWN,
+                 probe_interval=DB_BREAKER_PROBE_INTERVAL):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._retry_at = 0.0
+        self._probing = False
+        self.opened_at = None
+        self.last_error = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() >= self._retry_at:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """True if the caller may try the database now"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN and time.monotonic() >= self._retry_at:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                log.info("✓ %s circuit closed", self.name)
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+            self.opened_at = None
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failures += 1
+            if error is not None:
+                self.last_error = str(error).strip()
+
+            if self._state == HALF_OPEN:
+                self._state = OPEN
+                self._probing = False
+                self._retry_at = time.monotonic() + self.probe_interval
+            elif self._state == CLOSED and self._failures >= self.threshold:
+                self._state = OPEN
+                self._retry_at = time.monotonic() + self.cooldown
+                self.opened_at = time.time()
+                self.trips += 1
+                log.error("✗ %s circuit opened after %d failures: %s", self.name, self._failures, self.last_error)
+
+    def release(self):
+        """End a probe that neither succeeded nor failed (e.g. pool timeout)"""
+        with self._lock:
+            self._probing = False
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'threshold': self.threshold,
+                'cooldown': self.cooldown,
+                'probe_interval': self.probe_interval,
+                'retry_in': round(max(0.0, self._retry_at - time.monotonic()), 3) if state == OPEN else 0.0,
+                'opened_at': _timestamp_text(self.opened_at),
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'last_error': self.last_error,
+            }
+
+
+def _timestamp_text(timestamp):
+    if timestamp is None:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+db_breaker = CircuitBreaker('Database')
@@ -0,0 +1,227 @@
+# db_pool.py - Per-worker PostgreSQL connection pool
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available within the wait timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections for one gunicorn worker.
+
+    Connections are opened lazily up to ``maxconn``; ``warm()`` pre-opens
+    ``minconn`` of them. On checkout a connection is validated (closed or
+    broken connections are dropped, and long-idle ones are pinged) and
+    connections older than ``max_lifetime`` seconds are recycled.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=4, max_lifetime=1800,
+                 idle_ping=30, timeout=5):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minconn, maxconn))
+
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.idle_ping = idle_ping
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, created_at, last_used)], most recent last
+        self._created = {}     # id(conn) -> created_at for checked-out connections
+        self._size = 0         # open connections, idle + in use
+        self._waiting = 0
+        self._closed = False
+
+        # Stats
+        self._checkouts = 0
+        self._timeouts = 0
+        self._opened = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._saturated = 0    # checkouts that had to wait for a connection
+
+    def getconn(self):
+        """Borrow a connection, waiting up to ``timeout`` seconds"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Pool is closed")
+
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    self._created[id(conn)] = created_at
+                    break
+
+                if self._size < self.maxconn:
+                    # Reserve the slot, then connect outside the lock
+                    self._size += 1
+                    conn = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout("No database connection available after %ss" % self.timeout)
+
+                waited = True
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        if conn is not None:
+            conn = self._validate(conn, created_at, last_used)
+
+        if conn is None:
+            conn = self._open()
+
+        wait = time.monotonic() - started
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            if waited:
+                self._saturated += 1
+
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a borrowed connection; broken ones should be discarded"""
+        with self._cond:
+            created_at = self._created.pop(id(conn), None)
+
+        if created_at is None:
+            # Not one of ours (or already returned)
+            return
+
+        expired = time.monotonic() - created_at > self.max_lifetime
+        if not discard:
+            discard = self._closed or conn.closed or expired
+
+        if not discard:
+            try:
+                # End any transaction the caller left open; a no-op when idle
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard:
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                if expired:
+                    self._recycled += 1
+                else:
+                    self._discarded += 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def warm(self):
+        """Open connections until ``minconn`` are available"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.minconn:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                self._created.pop(id(conn), None)
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+                self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Snapshot of pool usage and wait times"""
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'waiting': self._waiting,
+                'saturation': round(in_use / self.maxconn, 3),
+                'checkouts': self._checkouts,
+                'saturated_checkouts': self._saturated,
+                'timeouts': self._timeouts,
+                'opened': self._opened,
+                'recycled': self._recycled,
+                'discarded': self._discarded,
+                'wait_avg_ms': round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'wait_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+    def _open(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._opened += 1
+        return conn
+
+    def _validate(self, conn, created_at, last_used):
+        """Return the connection if it is still usable, otherwise None"""
+        now = time.monotonic()
+        healthy = not conn.closed
+
+        if healthy and now - created_at > self.max_lifetime:
+            healthy = False
+            with self._cond:
+                self._recycled += 1
+
+        if healthy and now - last_used > self.idle_ping:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                conn.rollback()
+            except Exception:
+                healthy = False
+
+        if healthy:
+            return conn
+
+        # Drop it but keep the slot reserved for a fresh connection
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._discarded += 1
+        self._close(conn)
+        return None
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -1,407 +1,1394 @@
 # dbhelper.py - Complete version
 import os
+import io
+import csv
 import json
-from urllib.parse import urlparse
+import base64
+import logging
+import sys
+import threading
+import time
+import hashlib
+import uuid
+from datetime import datetime, timedelta
+from contextlib import contextmanager
 import psycopg2
-import traceback
+import psycopg2.extensions
+from psycopg2.extras import execute_values
 
-print("=== Loading dbhelper.py ===")
+from db_pool import ConnectionPool, PoolTimeout
+from metrics import metrics
+from query_profiler import query_profiler
+from circuit_breaker import db_breaker
+from recent_attendance import recent_attendance
+from recent_scans import SCAN_DEBOUNCE_SECONDS
+from student_cache import student_cache, MISS
+from attendance_journal import attendance_journal, iter_journal, drain_journal, REPLAY_SUFFIX, REJECTED_SUFFIX
+from student_assets import qr_payload, ensure_qr_code, remove_qr_code
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Pool settings (per gunicorn worker, see gunicorn_config.py)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_IDLE_PING = float(os.environ.get('DB_POOL_IDLE_PING', '30'))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
+# The database could not be reached, as opposed to rejecting a statement
+# (bad data, constraint): only these send a write to the file fallback
+DB_UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Any database error, for callers that do not import psycopg2 themselves
+DatabaseError = psycopg2.Error
+
+# /api/attendance paging
+ATTENDANCE_PAGE_SIZE = 50
+ATTENDANCE_PAGE_MAX = 500
+
+# /api/attendance/changes delta feed
+ATTENDANCE_CHANGES_LIMIT = 500
+ATTENDANCE_CHANGES_KEEP_DAYS = 7
+
+# NOTIFY channel for roster edits (migration 16) and photo updates; every
+# worker's event hub listens on it
+ROSTER_CHANNEL = 'roster_changes'
+# idnos per NOTIFY, well under the 8000-byte payload limit
+PHOTO_NOTIFY_CHUNK = 100
+
+# pg_advisory_xact_lock(class, hashtext(idno)) key class for record_scan
+SCAN_LOCK_CLASS = 715003
+# A scan_key is looked up this close (by time_logged) to the scan that
+# reuses it: retries repeat the original time, and the bound lets
+# PostgreSQL read one or two monthly partitions instead of all of them
+SCAN_KEY_WINDOW_SECONDS = 86400
+
+# attendance_sources ids: where a row in attendance_scans came from
+SOURCE_KIOSK = 2
+SOURCE_KIOSK_BATCH = 3
+SOURCE_JOURNAL = 4
+
+# Journal replay (file fallback -> PostgreSQL)
+LEGACY_ATTENDANCE_FILE = "attendance_data.json"
+JOURNAL_DRAIN_INTERVAL = float(os.environ.get('JOURNAL_DRAIN_INTERVAL', '30'))
+
+log = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _query_caller():
+    """'module.function' that issued the statement, past psycopg2's helpers"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__', '').startswith('psycopg2'):
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor recording statement time, rows and errors per calling function,
+    and feeding the query profiler when QUERY_PROFILE is on"""
+
+    def execute(self, query, vars=None):
+        return self._timed(_query_caller(), query, vars, super().execute, query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(_query_caller(), sql, None, super().copy_expert, sql, file, size)
+
+    def _timed(self, caller, query, vars, run, *args):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return run(*args)
+        except Exception:
+            failed = True
+            metrics.inc('attendance_db_query_errors_total', query=caller)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('attendance_db_query_duration_seconds', elapsed, query=caller)
+            if self.rowcount > 0:
+                metrics.inc('attendance_db_query_rows_total', self.rowcount, query=caller)
+            if query_profiler.enabled and not failed:
+                query_profiler.record(caller, query, vars, elapsed, self.rowcount,
+                                      server_side=self.name is not None)
+
+def open_connection():
+    """Open a new PostgreSQL connection, raising on failure"""
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        raise psycopg2.OperationalError("DATABASE_URL not set")
+
+    # libpq understands postgres:// URLs directly
+    return psycopg2.connect(database_url, connect_timeout=DB_CONNECT_TIMEOUT, cursor_factory=TimedCursor)
 
 def get_db_connection():
-    """Get database connection for Render PostgreSQL"""
+    """Get a standalone database connection for Render PostgreSQL.
+
+    The caller owns the connection and must close it. Request handlers
+    should borrow from the pool with db_connection() instead.
+    """
     try:
-        database_url = os.environ.get('DATABASE_URL')
-        
-        if not database_url:
-            print("WARNING: DATABASE_URL not set.")
+        if not os.environ.get('DATABASE_URL'):
+            log.warning("DATABASE_URL not set")
             return None
         
-        print("Connecting to database...")
-        result = urlparse(database_url)
+        if not db_breaker.allow():
+            log.warning("✗ Database circuit open, not connecting")
+            return None
         
-        conn = psycopg2.connect(
-            database=result.path[1:],
-            user=result.username,
-            password=result.password,
-            host=result.hostname,
-            port=result.port,
-            connect_timeout=10
-        )
+        log.debug("Connecting to database...")
+        conn = open_connection()
+        db_breaker.record_success()
         
-        print("✓ Database connection successful!")
+        log.debug("✓ Database connection successful")
         return conn
         
     except Exception as e:
-        print(f"✗ Database connection failed: {str(e)}")
+        log.error("✗ Database connection failed: %s", e)
+        db_breaker.record_failure(e)
         return None
 
-def get_all_attendance():
-    """Get all attendance records, most recent first - FIXED FOR POSTGRESQL"""
+def get_pool():
+    """Get this process's connection pool, creating it on first use"""
+    global _pool, _pool_pid
+    
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # A pool inherited through fork shares sockets with the parent,
+            # so drop it without closing and start a fresh one
+            _pool = ConnectionPool(
+                open_connection,
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                idle_ping=DB_POOL_IDLE_PING,
+                timeout=DB_POOL_TIMEOUT
+            )
+            _pool_pid = pid
+        return _pool
+
+@contextmanager
+def db_connection(autocommit=False):
+    """Borrow a pooled connection for the duration of a with-block.
+
+    Yields None when the database is unavailable so callers can fall back.
+    The connection goes back to the pool on exit; any uncommitted work is
+    rolled back, and connections that failed are discarded.
+    """
+    if not os.environ.get('DATABASE_URL'):
+        metrics.inc('attendance_db_unavailable_total', reason='not_configured')
+        yield None
+        return
+    
+    # While the database is down, fall back at once instead of waiting
+    # out connect_timeout on every call
+    if not db_breaker.allow():
+        metrics.inc('attendance_db_unavailable_total', reason='circuit_open')
+        yield None
+        return
+    
+    pool = get_pool()
+    started = time.perf_counter()
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("No database connection")
-            # Fallback to file
-            return get_attendance_from_file()
+        conn = pool.getconn()
+    except PoolTimeout as e:
+        log.warning("✗ Database pool exhausted: %s", e)
+        metrics.inc('attendance_db_unavailable_total', reason='pool_exhausted')
+        db_breaker.release()
+        yield None
+        return
+    except Exception as e:
+        log.error("✗ Database connection failed: %s", e)
+        metrics.inc('attendance_db_unavailable_total', reason='connect_failed')
+        db_breaker.record_failure(e)
+        yield None
+        return
+    metrics.observe('attendance_db_connection_acquire_seconds', time.perf_counter() - started)
+    
+    discard = False
+    try:
+        if autocommit:
+            conn.autocommit = True
+        yield conn
+    except DB_UNAVAILABLE_ERRORS as e:
+        discard = True
+        db_breaker.record_failure(e)
+        raise
+    finally:
+        if not discard:
+            db_breaker.record_success()
+        if not discard and not conn.closed:
+            try:
+                if autocommit:
+                    conn.autocommit = False
+            except Exception:
+                discard = True
+        pool.putconn(conn, discard=discard)
+
+def get_pool_stats():
+    """Connection pool usage for this worker"""
+    stats = get_pool().stats()
+    stats['pid'] = os.getpid()
+    return stats
+
+def get_db_health():
+    """Circuit breaker state plus how many scans wait in the journal"""
+    health = db_breaker.stats()
+    health['journal_bytes'] = sum(
+        os.path.getsize(path)
+        for path in (attendance_journal.path, attendance_journal.path + REPLAY_SUFFIX)
+        if os.path.exists(path)
+    )
+    health['pid'] = os.getpid()
+    return health
+
+def encode_attendance_cursor(time_logged, record_id):
+    """Opaque paging cursor for the (time_logged, id) position of a row"""
+    raw = f"{time_logged}|{record_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_attendance_cursor(cursor):
+    """Inverse of encode_attendance_cursor; raises ValueError if malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        time_logged, record_id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        datetime.fromisoformat(time_logged)
+        return time_logged, int(record_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def get_attendance_page(limit=ATTENDANCE_PAGE_SIZE, cursor=None, idno=None, course=None,
+                        date_from=None, date_to=None):
+    """Get one page of attendance, most recent first.
+
+    Uses keyset pagination on (time_logged, id) so every page is an index
+    range scan no matter how deep it is. date_from/date_to are inclusive
+    YYYY-MM-DD dates. Returns {'records': [...], 'next_cursor': str or None};
+    the first page also carries a 'change_token' for get_attendance_changes.
+    """
+    limit = max(1, min(int(limit), ATTENDANCE_PAGE_MAX))
+    after = decode_attendance_cursor(cursor) if cursor else None
+    start = datetime.strptime(date_from, '%Y-%m-%d') if date_from else None
+    end = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1) if date_to else None
+    
+    try:
+        with db_connection() as conn:
+            if not conn:
+                log.warning("No database connection")
+                return _get_attendance_page_from_file(limit, after, idno, course, start, end)
             
-        cursor = conn.cursor()
+            conditions = []
+            params = []
+            if after:
+                # The plain bound is redundant but lets the planner skip
+                # newer monthly partitions; row comparisons do not prune
+                conditions.append("time_logged <= %s::timestamp AND (time_logged, id) < (%s::timestamp, %s)")
+                params.extend([after[0], after[0], after[1]])
+            if idno:
+                conditions.append("idno = %s")
+                params.append(idno)
+            if course:
+                conditions.append("course = %s")
+                params.append(course)
+            if start:
+                conditions.append("time_logged >= %s")
+                params.append(start)
+            if end:
+                conditions.append("time_logged < %s")
+                params.append(end)
+            
+            where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+            
+            db_cursor = conn.cursor()
+            
+            change_token = None
+            if not after:
+                # Read the token first: changes racing the page query (and
+                # any past the horizon) are delivered again by the delta
+                # feed rather than lost
+                change_token = change_horizon.settled(db_cursor)
+            
+            # Fetch one extra row to know whether another page exists
+            db_cursor.execute(f"""
+                SELECT id, idno, lastname, firstname, course, level, time_logged
+                FROM attendance
+                {where}
+                ORDER BY time_logged DESC, id DESC
+                LIMIT %s
+            """, params + [limit + 1])
+            rows = db_cursor.fetchall()
+            db_cursor.close()
         
-        # ✅ POSTGRESQL syntax (not SQLite)
-        cursor.execute("""
-            SELECT idno, lastname, firstname, course, level, time_logged 
-            FROM attendance 
-            ORDER BY time_logged DESC
-        """)
+        records = [{
+            'id': row[0],
+            'idno': row[1],
+            'lastname': row[2],
+            'firstname': row[3],
+            'course': row[4],
+            'level': row[5],
+            'time_logged': str(row[6])
+        } for row in rows[:limit]]
         
-        records = cursor.fetchall()
-        conn.close()
+        next_cursor = None
+        if len(rows) > limit:
+            last = records[-1]
+            next_cursor = encode_attendance_cursor(last['time_logged'], last['id'])
         
-        # Convert to list of dictionaries
-        attendance_list = []
-        for record in records:
-            attendance_list.append({
-                'idno': record[0],
-                'lastname': record[1],
-                'firstname': record[2],
-                'course': record[3],
-                'level': record[4],
-                'time_logged': str(record[5])  # Convert timestamp to string
-            })
-        
-        print(f"Found {len(attendance_list)} attendance records")
-        return attendance_list
+        page = {'records': records, 'next_cursor': next_cursor}
+        if change_token is not None:
+            page['change_token'] = change_token
+        return page
         
     except Exception as e:
-        print(f"Error in get_all_attendance: {e}")
-        traceback.print_exc()
-        return []
+        log.exception("Error in get_attendance_page: %s", e)
+        return {'records': [], 'next_cursor': None}
 
-def get_attendance_from_file():
-    """Fallback: Get attendance from JSON file"""
+class ChangeHorizon:
+    """Highest attendance_changes seq with every lower seq committed or rolled back.
+
+    seq is taken when a change is written but becomes visible at commit,
+    so a slow transaction can still add seq 100 after 101 is visible; a
+    reader that moved past 101 would never see it. Consumers only go up
+    to settled(). A missing seq is waited for, not timed out: its writer
+    had a transaction id before the later seq was taken, so it is below
+    the snapshot xmax at which the gap was seen. Once the snapshot xmin
+    reaches that xmax, the writer has ended and a seq still missing was
+    rolled back. Kept per worker; any worker's value is valid for all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settled = 0
+        self._gap = None    # (last missing seq, txid every writer is below)
+
+    def settled(self, cursor):
+        """Advance and return the horizon"""
+        with self._lock:
+            while True:
+                # One statement, so the rows and xmin/xmax share a snapshot
+                cursor.execute("""
+                    SELECT MIN(seq),
+                           (SELECT c.seq FROM attendance_changes c
+                            WHERE c.seq > %(after)s
+                              AND NOT EXISTS (SELECT 1 FROM attendance_changes n WHERE n.seq = c.seq + 1)
+                            ORDER BY c.seq LIMIT 1),
+                           txid_snapshot_xmin(txid_current_snapshot()),
+                           txid_snapshot_xmax(txid_current_snapshot())
+                    FROM attendance_changes WHERE seq > %(after)s
+                """, {'after': self._settled})
+                first, run_end, xmin, xmax = cursor.fetchone()
+                if first is None:
+                    break
+                if first == self._settled + 1:
+                    self._settled = run_end
+                    continue
+                # seqs settled + 1 .. first - 1 are not visible (yet)
+                if self._gap is None:
+                    self._gap = (first - 1, xmax)
+                if xmin < self._gap[1]:
+                    break
+                self._settled = min(first - 1, self._gap[0])
+                self._gap = None
+            return self._settled
+
+
+change_horizon = ChangeHorizon()
+
+def get_attendance_changes(since, limit=ATTENDANCE_CHANGES_LIMIT, settle=True):
+    """Get attendance inserts/deletes logged after the change token `since`.
+
+    Returns {'changes': [{'seq', 'op', 'record'}], 'token', 'more', 'reset'}.
+    op is 'insert' or 'delete'. Pass 'token' back as the next `since`. 'reset'
+    means the token is older than the retained log and the client should
+    reload from /api/attendance. Only changes up to the ChangeHorizon are
+    returned, so a token never skips a seq that commits late.
+    
+    With settle=False every visible change is returned and 'settled' holds
+    the horizon; the SSE stream sends them all and resumes from the horizon.
+    """
+    limit = max(1, min(int(limit), ATTENDANCE_CHANGES_LIMIT))
+    since = int(since)
+    
     try:
-        attendance_file = "attendance_data.json"
+        with db_connection() as conn:
+            if not conn:
+                return {'changes': [], 'token': since, 'more': False, 'reset': False}
+            
+            cursor = conn.cursor()
+            settled = change_horizon.settled(cursor)
+            # Primary-key range scan
+            cursor.execute("""
+                SELECT seq, op, attendance_id, idno, lastname, firstname, course, level,
+                       time_logged, (SELECT MIN(seq) FROM attendance_changes)
+                FROM attendance_changes
+                WHERE seq > %s AND (NOT %s OR seq <= %s)
+                ORDER BY seq
+                LIMIT %s
+            """, (since, settle, settled, limit + 1))
+            rows = cursor.fetchall()
+            cursor.close()
         
-        if os.path.exists(attendance_file):
-            with open(attendance_file, 'r') as f:
-                attendance = json.load(f)
-            print(f"Loaded {len(attendance)} records from file")
-            return attendance
-        else:
-            print("No attendance file found")
-            return []
+        if rows and since > 0 and rows[0][9] > since + 1:
+            return {'changes': [], 'token': since, 'more': False, 'reset': True}
+        
+        changes = [{
+            'seq': row[0],
+            'op': 'insert' if row[1] == 'I' else 'delete',
+            'record': {
+                'id': row[2],
+                'idno': row[3],
+                'lastname': row[4],
+                'firstname': row[5],
+                'course': row[6],
+                'level': row[7],
+                'time_logged': str(row[8])
+            }
+        } for row in rows[:limit]]
+        
+        delta = {
+            'changes': changes,
+            'token': changes[-1]['seq'] if changes else since,
+            'more': len(rows) > limit,
+            'reset': False
+        }
+        if not settle:
+            delta['settled'] = settled
+        return delta
+        
+    except Exception as e:
+        log.error("Error in get_attendance_changes: %s", e)
+        return {'changes': [], 'token': since, 'more': False, 'reset': False}
+
+def get_change_horizon():
+    """Current change horizon (see ChangeHorizon), or None when the database is down"""
+    try:
+        with db_connection() as conn:
+            if not conn:
+                return None
+            
+            cursor = conn.cursor()
+            settled = change_horizon.settled(cursor)
+            cursor.close()
+            return settled
+        
+    except Exception as e:
+        log.error("Error in get_change_horizon: %s", e)
+        return None
+
+def _get_attendance_page_from_file(limit, after, idno, course, start, end):
+    """File fallback for get_attendance_page; file position stands in for id"""
+    records = []
+    for position, record in enumerate(get_attendance_from_file(), start=1):
+        try:
+            logged = datetime.fromisoformat(str(record.get('time_logged')))
+        except ValueError:
+            continue
+        if idno and record.get('idno') != idno:
+            continue
+        if course and record.get('course') != course:
+            continue
+        if (start and logged < start) or (end and logged >= end):
+            continue
+        if after and (logged, position) >= (datetime.fromisoformat(after[0]), after[1]):
+            continue
+        records.append((logged, position, dict(record, id=position)))
+    
+    records.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    page = [record for _, _, record in records[:limit]]
+    
+    next_cursor = None
+    if len(records) > limit:
+        next_cursor = encode_attendance_cursor(page[-1]['time_logged'], page[-1]['id'])
+    return {'records': page, 'next_cursor': next_cursor}
+
+def get_attendance_from_file():
+    """Fallback: Get attendance from the journal (and any legacy JSON file)"""
+    metrics.inc('attendance_file_fallbacks_total', operation='read')
+    try:
+        attendance = list(iter_attendance_from_file())
+        log.debug("Loaded %d records from file", len(attendance))
+        return attendance
             
     except Exception as e:
-        print(f"Error reading attendance file: {e}")
+        log.error("Error reading attendance file: %s", e)
         return []
 
+def iter_attendance_from_file():
+    """Stream file-fallback records, oldest first, without loading them all"""
+    yield from _iter_legacy_attendance()
+    yield from iter_journal(attendance_journal.path + REPLAY_SUFFIX)
+    yield from iter_journal(attendance_journal.path)
+
+def _iter_legacy_attendance():
+    """Records from the old attendance_data.json, keyed so replays are idempotent"""
+    if not os.path.exists(LEGACY_ATTENDANCE_FILE):
+        return
+    with open(LEGACY_ATTENDANCE_FILE, 'r') as f:
+        attendance = json.load(f)
+    for position, record in enumerate(attendance):
+        digest = hashlib.sha1(f"{position}|{json.dumps(record, sort_keys=True)}".encode()).hexdigest()
+        yield dict(record, scan_key=f"legacy-{digest}")
+
 def check_user_exists(idno):
     """Check if a user with given IDNO already exists"""
-    print(f"Checking if user exists: {idno}")
+    log.debug("Checking if user exists: %s", idno)
     
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return False
+        with db_connection() as conn:
+            if conn is None:
+                return False
             
-        cursor = conn.cursor()
-        cursor.execute("SELECT idno FROM users WHERE idno = %s", (idno,))
-        result = cursor.fetchone()
+            cursor = conn.cursor()
+            cursor.execute("SELECT idno FROM users WHERE idno = %s", (idno,))
+            result = cursor.fetchone()
         
-        cursor.close()
-        conn.close()
+            cursor.close()
         
         exists = result is not None
-        print(f"User {idno} exists: {exists}")
+        log.debug("User %s exists: %s", idno, exists)
         return exists
         
     except Exception as e:
-        print(f"Error checking user existence: {e}")
+        log.error("Error checking user existence: %s", e)
         return False
 
 def insert_user(idno, lastname, firstname, course, level):
     """Insert new user into database"""
-    print(f"Inserting user: {idno}, {lastname}, {firstname}, {course}, {level}")
+    log.debug("Inserting user: %s, %s, %s, %s, %s", idno, lastname, firstname, course, level)
     
     try:
-        conn = get_db_connection()
-        if conn is None:
-            print("No database connection")
-            return False
+        with db_connection() as conn:
+            if conn is None:
+                log.warning("No database connection")
+                return False
             
-        cursor = conn.cursor()
-        sql = "INSERT INTO users (idno, lastname, firstname, course, level) VALUES (%s, %s, %s, %s, %s)"
-        cursor.execute(sql, (idno, lastname, firstname, course, level))
-        conn.commit()
+            cursor = conn.cursor()
+            sql = "INSERT INTO users (idno, lastname, firstname, course, level) VALUES (%s, %s, %s, %s, %s)"
+            cursor.execute(sql, (idno, lastname, firstname, course, level))
+            conn.commit()
         
-        print(f"✓ User {idno} inserted successfully")
+            log.info("✓ User %s inserted", idno)
         
-        cursor.close()
-        conn.close()
+            cursor.close()
+        
+        # Write-through so a cached "not found" does not outlive the insert
+        student_cache.put({'idno': idno, 'lastname': lastname, 'firstname': firstname,
+                           'course': course, 'level': level})
         return True
         
     except Exception as e:
-        print(f"✗ Error inserting user: {e}")
+        log.error("✗ Error inserting user: %s", e)
         return False
 
 def validate_user(username, password):
     """Validate admin user"""
-    print(f"Validating user: {username}")
+    log.debug("Validating user: %s", username)
     
     try:
-        conn = get_db_connection()
-        if conn is None:
-            # Fallback for testing
-            if username == "admin" and password == "admin123":
-                return [{"username": "admin"}]
-            return []
+        with db_connection() as conn:
+            if conn is None:
+                # Fallback for testing
+                if username == "admin" and password == "admin123":
+                    return [{"username": "admin"}]
+                return []
             
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM admin_users WHERE username = %s AND password = %s", 
-                      (username, password))
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM admin_users WHERE username = %s AND password = %s", 
+                          (username, password))
         
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
-        rows = cursor.fetchall()
-        result = [dict(zip(columns, row)) for row in rows]
+            columns = [desc[0] for desc in cursor.description] if cursor.description else []
+            rows = cursor.fetchall()
+            result = [dict(zip(columns, row)) for row in rows]
         
-        cursor.close()
-        conn.close()
+            cursor.close()
         
-        print(f"Validation result: {len(result)} records found")
+        log.debug("Validation result: %d records found", len(result))
         return result
         
     except Exception as e:
-        print(f"Error in validate_user: {e}")
+        log.error("Error in validate_user: %s", e)
         return []
 
 def get_all_users_formatted():
     """Get all users for display"""
-    print("Getting all users...")
+    log.debug("Getting all users...")
     
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return []
+        with db_connection() as conn:
+            if conn is None:
+                return []
             
-        cursor = conn.cursor()
-        cursor.execute("SELECT idno, lastname, firstname, course, level FROM users ORDER BY lastname")
-        users = cursor.fetchall()
-        
-        result = []
-        for user in users:
-            result.append({
-                'idno': user[0],
-                'lastname': user[1],
-                'firstname': user[2],
-                'course': user[3],
-                'level': user[4]
-            })
+            cursor = conn.cursor()
+            cursor.execute("SELECT idno, lastname, firstname, course, level FROM users ORDER BY lastname")
+            users = cursor.fetchall()
         
-        cursor.close()
-        conn.close()
+            result = []
+            for user in users:
+                result.append({
+                    'idno': user[0],
+                    'lastname': user[1],
+                    'firstname': user[2],
+                    'course': user[3],
+                    'level': user[4]
+                })
+        
+            cursor.close()
         
-        print(f"Found {len(result)} users")
+        # The full roster is in hand anyway; prime the lookup cache with it
+        student_cache.warm(result)
+        log.debug("Found %d users", len(result))
         return result
         
     except Exception as e:
-        print(f"Error getting users: {e}")
+        log.error("Error getting users: %s", e)
         return []
 
-def initialize_database():
-    """Initialize database tables"""
-    print("=== Initializing database ===")
-    
+def prune_attendance_changes(keep_days=ATTENDANCE_CHANGES_KEEP_DAYS):
+    """Drop change-log rows older than keep_days; older tokens get a reset"""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            print("No database connection for initialization")
-            return
+        with db_connection() as conn:
+            if not conn:
+                return None
             
-        cursor = conn.cursor()
-        
-        # Create tables
-        tables = [
-            """CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                idno VARCHAR(50) NOT NULL UNIQUE,
-                lastname VARCHAR(100) NOT NULL,
-                firstname VARCHAR(100) NOT NULL,
-                course VARCHAR(50) NOT NULL,
-                level VARCHAR(10) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )""",
-            """CREATE TABLE IF NOT EXISTS attendance (
-                id SERIAL PRIMARY KEY,
-                idno VARCHAR(50) NOT NULL,
-                lastname VARCHAR(100) NOT NULL,
-                firstname VARCHAR(100) NOT NULL,
-                course VARCHAR(50) NOT NULL,
-                level VARCHAR(10) NOT NULL,
-                time_logged TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )""",
-            """CREATE TABLE IF NOT EXISTS admin_users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) NOT NULL UNIQUE,
-                password VARCHAR(100) NOT NULL
-            )"""
-        ]
-        
-        for table_sql in tables:
-            cursor.execute(table_sql)
-        
-        # Add default admin
-        cursor.execute("""
-            INSERT INTO admin_users (username, password) 
-            VALUES ('admin', 'admin123')
-            ON CONFLICT (username) DO NOTHING
-        """)
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM attendance_changes
+                WHERE changed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+            """, (keep_days,))
+            deleted = cursor.rowcount
+            conn.commit()
+            cursor.close()
         
-        print("✓ Database initialized successfully!")
+        if deleted:
+            log.info("✓ Pruned %d attendance changes", deleted)
+        return deleted
         
     except Exception as e:
-        print(f"Error initializing database: {e}")
+        log.error("Error pruning attendance changes: %s", e)
+        return None
 
 def get_student_by_id(student_id):
-    """Get student by ID"""
+    """Get student by ID, served from the roster cache when possible"""
+    cached = student_cache.get(student_id)
+    if cached is not MISS:
+        return cached._asdict() if cached is not None else None
+    
     try:
-        conn = get_db_connection()
-        if not conn:
-            return None
+        with db_connection() as conn:
+            if not conn:
+                return None
             
-        cursor = conn.cursor()
-        cursor.execute("SELECT idno, lastname, firstname, course, level FROM users WHERE idno = %s", (student_id,))
-        result = cursor.fetchone()
+            cursor = conn.cursor()
+            cursor.execute("SELECT idno, lastname, firstname, course, level FROM users WHERE idno = %s", (student_id,))
+            result = cursor.fetchone()
         
-        cursor.close()
-        conn.close()
+            cursor.close()
         
         if result:
-            return {
+            student = {
                 'idno': result[0],
                 'lastname': result[1],
                 'firstname': result[2],
                 'course': result[3],
                 'level': result[4]
             }
+            student_cache.put(student)
+            return student
+        student_cache.put_missing(student_id)
         return None
         
     except Exception as e:
-        print(f"Error getting student: {e}")
+        log.error("Error getting student: %s", e)
         return None
 
-def insert_attendance(idno, lastname, firstname, course, level, time_logged):
-    """Insert attendance record into database"""
-    print(f"Inserting attendance: {idno} at {time_logged}")
+def record_scan(idno, lastname, firstname, course, level, time_logged, scan_key=None,
+                debounce=SCAN_DEBOUNCE_SECONDS):
+    """Log a scan in one round trip and return the stored record.
+
+    Roster data from users is preferred; the QR payload fills in for
+    students that are not in the database. A scan whose scan_key is
+    already stored, or within debounce seconds of another scan of the
+    same idno, is not inserted: the original record is returned with
+    'duplicate': True. Falls back to file storage (returning the payload
+    as the record) when the database is unavailable; a scan the database
+    rejects is not journaled and returns None.
+    """
+    log.debug("Recording scan: %s at %s", idno, time_logged)
+    
+    scan_key = scan_key or uuid.uuid4().hex
+    payload = {
+        'idno': idno,
+        'lastname': lastname,
+        'firstname': firstname,
+        'course': course,
+        'level': level,
+        'time_logged': time_logged
+    }
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            print("No database connection for attendance")
-            # Fallback to file storage
-            return insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged)
+        # Autocommit so the INSERT is its own transaction: no BEGIN/COMMIT trips
+        with db_connection(autocommit=True) as conn:
+            if not conn:
+                log.warning("No database connection for attendance")
+                if insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged,
+                                             scan_key=scan_key):
+                    return payload
+                return None
             
-        cursor = conn.cursor()
-        
-        sql = """
-        INSERT INTO attendance (idno, lastname, firstname, course, level, time_logged) 
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """
+            cursor = conn.cursor()
+            # Both statements go in one round trip and run as one implicit
+            # transaction: the per-idno lock makes concurrent scans of one
+            # student (from any worker) see each other before inserting
+            cursor.execute("""
+                SELECT pg_advisory_xact_lock(%(lock_class)s, hashtext(%(idno)s));
+                WITH q (idno, lastname, firstname, course, level, time_logged, scan_key) AS (
+                    VALUES (%(idno)s, %(lastname)s, %(firstname)s, %(course)s, %(level)s,
+                            %(time_logged)s::timestamp, %(scan_key)s)
+                ),
+                original AS (
+                    (SELECT a.id, a.idno, a.lastname, a.firstname, a.course, a.level, a.time_logged
+                     FROM attendance a, q
+                     WHERE a.scan_key = q.scan_key
+                       AND a.time_logged > q.time_logged - %(key_window)s * INTERVAL '1 second'
+                       AND a.time_logged < q.time_logged + %(key_window)s * INTERVAL '1 second')
+                    UNION ALL
+                    (SELECT a.id, a.idno, a.lastname, a.firstname, a.course, a.level, a.time_logged
+                     FROM attendance a, q
+                     WHERE a.idno = q.idno
+                       AND a.time_logged > q.time_logged - %(debounce)s * INTERVAL '1 second'
+                       AND a.time_logged < q.time_logged + %(debounce)s * INTERVAL '1 second'
+                     ORDER BY a.time_logged DESC, a.id DESC
+                     LIMIT 1)
+                    LIMIT 1
+                ),
+                resolved AS (
+                    SELECT q.idno,
+                           COALESCE(u.lastname, q.lastname) AS lastname,
+                           COALESCE(u.firstname, q.firstname) AS firstname,
+                           COALESCE(u.course, q.course) AS course,
+                           COALESCE(u.level, q.level) AS level,
+                           q.time_logged,
+                           q.scan_key,
+                           CASE WHEN u.idno IS NULL THEN 1 ELSE 0 END AS flags
+                    FROM q
+                    LEFT JOIN users u ON u.idno = q.idno
+                    WHERE NOT EXISTS (SELECT 1 FROM original)
+                ),
+                inserted AS (
+                    INSERT INTO attendance_scans (student_id, scanned_at, source_id, flags, scan_key)
+                    SELECT attendance_student_id(r.idno, r.lastname, r.firstname, r.course, r.level),
+                           r.time_logged, %(source)s, r.flags, r.scan_key
+                    FROM resolved r
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, scan_key
+                )
+                SELECT i.id, r.idno, r.lastname, r.firstname, r.course, r.level, r.time_logged, FALSE
+                FROM inserted i JOIN resolved r ON r.scan_key = i.scan_key
+                UNION ALL
+                SELECT *, TRUE FROM original
+            """, {'idno': idno, 'lastname': lastname, 'firstname': firstname, 'course': course,
+                  'level': level, 'time_logged': time_logged, 'scan_key': scan_key,
+                  'debounce': debounce, 'lock_class': SCAN_LOCK_CLASS, 'source': SOURCE_KIOSK,
+                  'key_window': SCAN_KEY_WINDOW_SECONDS})
+            row = cursor.fetchone()
+            if row is None:
+                # Same key inserted concurrently by another worker
+                cursor.execute("""
+                    SELECT id, idno, lastname, firstname, course, level, time_logged, TRUE
+                    FROM attendance WHERE scan_key = %s AND time_logged = %s::timestamp
+                """, (scan_key, time_logged))
+                row = cursor.fetchone()
+            cursor.close()
         
-        cursor.execute(sql, (idno, lastname, firstname, course, level, time_logged))
-        conn.commit()
-        
-        print(f"✓ Attendance recorded for {idno}")
+        record = {
+            'id': row[0],
+            'idno': row[1],
+            'lastname': row[2],
+            'firstname': row[3],
+            'course': row[4],
+            'level': row[5],
+            'time_logged': str(row[6])
+        }
+        if row[7]:
+            log.info("Duplicate scan for %s, original at %s", idno, record['time_logged'])
+            record['duplicate'] = True
+            return record
         
-        cursor.close()
-        conn.close()
-        return True
+        log.info("✓ Attendance recorded for %s", idno)
+        recent_attendance.add(record)
+        return record
         
-    except Exception as e:
-        print(f"✗ Error inserting attendance: {e}")
+    except DB_UNAVAILABLE_ERRORS as e:
+        log.error("✗ Error recording scan: %s", e)
         # Try file storage as fallback
-        return insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged)
+        if insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged,
+                                     scan_key=scan_key):
+            return payload
+        return None
+    except Exception as e:
+        # Replaying it from the journal would fail the same way
+        log.error("✗ Scan rejected for %s: %s", idno, e)
+        return None
 
-def insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged):
-    """Fallback: Save attendance to JSON file"""
-    try:
-        attendance_file = "attendance_data.json"
+def record_scan_batch(scans, debounce=SCAN_DEBOUNCE_SECONDS):
+    """Log many kiosk scans in one transaction; returns {scan_key: (record, duplicate)}.
+
+    scans are dicts with idno, lastname, firstname, course, level,
+    time_logged and scan_key, already free of duplicates among
+    themselves. Each is checked against the table like record_scan: a
+    stored scan_key or a scan of the idno within debounce seconds is
+    returned instead of inserting. Raises when the database is unavailable.
+    """
+    if not scans:
+        return {}
+    
+    with db_connection() as conn:
+        if not conn:
+            raise psycopg2.OperationalError("No database connection")
         
-        # Load existing attendance
-        if os.path.exists(attendance_file):
-            with open(attendance_file, 'r') as f:
-                attendance = json.load(f)
-        else:
-            attendance = []
+        cursor = conn.cursor()
+        # Same per-idno locks as record_scan, in a fixed order so two
+        # batches cannot deadlock; the next statement then sees any
+        # scan another worker committed for these students
+        cursor.execute("""
+            SELECT pg_advisory_xact_lock(%s, hashtext(idno))
+            FROM (SELECT DISTINCT unnest(%s::text[]) AS idno ORDER BY 1) ids
+        """, (SCAN_LOCK_CLASS, sorted({scan['idno'] for scan in scans})))
         
-        # Add new record
-        attendance.append({
+        rows = execute_values(cursor, """
+            WITH q (idno, lastname, firstname, course, level, time_logged, scan_key, debounce, key_window, source) AS (
+                SELECT v.idno, v.lastname, v.firstname, v.course, v.level, v.time_logged::timestamp,
+                       v.scan_key, v.debounce::float8, v.key_window::float8, v.source::smallint
+                FROM (VALUES %s) AS v (idno, lastname, firstname, course, level, time_logged, scan_key,
+                                       debounce, key_window, source)
+            ),
+            original AS (
+                SELECT q.scan_key, o.*
+                FROM q
+                CROSS JOIN LATERAL (
+                    (SELECT a.id, a.idno, a.lastname, a.firstname, a.course, a.level, a.time_logged
+                     FROM attendance a
+                     WHERE a.scan_key = q.scan_key
+                       AND a.time_logged > q.time_logged - q.key_window * INTERVAL '1 second'
+                       AND a.time_logged < q.time_logged + q.key_window * INTERVAL '1 second')
+                    UNION ALL
+                    (SELECT a.id, a.idno, a.lastname, a.firstname, a.course, a.level, a.time_logged
+                     FROM attendance a
+                     WHERE a.idno = q.idno
+                       AND a.time_logged > q.time_logged - q.debounce * INTERVAL '1 second'
+                       AND a.time_logged < q.time_logged + q.debounce * INTERVAL '1 second'
+                     ORDER BY a.time_logged DESC, a.id DESC
+                     LIMIT 1)
+                    LIMIT 1
+                ) o
+            ),
+            resolved AS (
+                SELECT q.idno,
+                       COALESCE(u.lastname, q.lastname) AS lastname,
+                       COALESCE(u.firstname, q.firstname) AS firstname,
+                       COALESCE(u.course, q.course) AS course,
+                       COALESCE(u.level, q.level) AS level,
+                       q.time_logged,
+                       q.scan_key,
+                       q.source,
+                       CASE WHEN u.idno IS NULL THEN 1 ELSE 0 END AS flags
+                FROM q
+                LEFT JOIN users u ON u.idno = q.idno
+                WHERE NOT EXISTS (SELECT 1 FROM original o WHERE o.scan_key = q.scan_key)
+            ),
+            inserted AS (
+                INSERT INTO attendance_scans (student_id, scanned_at, source_id, flags, scan_key)
+                SELECT attendance_student_id(r.idno, r.lastname, r.firstname, r.course, r.level),
+                       r.time_logged, r.source, r.flags, r.scan_key
+                FROM resolved r
+                ON CONFLICT DO NOTHING
+                RETURNING id, scan_key
+            )
+            SELECT r.scan_key, i.id, r.idno, r.lastname, r.firstname, r.course, r.level, r.time_logged, FALSE
+            FROM inserted i JOIN resolved r ON r.scan_key = i.scan_key
+            UNION ALL
+            SELECT *, TRUE FROM original
+        """, [(
+            scan['idno'],
+            scan.get('lastname') or '',
+            scan.get('firstname') or '',
+            scan.get('course') or '',
+            scan.get('level') or '',
+            scan['time_logged'],
+            scan['scan_key'],
+            debounce,
+            SCAN_KEY_WINDOW_SECONDS,
+            SOURCE_KIOSK_BATCH
+        ) for scan in scans], page_size=len(scans), fetch=True)
+        conn.commit()
+        cursor.close()
+    
+    results = {}
+    for row in rows:
+        record = {
+            'id': row[1],
+            'idno': row[2],
+            'lastname': row[3],
+            'firstname': row[4],
+            'course': row[5],
+            'level': row[6],
+            'time_logged': str(row[7])
+        }
+        results[row[0]] = (record, row[8])
+        if not row[8]:
+            recent_attendance.add(record)
+    return results
+
+def insert_attendance_to_file(idno, lastname, firstname, course, level, time_logged, scan_key=None):
+    """Fallback: Append attendance to the journal for a later replay"""
+    metrics.inc('attendance_file_fallbacks_total', operation='write')
+    try:
+        record = {
+            'scan_key': scan_key or uuid.uuid4().hex,
             'idno': idno,
             'lastname': lastname,
             'firstname': firstname,
             'course': course,
             'level': level,
             'time_logged': time_logged
-        })
+        }
+        attendance_journal.append([record])
         
-        # Save back to file
-        with open(attendance_file, 'w') as f:
-            json.dump(attendance, f, indent=2)
-        
-        print(f"✓ Attendance saved to file for {idno}")
+        recent_attendance.add(record)
+        log.warning("✓ Attendance saved to file for %s", idno)
         return True
         
     except Exception as e:
-        print(f"✗ File save also failed: {e}")
+        log.error("✗ File save also failed: %s", e)
         return False
 
-def delete_user(idno):
-    """Delete user from database"""
+def insert_attendance_batch_to_file(entries):
+    """Fallback for a batch: journal all entries with one fsync"""
+    metrics.inc('attendance_file_fallbacks_total', operation='write')
     try:
-        conn = get_db_connection()
+        records = [{
+            'scan_key': entry.get('scan_key') or uuid.uuid4().hex,
+            'idno': entry['idno'],
+            'lastname': entry.get('lastname') or '',
+            'firstname': entry.get('firstname') or '',
+            'course': entry.get('course') or '',
+            'level': entry.get('level') or '',
+            'time_logged': entry['time_logged']
+        } for entry in entries]
+        attendance_journal.append(records)
+        
+        for record in records:
+            recent_attendance.add(record)
+        log.warning("✓ %d scans saved to file", len(records))
+        return True
+        
+    except Exception as e:
+        log.error("✗ File save also failed: %s", e)
+        return False
+
+def insert_attendance_batch(entries, source=SOURCE_KIOSK, debounce=SCAN_DEBOUNCE_SECONDS):
+    """Insert many scans in one statement and return the stored records.
+
+    entries are dicts with idno, lastname, firstname, course, level,
+    time_logged and a scan_key. Roster data is preferred like record_scan.
+    Keys already in the table are skipped, which makes journal replays
+    safe to repeat. Like record_scan_batch, a scan within debounce seconds
+    of a stored or earlier queued scan of the same idno is skipped too;
+    replays pass debounce=0, since those scans were already accepted.
+    source is an attendance_sources id. Raises when the database is
+    unavailable.
+    """
+    with db_connection() as conn:
         if not conn:
-            return False
-            
+            raise psycopg2.OperationalError("No database connection")
+        
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM users WHERE idno = %s", (idno,))
+        # Same per-idno locks as record_scan_batch, so the debounce check
+        # sees scans other workers are committing for these students
+        cursor.execute("""
+            SELECT pg_advisory_xact_lock(%s, hashtext(idno))
+            FROM (SELECT DISTINCT unnest(%s::text[]) AS idno ORDER BY 1) ids
+        """, (SCAN_LOCK_CLASS, sorted({entry.get('idno') or '' for entry in entries})))
+        
+        rows = execute_values(cursor, """
+            WITH q (idno, lastname, firstname, course, level, time_logged, scan_key, source, debounce) AS (
+                SELECT v.idno, v.lastname, v.firstname, v.course, v.level, v.time_logged::timestamp,
+                       v.scan_key, v.source::smallint, v.debounce::float8
+                FROM (VALUES %s) AS v (idno, lastname, firstname, course, level, time_logged, scan_key,
+                                       source, debounce)
+            ),
+            resolved AS (
+                SELECT DISTINCT ON (q.scan_key) q.idno,
+                       COALESCE(u.lastname, q.lastname) AS lastname,
+                       COALESCE(u.firstname, q.firstname) AS firstname,
+                       COALESCE(u.course, q.course) AS course,
+                       COALESCE(u.level, q.level) AS level,
+                       q.time_logged,
+                       q.scan_key,
+                       q.source,
+                       CASE WHEN u.idno IS NULL THEN 1 ELSE 0 END AS flags
+                FROM q
+                LEFT JOIN users u ON u.idno = q.idno
+                -- Also skips keys still only in attendance_legacy; a replayed
+                -- scan keeps its time, which prunes the lookup to one partition
+                WHERE NOT EXISTS (SELECT 1 FROM attendance a
+                                  WHERE a.scan_key = q.scan_key AND a.time_logged = q.time_logged)
+                  AND NOT EXISTS (SELECT 1 FROM attendance a
+                                  WHERE a.idno = q.idno
+                                    AND a.time_logged > q.time_logged - q.debounce * INTERVAL '1 second'
+                                    AND a.time_logged < q.time_logged + q.debounce * INTERVAL '1 second')
+                  AND NOT EXISTS (SELECT 1 FROM q p
+                                  WHERE p.idno = q.idno AND (p.time_logged, p.scan_key) < (q.time_logged, q.scan_key)
+                                    AND p.time_logged > q.time_logged - q.debounce * INTERVAL '1 second')
+            ),
+            inserted AS (
+                INSERT INTO attendance_scans (student_id, scanned_at, source_id, flags, scan_key)
+                SELECT attendance_student_id(r.idno, r.lastname, r.firstname, r.course, r.level),
+                       r.time_logged, r.source, r.flags, r.scan_key
+                FROM resolved r
+                ON CONFLICT DO NOTHING
+                RETURNING id, scan_key
+            )
+            SELECT i.id, r.idno, r.lastname, r.firstname, r.course, r.level, r.time_logged
+            FROM inserted i JOIN resolved r ON r.scan_key = i.scan_key
+        """, [(
+            entry.get('idno'),
+            entry.get('lastname') or '',
+            entry.get('firstname') or '',
+            entry.get('course') or '',
+            entry.get('level') or '',
+            entry.get('time_logged'),
+            entry.get('scan_key'),
+            source,
+            debounce
+        ) for entry in entries], page_size=len(entries) or 1, fetch=True)
         conn.commit()
+        cursor.close()
+    
+    records = [{
+        'id': row[0],
+        'idno': row[1],
+        'lastname': row[2],
+        'firstname': row[3],
+        'course': row[4],
+        'level': row[5],
+        'time_logged': str(row[6])
+    } for row in rows]
+    for record in records:
+        recent_attendance.add(record)
+    return records
+
+def replay_attendance_journal():
+    """Bulk-load journaled scans into PostgreSQL once it is reachable again.
+
+    Covers the journal, spool files left by dead batch-writer workers and
+    the legacy attendance_data.json. Only one process drains at a time.
+    Returns the number of entries replayed, or None if skipped.
+    """
+    journal_dir = os.path.dirname(os.path.abspath(attendance_journal.path))
+    spools = [name for name in os.listdir(journal_dir)
+              if name.startswith('attendance_spool.') and not name.endswith(REJECTED_SUFFIX)]
+    if not (spools or os.path.exists(LEGACY_ATTENDANCE_FILE)
+            or os.path.exists(attendance_journal.path + REPLAY_SUFFIX)
+            or (os.path.exists(attendance_journal.path) and os.path.getsize(attendance_journal.path))):
+        return 0
+    
+    with db_connection() as conn:
+        if not conn:
+            return None
+    
+    with open(attendance_journal.path + '.lock', 'a') as lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another worker is already draining
+                return None
+        
+        def replay_batch(batch):
+            return insert_attendance_batch(batch, source=SOURCE_JOURNAL, debounce=0)
+        
+        replayed = 0
+        
+        if os.path.exists(LEGACY_ATTENDANCE_FILE):
+            batch = []
+            for record in _iter_legacy_attendance():
+                batch.append(record)
+                if len(batch) >= 500:
+                    replay_batch(batch)
+                    replayed += len(batch)
+                    batch = []
+            if batch:
+                replay_batch(batch)
+                replayed += len(batch)
+            os.replace(LEGACY_ATTENDANCE_FILE, LEGACY_ATTENDANCE_FILE + '.imported')
         
-        success = cursor.rowcount > 0
+        replayed += drain_journal(attendance_journal.path, replay_batch, unavailable=DB_UNAVAILABLE_ERRORS)
+        
+        for name in spools:
+            # attendance_spool.<pid>.jsonl; a live worker still owns its spool
+            try:
+                pid = int(name.split('.')[1])
+            except (ValueError, IndexError):
+                continue
+            if _pid_alive(pid):
+                continue
+            path = os.path.join(journal_dir, name)
+            if name.endswith(REPLAY_SUFFIX):
+                path = path[:-len(REPLAY_SUFFIX)]
+            replayed += drain_journal(path, replay_batch, unavailable=DB_UNAVAILABLE_ERRORS)
+    
+    if replayed:
+        log.info("✓ Replayed %d journaled attendance records", replayed)
+    return replayed
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def start_journal_drainer(interval=JOURNAL_DRAIN_INTERVAL):
+    """Background thread that replays the journal whenever the DB is up"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                replay_attendance_journal()
+            except Exception as e:
+                log.error("✗ Journal replay failed: %s", e)
+    
+    thread = threading.Thread(target=run, name='journal-drainer', daemon=True)
+    thread.start()
+    return thread
+
+def delete_attendance_record(idno, time_logged):
+    """Delete the attendance rows for a student at a time; returns the count"""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM attendance 
+            WHERE idno = %s AND time_logged = %s
+            RETURNING id
+        """, (idno, time_logged))
+        deleted_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
         cursor.close()
-        conn.close()
+    
+    for record_id in deleted_ids:
+        recent_attendance.remove(record_id=record_id)
+    return len(deleted_ids)
+
+def get_recent_attendance(n=1):
+    """Newest n attendance records from the in-memory buffer.
+
+    The buffer is seeded with one LIMIT query and then kept current by
+    inserts/deletes, so this does not touch the attendance table.
+    """
+    if recent_attendance.needs_reseed(n):
+        seed_recent_attendance()
+    return recent_attendance.latest(n)
+
+def seed_recent_attendance():
+    """Load the newest RECENT_ATTENDANCE_SIZE records into the buffer"""
+    try:
+        with db_connection() as conn:
+            if not conn:
+                records = get_attendance_from_file()
+                records = [dict(record) for record in records[-recent_attendance.size:]]
+            else:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, idno, lastname, firstname, course, level, time_logged
+                    FROM attendance
+                    ORDER BY time_logged DESC, id DESC
+                    LIMIT %s
+                """, (recent_attendance.size,))
+                records = [{
+                    'id': row[0],
+                    'idno': row[1],
+                    'lastname': row[2],
+                    'firstname': row[3],
+                    'course': row[4],
+                    'level': row[5],
+                    'time_logged': str(row[6])
+                } for row in cursor.fetchall()]
+                cursor.close()
+        
+        recent_attendance.seed(records)
+        log.info("Seeded %d recent attendance records", len(records))
         
-        print(f"Delete user {idno}: {'success' if success else 'not found'}")
+    except Exception as e:
+        log.error("Error seeding recent attendance: %s", e)
+
+def delete_user(idno):
+    """Delete user from database"""
+    try:
+        with db_connection() as conn:
+            if not conn:
+                return False
+            
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM users WHERE idno = %s", (idno,))
+            conn.commit()
+        
+            success = cursor.rowcount > 0
+            cursor.close()
+        
+        student_cache.invalidate(idno)
+        log.info("Delete user %s: %s", idno, 'success' if success else 'not found')
         return success
         
     except Exception as e:
-        print(f"Error deleting user: {e}")
+        log.error("Error deleting user: %s", e)
         return False
 
 def update_user(idno, lastname, firstname, course, level):
     """Update user information"""
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with db_connection() as conn:
+            if not conn:
+                return False
             
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE users 
-            SET lastname = %s, firstname = %s, course = %s, level = %s 
-            WHERE idno = %s
-        """, (lastname, firstname, course, level, idno))
-        conn.commit()
+            cursor = conn.cursor()
+            # Return the previous values too, to tell if the QR payload changed
+            cursor.execute("""
+                UPDATE users u
+                SET lastname = %s, firstname = %s, course = %s, level = %s 
+                FROM (SELECT idno, lastname, firstname, course, level
+                      FROM users WHERE idno = %s FOR UPDATE) old
+                WHERE u.idno = old.idno
+                RETURNING old.idno, old.lastname, old.firstname, old.course, old.level
+            """, (lastname, firstname, course, level, idno))
+            old = cursor.fetchone()
+            conn.commit()
         
-        success = cursor.rowcount > 0
-        cursor.close()
-        conn.close()
+            success = old is not None
+            cursor.close()
         
-        print(f"Update user {idno}: {'success' if success else 'not found'}")
+        if success:
+            student = {'idno': idno, 'lastname': lastname, 'firstname': firstname,
+                       'course': course, 'level': level}
+            student_cache.put(student)
+            refresh_qr_code(dict(zip(('idno', 'lastname', 'firstname', 'course', 'level'), old)), student)
+        else:
+            student_cache.invalidate(idno)
+        log.info("Update user %s: %s", idno, 'success' if success else 'not found')
         return success
         
     except Exception as e:
-        print(f"Error updating user: {e}")
+        log.error("Error updating user: %s", e)
         return False
+
+def upsert_users_bulk(students):
+    """Load many roster rows with COPY and upsert them in one transaction.
+
+    students are validated dicts with idno, lastname, firstname, course
+    and level (idno unique). Rows go to a temporary staging table via COPY,
+    then one INSERT ... ON CONFLICT moves them into users; unchanged rows
+    are left alone. Returns {'inserted': n, 'updated': n, 'unchanged': n}.
+    Raises when the database is unavailable; nothing is written on error.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for student in students:
+        writer.writerow([student['idno'], student['lastname'], student['firstname'],
+                         student['course'], student['level']])
+    buffer.seek(0)
+    
+    with db_connection() as conn:
+        if not conn:
+            raise psycopg2.OperationalError("No database connection")
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMPORARY TABLE users_import (
+                idno VARCHAR(50) NOT NULL,
+                lastname VARCHAR(100) NOT NULL,
+                firstname VARCHAR(100) NOT NULL,
+                course VARCHAR(50) NOT NULL,
+                level VARCHAR(10) NOT NULL
+            ) ON COMMIT DROP
+        """)
+        cursor.copy_expert(
+            "COPY users_import (idno, lastname, firstname, course, level) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+        cursor.execute("""
+            INSERT INTO users (idno, lastname, firstname, course, level)
+            SELECT idno, lastname, firstname, course, level FROM users_import
+            ON CONFLICT (idno) DO UPDATE
+            SET lastname = EXCLUDED.lastname,
+                firstname = EXCLUDED.firstname,
+                course = EXCLUDED.course,
+                level = EXCLUDED.level
+            WHERE (users.lastname, users.firstname, users.course, users.level)
+                  IS DISTINCT FROM (EXCLUDED.lastname, EXCLUDED.firstname, EXCLUDED.course, EXCLUDED.level)
+            RETURNING (xmax = 0) AS inserted
+        """)
+        results = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    
+    inserted = sum(1 for row in results if row[0])
+    counts = {
+        'inserted': inserted,
+        'updated': len(results) - inserted,
+        'unchanged': len(students) - len(results)
+    }
+    
+    # No warm here: the roster_changes NOTIFY clears every worker's cache
+    # (this one included), and they refill on lookup
+    log.info("✓ Bulk upserted %d users: %s", len(students), counts)
+    return counts
+
+def notify_photo_changes(idnos):
+    """Ask every worker's photo index to re-check these idnos (best effort)"""
+    idnos = list(idnos)
+    if not idnos:
+        return
+    
+    try:
+        with db_connection() as conn:
+            if not conn:
+                log.warning("No database connection for photo notifications")
+                return
+            
+            cursor = conn.cursor()
+            for start in range(0, len(idnos), PHOTO_NOTIFY_CHUNK):
+                cursor.execute("SELECT pg_notify(%s, %s)", (
+                    ROSTER_CHANNEL, json.dumps({'photos': idnos[start:start + PHOTO_NOTIFY_CHUNK]})))
+            conn.commit()
+            cursor.close()
+        
+    except Exception as e:
+        log.error("Error notifying photo changes: %s", e)
+
+def refresh_qr_code(old, new):
+    """Re-render a student's QR image only if its payload changed"""
+    old_payload, new_payload = qr_payload(old), qr_payload(new)
+    if old_payload == new_payload:
+        return
+    try:
+        ensure_qr_code(new_payload)
+        remove_qr_code(old_payload)
+    except Exception as e:
+        # /qr/<idno>.png renders it on first request instead
+        log.warning("QR code refresh error for %s: %s", new['idno'], e)
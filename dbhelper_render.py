@@ -171,65 +171,14 @@ def insert_attendance(idno, lastname, firstname, course, level, time_logged):
     conn.close()
 
 def initialize_database():
-    """Initialize database tables (PostgreSQL only)"""
+    """Initialize database tables (PostgreSQL only); see migrations.py"""
     if not USE_POSTGRESQL:
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            idno VARCHAR(50) NOT NULL UNIQUE,
-            lastname VARCHAR(100) NOT NULL,
-            firstname VARCHAR(100) NOT NULL,
-            course VARCHAR(50) NOT NULL,
-            level VARCHAR(10) NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        
-        # Create attendance table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS attendance (
-            id SERIAL PRIMARY KEY,
-            idno VARCHAR(50) NOT NULL,
-            lastname VARCHAR(100) NOT NULL,
-            firstname VARCHAR(100) NOT NULL,
-            course VARCHAR(50) NOT NULL,
-            level VARCHAR(10) NOT NULL,
-            time_logged TIMESTAMP NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        
-        # Create admin users table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admin_users (
-            id SERIAL PRIMARY KEY,
-            username VARCHAR(50) NOT NULL UNIQUE,
-            password VARCHAR(100) NOT NULL
-        )
-        """)
-        
-        # Insert default admin if not exists
-        cursor.execute("""
-        INSERT INTO admin_users (username, password) 
-        VALUES ('admin', 'admin123')
-        ON CONFLICT (username) DO NOTHING
-        """)
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        from migrations import migrate
+        migrate()
         print("Database tables initialized successfully!")
         
     except Exception as e:
         print(f"Error initializing database: {e}")
-
-# Initialize database on import (for PostgreSQL)
-if USE_POSTGRESQL:
-    initialize_database()
@@ -1,4 +1,51 @@
+import logging
+
 bind = "0.0.0.0:10000"
 workers = 4
 threads = 4
 timeout = 120
+
+# Import the app once in the master: workers fork with it loaded, so
+# boots and restarts skip the imports. Importing app.py opens nothing;
+# connections and threads are set up per worker in post_fork
+preload_app = True
+
+# Each worker keeps its own database pool (DB_POOL_MIN / DB_POOL_MAX env vars);
+# DB_POOL_MAX should not exceed threads
+
+# Live monitor streams (/api/attendance/stream) each hold a thread;
+# SSE_MAX_SUBSCRIBERS caps them per worker so scans always have threads left
+
+# Each worker has its own database circuit breaker (DB_BREAKER_THRESHOLD,
+# DB_BREAKER_COOLDOWN, DB_BREAKER_PROBE_INTERVAL); see /health
+
+# Workers write metrics snapshots to METRICS_DIR (local to this machine);
+# /metrics in any worker sums them. LOG_LEVEL and LOG_SAMPLE_RATE set
+# the app's logging
+
+
+def on_starting(server):
+    # Migrate once, in the master, before any worker boots; workers then
+    # only check schema_version
+    from app_logging import setup_logging
+    from metrics import reset_metrics_dir
+    from migrations import migrate
+    setup_logging()
+    # Snapshots left by a previous run's workers
+    reset_metrics_dir()
+    try:
+        migrate()
+    except Exception as e:
+        logging.getLogger('gunicorn_config').error("✗ Migration failed: %s", e)
+
+
+def post_fork(server, worker):
+    # Schema check, caches, listener and refresher threads for this worker
+    from app import start_worker
+    start_worker()
+
+
+def worker_exit(server, worker):
+    # Write out scans still queued by the write-behind writer
+    from attendance_writer import shutdown_writer
+    shutdown_writer()
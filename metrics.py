@@ -0,0 +1,350 @@
+# metrics.py - Request, query and cache metrics, summed over gunicorn workers
+#
+# Each worker counts into its own registry and writes a snapshot to
+# METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL seconds. /metrics,
+# served by whichever worker gets the scrape, refreshes its own snapshot
+# and adds up all of them, so other workers' numbers are at most one
+# interval old. Counters and histograms of workers that have exited are
+# folded into exited.json, so totals never go backwards on a restart;
+# their gauges are dropped.
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'attendance_metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '10'))
+EXITED_SNAPSHOT = 'exited.json'
+
+# Seconds; scans and pages take a few milliseconds, exports and reports more
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help). Gauges are summed over workers unless listed in
+# MAX_GAUGES (values every worker reads from the same place)
+METRICS = {
+    'attendance_http_requests_total': (
+        'counter', "HTTP requests by route, method and status"),
+    'attendance_http_request_duration_seconds': (
+        'histogram', "HTTP request latency by route and method (to the first byte for streams)"),
+    'attendance_db_query_duration_seconds': (
+        'histogram', "PostgreSQL statement time by calling function"),
+    'attendance_db_query_rows_total': (
+        'counter', "Rows returned or changed by calling function"),
+    'attendance_db_query_errors_total': (
+        'counter', "Failed PostgreSQL statements by calling function"),
+    'attendance_db_connection_acquire_seconds': (
+        'histogram', "Time to borrow a pooled connection"),
+    'attendance_db_unavailable_total': (
+        'counter', "Database calls that fell back because no connection was available, by reason"),
+    'attendance_db_pool_connections': (
+        'gauge', "Open pooled connections by state"),
+    'attendance_db_pool_waiting': (
+        'gauge', "Threads waiting for a pooled connection"),
+    'attendance_db_circuit_open': (
+        'gauge', "Workers whose database circuit breaker is not closed"),
+    'attendance_file_fallbacks_total': (
+        'counter', "Attendance reads and writes served from the journal files instead of PostgreSQL"),
+    'attendance_journal_bytes': (
+        'gauge', "Scans waiting in the journal for replay"),
+    'attendance_write_queue_depth': (
+        'gauge', "Scans queued by the write-behind writer"),
+    'attendance_student_cache_lookups_total': (
+        'counter', "Student cache lookups by result"),
+    'attendance_student_cache_hit_ratio': (
+        'gauge', "Share of student cache lookups answered from memory (hits and known misses)"),
+    'attendance_scans_total': (
+        'counter', "Kiosk scans by result: accepted, duplicate scan_key or debounced rescan"),
+    'attendance_log_records_dropped_total': (
+        'counter', "Log records not written, by reason"),
+    'attendance_workers': (
+        'gauge', "Workers reporting metrics"),
+}
+MAX_GAUGES = {'attendance_journal_bytes'}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Counters and latency histograms for one worker.
+
+    inc() and observe() take one short lock; gauges come from collectors,
+    functions called at snapshot time that return [(name, labels, value)].
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}      # (name, labels) -> value
+        self._histograms = {}    # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collect):
+        if collect not in self._collectors:
+            self._collectors.append(collect)
+
+    def reset(self):
+        """Forget counts inherited through fork"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """This worker's metrics as a JSON-able dict"""
+        counters = {}
+        gauges = []
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    if METRICS[name][0] == 'counter':
+                        counters[_key(name, labels)] = value
+                    else:
+                        gauges.append([name, sorted(labels.items()), value])
+            except Exception as e:
+                log.error("✗ Metrics collector %s failed: %s", getattr(collect, '__name__', collect), e)
+        with self._lock:
+            counters.update(self._counters)
+            histograms = [[name, list(labels), list(values)]
+                          for (name, labels), values in self._histograms.items()]
+        return {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': histograms,
+            'gauges': gauges,
+        }
+
+
+metrics = Registry()
+
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def _write_json(path, data):
+    partial = f"{path}.{os.getpid()}.partial"
+    with open(partial, 'w') as f:
+        json.dump(data, f)
+    os.replace(partial, path)
+
+
+def write_snapshot():
+    """Publish this worker's metrics for /metrics in the other workers"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(_snapshot_path(os.getpid()), metrics.snapshot())
+
+
+def start_metrics_writer(interval=METRICS_FLUSH_INTERVAL):
+    """Background thread writing this worker's snapshot (once per process)"""
+    global _writer_pid
+
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return None
+        # Counts made in the gunicorn master before fork are not this worker's
+        metrics.reset()
+        _writer_pid = os.getpid()
+
+    def run():
+        while True:
+            try:
+                write_snapshot()
+            except Exception as e:
+                log.error("✗ Writing metrics snapshot failed: %s", e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='metrics-writer', daemon=True)
+    thread.start()
+    return thread
+
+
+def reset_metrics_dir():
+    """Remove every snapshot; gunicorn's master calls this before booting workers"""
+    if not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json') or name.endswith('.partial'):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _dir_lock():
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _empty():
+    return {'counters': [], 'histograms': [], 'gauges': []}
+
+
+def _add(total, snapshot, gauges=True):
+    """Add one snapshot into total: {'counters': {key: v}, 'histograms': {key: [..]}, 'gauges': {key: v}}"""
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, tuple(map(tuple, labels)))
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for name, labels, values in snapshot.get('histograms', []):
+        key = (name, tuple(map(tuple, labels)))
+        current = total['histograms'].get(key)
+        total['histograms'][key] = values if current is None else [a + b for a, b in zip(current, values)]
+    if gauges:
+        for name, labels, value in snapshot.get('gauges', []):
+            key = (name, tuple(map(tuple, labels)))
+            if name in MAX_GAUGES:
+                total['gauges'][key] = max(total['gauges'].get(key, value), value)
+            else:
+                total['gauges'][key] = total['gauges'].get(key, 0) + value
+
+
+def _as_snapshot(total):
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in total['counters'].items()],
+        'histograms': [[name, list(labels), values] for (name, labels), values in total['histograms'].items()],
+        'gauges': [],
+    }
+
+
+def collect_all():
+    """Every worker's metrics added up (see the module comment)"""
+    write_snapshot()
+    total = {'counters': {}, 'histograms': {}, 'gauges': {}}
+    workers = 0
+    with _dir_lock():
+        exited_path = os.path.join(METRICS_DIR, EXITED_SNAPSHOT)
+        exited = _load(exited_path) or _empty()
+        folded = []
+        for name in os.listdir(METRICS_DIR):
+            stem, ext = os.path.splitext(name)
+            if ext != '.json' or not stem.isdigit():
+                continue
+            snapshot = _load(os.path.join(METRICS_DIR, name))
+            if snapshot is None:
+                continue
+            if _pid_alive(int(stem)):
+                _add(total, snapshot)
+                workers += 1
+            else:
+                folded.append((name, snapshot))
+
+        if folded:
+            merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+            _add(merged, exited, gauges=False)
+            for _, snapshot in folded:
+                _add(merged, snapshot, gauges=False)
+            exited = _as_snapshot(merged)
+            _write_json(exited_path, exited)
+            for name, _ in folded:
+                os.remove(os.path.join(METRICS_DIR, name))
+    _add(total, exited, gauges=False)
+
+    total['gauges'][('attendance_workers', ())] = workers
+    lookups = {dict(labels).get('result'): value for (name, labels), value in total['counters'].items()
+               if name == 'attendance_student_cache_lookups_total'}
+    if sum(lookups.values()):
+        answered = lookups.get('hit', 0) + lookups.get('negative_hit', 0)
+        total['gauges'][('attendance_student_cache_hit_ratio', ())] = answered / sum(lookups.values())
+    return total
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(total):
+    """Prometheus text exposition format (version 0.0.4)"""
+    series = {}
+    for kind in ('counters', 'histograms', 'gauges'):
+        for (name, labels), value in total[kind].items():
+            series.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        if name not in series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(series[name]):
+            if kind != 'histogram':
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
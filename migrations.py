@@ -0,0 +1,850 @@
+# migrations.py - Versioned schema migrations
+#
+#   python migrations.py            apply pending migrations
+#   python migrations.py --status   show applied / pending versions
+#
+# Migrations run once, in order, recorded in schema_version with a checksum
+# of their SQL. Never edit an applied migration; append a new one instead.
+# The gunicorn master migrates before forking (on_starting); workers only
+# compare versions at boot.
+import argparse
+import hashlib
+import logging
+import sys
+import time
+from collections import namedtuple
+
+import psycopg2
+
+from dbhelper import open_connection, db_connection
+from app_logging import setup_logging
+
+log = logging.getLogger(__name__)
+
+# pg_advisory_lock key: one migrating process at a time
+MIGRATION_LOCK_ID = 715002
+
+# transactional=False for statements that cannot run in a transaction
+# block (CREATE INDEX CONCURRENTLY); index names the index they build
+Migration = namedtuple('Migration', 'version name sql transactional index', defaults=(True, None))
+
+
+class MigrationError(Exception):
+    """Raised when applied migrations no longer match this code"""
+
+
+def index_concurrently(version, name, index, definition, unique=False):
+    """A migration that builds an index without blocking writes"""
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {index} ON {definition}"
+    return Migration(version, name, sql, transactional=False, index=index)
+
+
+MIGRATIONS = [
+    # IF NOT EXISTS throughout: databases created before migrations
+    # existed already have most of this
+    Migration(1, 'baseline', """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            idno VARCHAR(50) NOT NULL UNIQUE,
+            lastname VARCHAR(100) NOT NULL,
+            firstname VARCHAR(100) NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS attendance (
+            id SERIAL PRIMARY KEY,
+            idno VARCHAR(50) NOT NULL,
+            lastname VARCHAR(100) NOT NULL,
+            firstname VARCHAR(100) NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            time_logged TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS admin_users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) NOT NULL UNIQUE,
+            password VARCHAR(100) NOT NULL
+        );
+
+        INSERT INTO admin_users (username, password)
+        VALUES ('admin', 'admin123')
+        ON CONFLICT (username) DO NOTHING;
+    """),
+
+    # Journal replays and batch writes dedupe on scan_key
+    Migration(2, 'attendance_scan_key', """
+        ALTER TABLE attendance ADD COLUMN IF NOT EXISTS scan_key VARCHAR(64);
+    """),
+
+    # Inserts/deletes on attendance, in commit order, for the delta feed;
+    # announced on the attendance_changes channel for live monitors
+    Migration(3, 'attendance_changes', """
+        CREATE TABLE IF NOT EXISTS attendance_changes (
+            seq BIGSERIAL PRIMARY KEY,
+            op CHAR(1) NOT NULL,
+            attendance_id INTEGER NOT NULL,
+            idno VARCHAR(50) NOT NULL,
+            lastname VARCHAR(100) NOT NULL,
+            firstname VARCHAR(100) NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            time_logged TIMESTAMP NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE OR REPLACE FUNCTION log_attendance_change() RETURNS trigger AS $$
+        DECLARE
+            rec attendance;
+            op_code CHAR(1);
+            change_seq BIGINT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                rec := NEW;
+                op_code := 'I';
+            ELSE
+                rec := OLD;
+                op_code := 'D';
+            END IF;
+
+            INSERT INTO attendance_changes
+                (op, attendance_id, idno, lastname, firstname, course, level, time_logged)
+            VALUES (op_code, rec.id, rec.idno, rec.lastname, rec.firstname,
+                    rec.course, rec.level, rec.time_logged)
+            RETURNING seq INTO change_seq;
+
+            PERFORM pg_notify('attendance_changes', json_build_object(
+                'seq', change_seq,
+                'op', CASE op_code WHEN 'I' THEN 'insert' ELSE 'delete' END,
+                'record', json_build_object(
+                    'id', rec.id,
+                    'idno', rec.idno,
+                    'lastname', rec.lastname,
+                    'firstname', rec.firstname,
+                    'course', rec.course,
+                    'level', rec.level,
+                    'time_logged', rec.time_logged::text
+                )
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS attendance_change_log ON attendance;
+        CREATE TRIGGER attendance_change_log
+        AFTER INSERT OR DELETE ON attendance
+        FOR EACH ROW EXECUTE FUNCTION log_attendance_change();
+    """),
+
+    # Report rollups, maintained from attendance_changes by
+    # attendance_reports.refresh_rollups; NULL last_seq rebuilds them
+    Migration(4, 'attendance_rollups', """
+        CREATE TABLE IF NOT EXISTS attendance_rollup_hourly (
+            day DATE NOT NULL,
+            hour SMALLINT NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            scans INTEGER NOT NULL,
+            PRIMARY KEY (day, hour, course, level)
+        );
+
+        CREATE TABLE IF NOT EXISTS attendance_rollup_student_day (
+            day DATE NOT NULL,
+            idno VARCHAR(50) NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            first_in TIMESTAMP,
+            last_out TIMESTAMP,
+            scans INTEGER NOT NULL,
+            PRIMARY KEY (day, idno)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_rollup_student_day_idno ON attendance_rollup_student_day (idno, day);
+
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name VARCHAR(50) PRIMARY KEY,
+            last_seq BIGINT,
+            refreshed_at TIMESTAMP
+        );
+
+        INSERT INTO rollup_state (name) VALUES ('attendance')
+        ON CONFLICT (name) DO NOTHING;
+    """),
+
+    # attendance is the big table: build its indexes without locking out scans
+    index_concurrently(5, 'attendance_time_index', 'idx_attendance_time_id',
+                       "attendance (time_logged DESC, id DESC)"),
+    index_concurrently(6, 'attendance_idno_index', 'idx_attendance_idno_time',
+                       "attendance (idno, time_logged DESC, id DESC)"),
+    index_concurrently(7, 'attendance_course_index', 'idx_attendance_course_time',
+                       "attendance (course, time_logged DESC, id DESC)"),
+    index_concurrently(8, 'attendance_scan_key_index', 'idx_attendance_scan_key',
+                       "attendance (scan_key)", unique=True),
+
+    # Scans become a narrow fact table (attendance_scans) keyed to a small
+    # dimension of roster attributes as they were at scan time
+    # (attendance_students); attendance is now a view with the old shape.
+    # The old table stays readable as attendance_legacy until
+    # attendance_backfill.py has copied it over in chunks: the view shows
+    # its rows above the copied_through watermark. Inserts and deletes on
+    # the view are routed to the fact table by INSTEAD OF triggers.
+    Migration(9, 'attendance_fact_table', """
+        ALTER TABLE attendance RENAME TO attendance_legacy;
+        DROP TRIGGER IF EXISTS attendance_change_log ON attendance_legacy;
+        DROP FUNCTION IF EXISTS log_attendance_change();
+
+        CREATE TABLE attendance_students (
+            student_id SERIAL PRIMARY KEY,
+            idno VARCHAR(50) NOT NULL,
+            lastname VARCHAR(100) NOT NULL,
+            firstname VARCHAR(100) NOT NULL,
+            course VARCHAR(50) NOT NULL,
+            level VARCHAR(10) NOT NULL,
+            UNIQUE (idno, lastname, firstname, course, level)
+        );
+
+        CREATE TABLE attendance_sources (
+            source_id SMALLINT PRIMARY KEY,
+            name VARCHAR(50) NOT NULL UNIQUE
+        );
+        INSERT INTO attendance_sources (source_id, name) VALUES
+            (1, 'legacy'), (2, 'kiosk'), (3, 'kiosk_batch'), (4, 'journal'), (5, 'admin');
+
+        -- flags: 1 = idno not in users at scan time, 2 = copied from attendance_legacy.
+        -- No foreign keys: every scan pays for them and nothing deletes
+        -- students or sources
+        CREATE TABLE attendance_scans (
+            id INTEGER PRIMARY KEY DEFAULT nextval('attendance_id_seq'),
+            student_id INTEGER NOT NULL,
+            scanned_at TIMESTAMP NOT NULL,
+            source_id SMALLINT NOT NULL,
+            flags SMALLINT NOT NULL DEFAULT 0,
+            scan_key VARCHAR(64) UNIQUE
+        );
+        ALTER SEQUENCE attendance_id_seq OWNED BY attendance_scans.id;
+        CREATE INDEX idx_attendance_scans_time ON attendance_scans (scanned_at DESC, id DESC);
+        CREATE INDEX idx_attendance_scans_student_time ON attendance_scans (student_id, scanned_at DESC, id DESC);
+        CREATE INDEX idx_attendance_students_course ON attendance_students (course);
+
+        CREATE TABLE attendance_backfill (
+            copied_through INTEGER NOT NULL,
+            rows_copied BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO attendance_backfill (copied_through) VALUES (0);
+
+        -- student_id for a roster snapshot, adding it on first use
+        CREATE FUNCTION attendance_student_id(p_idno VARCHAR, p_lastname VARCHAR, p_firstname VARCHAR,
+                                              p_course VARCHAR, p_level VARCHAR) RETURNS INTEGER AS $$
+        DECLARE
+            found_id INTEGER;
+        BEGIN
+            SELECT student_id INTO found_id FROM attendance_students
+            WHERE idno = p_idno AND lastname = p_lastname AND firstname = p_firstname
+              AND course = p_course AND level = p_level;
+            IF found_id IS NULL THEN
+                INSERT INTO attendance_students (idno, lastname, firstname, course, level)
+                VALUES (p_idno, p_lastname, p_firstname, p_course, p_level)
+                ON CONFLICT DO NOTHING
+                RETURNING student_id INTO found_id;
+            END IF;
+            IF found_id IS NULL THEN
+                -- Added concurrently by another scan
+                SELECT student_id INTO found_id FROM attendance_students
+                WHERE idno = p_idno AND lastname = p_lastname AND firstname = p_firstname
+                  AND course = p_course AND level = p_level;
+            END IF;
+            RETURN found_id;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION log_attendance_row(op_code CHAR(1), record_id INTEGER, r_idno VARCHAR,
+                                           r_lastname VARCHAR, r_firstname VARCHAR, r_course VARCHAR,
+                                           r_level VARCHAR, r_time_logged TIMESTAMP) RETURNS VOID AS $$
+        DECLARE
+            change_seq BIGINT;
+        BEGIN
+            INSERT INTO attendance_changes
+                (op, attendance_id, idno, lastname, firstname, course, level, time_logged)
+            VALUES (op_code, record_id, r_idno, r_lastname, r_firstname, r_course, r_level, r_time_logged)
+            RETURNING seq INTO change_seq;
+
+            PERFORM pg_notify('attendance_changes', json_build_object(
+                'seq', change_seq,
+                'op', CASE op_code WHEN 'I' THEN 'insert' ELSE 'delete' END,
+                'record', json_build_object(
+                    'id', record_id,
+                    'idno', r_idno,
+                    'lastname', r_lastname,
+                    'firstname', r_firstname,
+                    'course', r_course,
+                    'level', r_level,
+                    'time_logged', r_time_logged::text
+                )
+            )::text);
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION log_attendance_scan() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+            op_code CHAR(1);
+            s attendance_students%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                -- Backfilled rows were logged when they went into attendance_legacy
+                IF NEW.flags & 2 <> 0 THEN
+                    RETURN NULL;
+                END IF;
+                rec := NEW;
+                op_code := 'I';
+            ELSE
+                rec := OLD;
+                op_code := 'D';
+            END IF;
+
+            SELECT * INTO s FROM attendance_students WHERE student_id = rec.student_id;
+            PERFORM log_attendance_row(op_code, rec.id, s.idno, s.lastname, s.firstname,
+                                       s.course, s.level, rec.scanned_at);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER attendance_scans_change_log
+        AFTER INSERT OR DELETE ON attendance_scans
+        FOR EACH ROW EXECUTE FUNCTION log_attendance_scan();
+
+        CREATE VIEW attendance AS
+        SELECT f.id, s.idno, s.lastname, s.firstname, s.course, s.level,
+               f.scanned_at AS time_logged, f.scan_key, f.source_id, f.flags
+        FROM attendance_scans f
+        JOIN attendance_students s ON s.student_id = f.student_id
+        UNION ALL
+        SELECT l.id, l.idno, l.lastname, l.firstname, l.course, l.level,
+               l.time_logged, l.scan_key, 1::smallint, 2::smallint
+        FROM attendance_legacy l
+        WHERE l.id > (SELECT copied_through FROM attendance_backfill);
+
+        CREATE FUNCTION attendance_view_insert() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO attendance_scans (student_id, scanned_at, source_id, flags, scan_key)
+            VALUES (attendance_student_id(NEW.idno, NEW.lastname, NEW.firstname, NEW.course, NEW.level),
+                    NEW.time_logged,
+                    COALESCE(NEW.source_id, 5),
+                    COALESCE(NEW.flags, CASE WHEN EXISTS (SELECT 1 FROM users WHERE idno = NEW.idno)
+                                             THEN 0 ELSE 1 END),
+                    NEW.scan_key)
+            RETURNING id, source_id, flags INTO NEW.id, NEW.source_id, NEW.flags;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION attendance_view_delete() RETURNS trigger AS $$
+        BEGIN
+            -- Waits out a running backfill chunk, so the row is either
+            -- already in attendance_scans or will never be copied there
+            PERFORM pg_advisory_xact_lock_shared(715004);
+            DELETE FROM attendance_scans WHERE id = OLD.id;
+            IF NOT FOUND THEN
+                DELETE FROM attendance_legacy WHERE id = OLD.id;
+                IF NOT FOUND THEN
+                    RETURN NULL;
+                END IF;
+                PERFORM log_attendance_row('D', OLD.id, OLD.idno, OLD.lastname, OLD.firstname,
+                                           OLD.course, OLD.level, OLD.time_logged);
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER attendance_view_insert
+        INSTEAD OF INSERT ON attendance
+        FOR EACH ROW EXECUTE FUNCTION attendance_view_insert();
+        CREATE TRIGGER attendance_view_delete
+        INSTEAD OF DELETE ON attendance
+        FOR EACH ROW EXECUTE FUNCTION attendance_view_delete();
+
+        -- Copy the next chunk_size legacy rows (by id) and advance the
+        -- watermark in the caller's transaction; returns the rows read
+        CREATE FUNCTION attendance_backfill_chunk(chunk_size INTEGER) RETURNS INTEGER AS $$
+        DECLARE
+            after_id INTEGER;
+            last_id INTEGER;
+            moved INTEGER;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(715004);
+            SELECT copied_through INTO after_id FROM attendance_backfill;
+            SELECT MAX(id), COUNT(*) INTO last_id, moved
+            FROM (SELECT id FROM attendance_legacy WHERE id > after_id ORDER BY id LIMIT chunk_size) c;
+            IF moved = 0 THEN
+                RETURN 0;
+            END IF;
+
+            INSERT INTO attendance_students (idno, lastname, firstname, course, level)
+            SELECT DISTINCT idno, lastname, firstname, course, level
+            FROM attendance_legacy WHERE id > after_id AND id <= last_id
+            ON CONFLICT DO NOTHING;
+
+            -- A scan_key already in attendance_scans (a journal replay of an
+            -- old scan) keeps that row
+            INSERT INTO attendance_scans (id, student_id, scanned_at, source_id, flags, scan_key)
+            SELECT l.id, s.student_id, l.time_logged, 1, 2, l.scan_key
+            FROM attendance_legacy l
+            JOIN attendance_students s
+              ON s.idno = l.idno AND s.lastname = l.lastname AND s.firstname = l.firstname
+             AND s.course = l.course AND s.level = l.level
+            WHERE l.id > after_id AND l.id <= last_id
+            ON CONFLICT DO NOTHING;
+
+            UPDATE attendance_backfill
+            SET copied_through = last_id, rows_copied = rows_copied + moved,
+                updated_at = CURRENT_TIMESTAMP;
+            RETURN moved;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+
+    # Drops attendance_legacy once everything is copied. Small tables are
+    # copied here; big ones need `python attendance_backfill.py` first so
+    # the copy happens in short transactions
+    Migration(10, 'attendance_backfill_finish', """
+        -- Locks the view and its tables up front: the view is replaced
+        -- below, and a delete already inside it must not be left waiting
+        -- on the backfill lock
+        LOCK TABLE attendance IN ACCESS EXCLUSIVE MODE;
+
+        DO $$
+        BEGIN
+            IF (SELECT COUNT(*) FROM (
+                    SELECT 1 FROM attendance_legacy
+                    WHERE id > (SELECT copied_through FROM attendance_backfill)
+                    LIMIT 50001) pending) > 50000 THEN
+                RAISE EXCEPTION 'attendance_legacy is not copied yet: run python attendance_backfill.py';
+            END IF;
+            WHILE attendance_backfill_chunk(5000) > 0 LOOP
+            END LOOP;
+        END;
+        $$;
+
+        CREATE OR REPLACE VIEW attendance AS
+        SELECT f.id, s.idno, s.lastname, s.firstname, s.course, s.level,
+               f.scanned_at AS time_logged, f.scan_key, f.source_id, f.flags
+        FROM attendance_scans f
+        JOIN attendance_students s ON s.student_id = f.student_id;
+
+        CREATE OR REPLACE FUNCTION attendance_view_delete() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM attendance_scans WHERE id = OLD.id;
+            IF NOT FOUND THEN
+                RETURN NULL;
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP FUNCTION attendance_backfill_chunk(INTEGER);
+        DROP TABLE attendance_backfill;
+        DROP TABLE attendance_legacy;
+    """),
+
+    # Unique keys of a partitioned attendance_scans must include scanned_at;
+    # built ahead so migration 15 can attach the current table as is
+    index_concurrently(11, 'attendance_scans_partition_keys', 'idx_attendance_scans_id_time',
+                       "attendance_scans (id, scanned_at)", unique=True),
+    index_concurrently(12, 'attendance_scans_partition_scan_keys', 'idx_attendance_scans_key_time',
+                       "attendance_scans (scan_key, scanned_at)", unique=True),
+
+    # A CHECK matching the history partition's bound (migration 15) lets
+    # ATTACH PARTITION skip scanning the table while it holds the exclusive
+    # lock. It is added NOT VALID, which takes that lock only for a moment,
+    # and validated on its own, which scans with reads and writes going on.
+    # The bound is next month, or the month after the newest scan if kiosk
+    # clocks already stored later ones; scans past it fail until 15 runs
+    Migration(13, 'attendance_scans_history_bound', """
+        LOCK TABLE attendance_scans IN ACCESS EXCLUSIVE MODE;
+
+        DO $$
+        BEGIN
+            EXECUTE format('ALTER TABLE attendance_scans ADD CONSTRAINT attendance_scans_history_bound '
+                           'CHECK (scanned_at < %L) NOT VALID',
+                           GREATEST(date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month',
+                                    (SELECT date_trunc('month', MAX(scanned_at)) + INTERVAL '1 month'
+                                     FROM attendance_scans)));
+        END;
+        $$;
+    """),
+    Migration(14, 'attendance_scans_history_bound_validate', """
+        ALTER TABLE attendance_scans VALIDATE CONSTRAINT attendance_scans_history_bound;
+    """),
+
+    # attendance_scans becomes range-partitioned by month on scanned_at.
+    # The existing table is attached, without copying, as
+    # attendance_scans_history for everything before the bound checked by
+    # migration 13; new months get their own partitions ahead of time from
+    # attendance_partitions.py, and expired ones are detached and
+    # archived there instead of deleted. Scans outside every partition
+    # land in attendance_scans_default until their month is created.
+    # The history stays one partition: it is archived as a whole, once
+    # its newest month is past retention (see attendance_partitions.py)
+    Migration(15, 'attendance_scans_partitioned', """
+        LOCK TABLE attendance IN ACCESS EXCLUSIVE MODE;
+
+        ALTER TABLE attendance_scans RENAME TO attendance_scans_history;
+        DROP TRIGGER attendance_scans_change_log ON attendance_scans_history;
+        ALTER TABLE attendance_scans_history DROP CONSTRAINT attendance_scans_pkey;
+        ALTER TABLE attendance_scans_history DROP CONSTRAINT attendance_scans_scan_key_key;
+        ALTER TABLE attendance_scans_history
+            ADD CONSTRAINT attendance_scans_history_pkey PRIMARY KEY USING INDEX idx_attendance_scans_id_time;
+        ALTER TABLE attendance_scans_history
+            ADD CONSTRAINT attendance_scans_history_scan_key_key UNIQUE USING INDEX idx_attendance_scans_key_time;
+        ALTER INDEX idx_attendance_scans_time RENAME TO idx_attendance_scans_history_time;
+        ALTER INDEX idx_attendance_scans_student_time RENAME TO idx_attendance_scans_history_student_time;
+
+        CREATE TABLE attendance_scans (
+            id INTEGER NOT NULL DEFAULT nextval('attendance_id_seq'),
+            student_id INTEGER NOT NULL,
+            scanned_at TIMESTAMP NOT NULL,
+            source_id SMALLINT NOT NULL,
+            flags SMALLINT NOT NULL DEFAULT 0,
+            scan_key VARCHAR(64),
+            PRIMARY KEY (id, scanned_at),
+            UNIQUE (scan_key, scanned_at)
+        ) PARTITION BY RANGE (scanned_at);
+        ALTER SEQUENCE attendance_id_seq OWNED BY attendance_scans.id;
+        CREATE INDEX idx_attendance_scans_time ON attendance_scans (scanned_at DESC, id DESC);
+        CREATE INDEX idx_attendance_scans_student_time ON attendance_scans (student_id, scanned_at DESC, id DESC);
+        CREATE TABLE attendance_scans_default PARTITION OF attendance_scans DEFAULT;
+
+        -- Creates the partition for the month of month_start unless it
+        -- exists or is covered by attendance_scans_history; rows waiting in
+        -- the default partition (which cannot overlap the history) move
+        -- into it. Returns whether it created one
+        CREATE FUNCTION attendance_create_partition(month_start DATE) RETURNS BOOLEAN AS $$
+        DECLARE
+            lo TIMESTAMP := date_trunc('month', month_start);
+            hi TIMESTAMP := date_trunc('month', month_start) + INTERVAL '1 month';
+            part TEXT := 'attendance_scans_' || to_char(month_start, '"y"YYYY"m"MM');
+            waiting BOOLEAN;
+        BEGIN
+            -- Concurrent creations deadlock on the default partition
+            PERFORM pg_advisory_xact_lock(715005);
+            IF to_regclass(part) IS NOT NULL THEN
+                RETURN FALSE;
+            END IF;
+
+            waiting := EXISTS (SELECT 1 FROM attendance_scans_default WHERE scanned_at >= lo AND scanned_at < hi);
+            IF NOT waiting THEN
+                BEGIN
+                    EXECUTE format('CREATE TABLE %I PARTITION OF attendance_scans FOR VALUES FROM (%L) TO (%L)',
+                                   part, lo, hi);
+                EXCEPTION WHEN invalid_object_definition THEN
+                    -- Overlaps attendance_scans_history
+                    RETURN FALSE;
+                END;
+                RETURN TRUE;
+            END IF;
+
+            -- A move, not a delete and insert: keep it out of attendance_changes
+            PERFORM set_config('attendance.moving_partitions', 'on', TRUE);
+            CREATE TEMP TABLE attendance_scans_moving ON COMMIT DROP AS
+            SELECT * FROM attendance_scans_default WHERE scanned_at >= lo AND scanned_at < hi;
+            DELETE FROM attendance_scans_default WHERE scanned_at >= lo AND scanned_at < hi;
+            EXECUTE format('CREATE TABLE %I PARTITION OF attendance_scans FOR VALUES FROM (%L) TO (%L)',
+                           part, lo, hi);
+            INSERT INTO attendance_scans SELECT * FROM attendance_scans_moving;
+            DROP TABLE attendance_scans_moving;
+            PERFORM set_config('attendance.moving_partitions', 'off', TRUE);
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- The partition bound is the one attendance_scans_history_bound
+        -- already proved, so attaching does not scan the table; the
+        -- partition constraint then makes the CHECK redundant
+        DO $$
+        DECLARE
+            bound TIMESTAMP;
+            month_start DATE;
+        BEGIN
+            SELECT substring(pg_get_constraintdef(oid) FROM '''([^'']+)''')::timestamp INTO bound
+            FROM pg_constraint
+            WHERE conrelid = 'attendance_scans_history'::regclass AND conname = 'attendance_scans_history_bound';
+            EXECUTE format('ALTER TABLE attendance_scans ATTACH PARTITION attendance_scans_history '
+                           'FOR VALUES FROM (MINVALUE) TO (%L)', bound);
+            ALTER TABLE attendance_scans_history DROP CONSTRAINT attendance_scans_history_bound;
+
+            FOR month_start IN
+                SELECT generate_series(bound, bound + INTERVAL '2 months', INTERVAL '1 month')::date
+                UNION
+                SELECT date_trunc('month', scanned_at)::date FROM attendance_scans_default
+            LOOP
+                PERFORM attendance_create_partition(month_start);
+            END LOOP;
+        END;
+        $$;
+
+        CREATE TRIGGER attendance_scans_change_log
+        AFTER INSERT OR DELETE ON attendance_scans
+        FOR EACH ROW EXECUTE FUNCTION log_attendance_scan();
+
+        CREATE OR REPLACE FUNCTION log_attendance_scan() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+            op_code CHAR(1);
+            s attendance_students%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                -- Backfilled rows were logged when they went into attendance_legacy
+                IF NEW.flags & 2 <> 0 THEN
+                    RETURN NULL;
+                END IF;
+                rec := NEW;
+                op_code := 'I';
+            ELSE
+                rec := OLD;
+                op_code := 'D';
+            END IF;
+            IF current_setting('attendance.moving_partitions', TRUE) = 'on' THEN
+                RETURN NULL;
+            END IF;
+
+            SELECT * INTO s FROM attendance_students WHERE student_id = rec.student_id;
+            PERFORM log_attendance_row(op_code, rec.id, s.idno, s.lastname, s.firstname,
+                                       s.course, s.level, rec.scanned_at);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- Same definition, re-pointed at the partitioned table
+        CREATE OR REPLACE VIEW attendance AS
+        SELECT f.id, s.idno, s.lastname, s.firstname, s.course, s.level,
+               f.scanned_at AS time_logged, f.scan_key, f.source_id, f.flags
+        FROM attendance_scans f
+        JOIN attendance_students s ON s.student_id = f.student_id;
+
+        -- scanned_at lets the delete prune to one partition
+        CREATE OR REPLACE FUNCTION attendance_view_delete() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM attendance_scans WHERE id = OLD.id AND scanned_at = OLD.time_logged;
+            IF NOT FOUND THEN
+                RETURN NULL;
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+
+    # Roster edits NOTIFY roster_changes so every worker's student_cache
+    # drops them (attendance_events). One message per statement: up to 100
+    # idnos, or {"all": true} for a bulk import
+    Migration(16, 'users_change_notify', """
+        CREATE FUNCTION notify_roster_change() RETURNS trigger AS $$
+        DECLARE
+            changed JSON;
+            total INTEGER;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT json_agg(idno), COUNT(*) INTO changed, total FROM (SELECT idno FROM new_rows LIMIT 101) r;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT json_agg(idno), COUNT(*) INTO changed, total FROM (SELECT idno FROM old_rows LIMIT 101) r;
+            ELSE
+                -- idno itself may have changed
+                SELECT json_agg(idno), COUNT(*) INTO changed, total FROM (
+                    SELECT idno FROM new_rows UNION SELECT idno FROM old_rows LIMIT 101
+                ) r;
+            END IF;
+
+            IF total > 100 THEN
+                PERFORM pg_notify('roster_changes', '{"all": true}');
+            ELSIF total > 0 THEN
+                PERFORM pg_notify('roster_changes', json_build_object('idnos', changed)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        -- A transition table trigger handles one event, hence three
+        CREATE TRIGGER users_insert_notify
+        AFTER INSERT ON users REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_roster_change();
+        CREATE TRIGGER users_update_notify
+        AFTER UPDATE ON users REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_roster_change();
+        CREATE TRIGGER users_delete_notify
+        AFTER DELETE ON users REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_roster_change();
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def checksum(migration):
+    return hashlib.sha256(migration.sql.strip().encode('utf-8')).hexdigest()
+
+
+def _applied(cursor):
+    """version -> checksum of the applied migrations ({} before the first)"""
+    cursor.execute("SELECT to_regclass('schema_version')")
+    if cursor.fetchone()[0] is None:
+        return {}
+    cursor.execute("SELECT version, checksum FROM schema_version")
+    return dict(cursor.fetchall())
+
+
+def _compare(applied):
+    """(pending migrations, versions whose SQL changed since applied)"""
+    pending = [m for m in MIGRATIONS if m.version not in applied]
+    changed = [m.version for m in MIGRATIONS
+               if m.version in applied and applied[m.version] != checksum(m)]
+    return pending, changed
+
+
+def check_schema():
+    """Cheap boot-time check; returns a status dict, or None without a database"""
+    try:
+        with db_connection() as conn:
+            if not conn:
+                return None
+            cursor = conn.cursor()
+            applied = _applied(cursor)
+            cursor.close()
+    except psycopg2.Error as e:
+        log.error("✗ Schema version check failed: %s", e)
+        return None
+
+    pending, changed = _compare(applied)
+    return {
+        'current': max(applied) if applied else 0,
+        'latest': LATEST_VERSION,
+        'pending': [m.version for m in pending],
+        'changed': changed,
+    }
+
+
+def ensure_schema():
+    """Log how the schema compares with this code; never migrates.
+
+    Migrating is left to the gunicorn master (on_starting) or
+    `python migrations.py`, so workers never take DDL locks while serving.
+    """
+    status = check_schema()
+    if status is None:
+        log.warning("No database connection for the schema check")
+        return None
+    if status['changed']:
+        log.error("✗ Applied migrations %s differ from this code", status['changed'])
+    if status['pending']:
+        log.error("✗ Schema at version %d but this code expects %d; run `python migrations.py`",
+                  status['current'], status['latest'])
+        return status
+    log.info("✓ Schema at version %d", status['current'])
+    return status
+
+
+def migrate():
+    """Apply pending migrations in order; returns the versions applied.
+
+    Holds a session advisory lock, so processes that start together wait
+    for the first one and then find nothing left to do. Raises
+    MigrationError if an applied migration's SQL has since changed.
+    """
+    conn = open_connection()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(100) NOT NULL,
+                    checksum CHAR(64) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    duration_ms INTEGER
+                )
+            """)
+            pending, changed = _compare(_applied(cursor))
+            if changed:
+                raise MigrationError(f"Applied migrations {changed} were edited; add a new migration instead")
+
+            done = []
+            for migration in pending:
+                _apply(conn, cursor, migration)
+                done.append(migration.version)
+            return done
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.close()
+
+
+def _apply(conn, cursor, migration):
+    started = time.monotonic()
+    record = """
+        INSERT INTO schema_version (version, name, checksum, duration_ms)
+        VALUES (%s, %s, %s, %s)
+    """
+
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            cursor.execute(migration.sql)
+            cursor.execute(record, (migration.version, migration.name, checksum(migration),
+                                    int((time.monotonic() - started) * 1000)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        if migration.index:
+            _drop_invalid_index(cursor, migration.index)
+        cursor.execute(migration.sql)
+        cursor.execute(record, (migration.version, migration.name, checksum(migration),
+                                int((time.monotonic() - started) * 1000)))
+
+    log.info("✓ Migration %d %s applied in %.2fs", migration.version, migration.name,
+             time.monotonic() - started)
+
+
+def _drop_invalid_index(cursor, index):
+    """A failed CONCURRENTLY build leaves an invalid index that IF NOT EXISTS would keep"""
+    cursor.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    """, (index,))
+    if cursor.fetchone():
+        log.warning("Dropping invalid index %s left by an interrupted build", index)
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument('--status', action='store_true', help="Show versions without migrating")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    if args.status:
+        status = check_schema()
+        if status is None:
+            print("✗ Database unavailable")
+            return 1
+        print(f"Schema version {status['current']} of {status['latest']}")
+        if status['pending']:
+            print(f"Pending: {status['pending']}")
+        if status['changed']:
+            print(f"✗ Edited since applied: {status['changed']}")
+        return 1 if status['pending'] or status['changed'] else 0
+
+    applied = migrate()
+    print(f"✓ Schema at version {LATEST_VERSION} ({len(applied)} migrations applied)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# photo_index.py - Which student photo files exist, without hitting the disk per scan
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from student_assets import IMAGE_DIR, PHOTO_VARIANTS, photo_path
+
+log = logging.getLogger(__name__)
+
+PHOTO_PLACEHOLDER = 'static/photo-placeholder.svg'
+# Legacy uploads that predate the pipeline
+LEGACY_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# How long an idno without a photo is trusted before the disk is checked
+# again (uploads handled by other gunicorn workers show up after this)
+PHOTO_INDEX_MISS_TTL = float(os.environ.get('PHOTO_INDEX_MISS_TTL', '60'))
+# Remembered misses per worker; /api/photo/<idno> is public, so any idno can become one
+PHOTO_INDEX_MISS_SIZE = int(os.environ.get('PHOTO_INDEX_MISS_SIZE', '10000'))
+
+
+def _version(path):
+    try:
+        return int(os.stat(path).st_mtime)
+    except OSError:
+        return None
+
+
+class PhotoIndex:
+    """idno -> {variant: (path, mtime)} for the photos under static/image.
+
+    Built once at startup; the photo pipeline refreshes entries as uploads
+    finish. Variants are 'thumb', 'display' and None (the master/legacy
+    file). A miss is re-checked on disk at most every PHOTO_INDEX_MISS_TTL;
+    at most miss_size misses are remembered, expired ones dropped first.
+    """
+
+    def __init__(self, directory=IMAGE_DIR, miss_ttl=PHOTO_INDEX_MISS_TTL, miss_size=PHOTO_INDEX_MISS_SIZE):
+        self.directory = directory
+        self.miss_ttl = miss_ttl
+        self.miss_size = miss_size
+        self._lock = threading.Lock()
+        self._photos = {}
+        # idno -> expiry, oldest first (the TTL is fixed, so also soonest to expire)
+        self._misses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def build(self):
+        """Scan the image directory; returns the number of students found"""
+        photos = {}
+        try:
+            for name in os.listdir(self.directory):
+                idno, extension = os.path.splitext(name)
+                path = os.path.join(self.directory, name)
+                if extension.lower() in LEGACY_EXTENSIONS and os.path.isfile(path):
+                    current = photos.setdefault(idno, {}).get(None)
+                    # <idno>.jpg is the pipeline's master; prefer it
+                    if current is None or extension == '.jpg':
+                        photos[idno][None] = (path, _version(path))
+
+            for variant in PHOTO_VARIANTS:
+                variant_dir = os.path.join(self.directory, variant)
+                if not os.path.isdir(variant_dir):
+                    continue
+                for name in os.listdir(variant_dir):
+                    idno, extension = os.path.splitext(name)
+                    if extension == '.webp':
+                        path = os.path.join(variant_dir, name)
+                        photos.setdefault(idno, {})[variant] = (path, _version(path))
+        except OSError as e:
+            log.error("Photo index scan failed: %s", e)
+
+        with self._lock:
+            self._photos = photos
+            self._misses = OrderedDict()
+        log.info("✓ Indexed photos for %d students", len(photos))
+        return len(photos)
+
+    def refresh(self, idno, *args):
+        """Re-stat one student's files (pipeline callback(idno, path))"""
+        found = {}
+        for variant in list(PHOTO_VARIANTS) + [None]:
+            path = photo_path(idno, variant, self.directory)
+            version = _version(path)
+            if version is not None:
+                found[variant] = (path, version)
+        if None not in found:
+            for extension in LEGACY_EXTENSIONS[1:]:
+                path = os.path.join(self.directory, idno + extension)
+                version = _version(path)
+                if version is not None:
+                    found[None] = (path, version)
+                    break
+
+        with self._lock:
+            if found:
+                self._photos[idno] = found
+                self._misses.pop(idno, None)
+            else:
+                self._photos.pop(idno, None)
+                self._remember_miss(idno)
+        return found
+
+    def apply_roster_change(self, event):
+        """Hub listener (roster_changes): re-check photos another process wrote"""
+        for idno in event.get('photos') or ():
+            self.refresh(idno)
+
+    def _remember_miss(self, idno):
+        # Caller holds self._lock
+        now = time.monotonic()
+        self._misses.pop(idno, None)
+        self._misses[idno] = now + self.miss_ttl
+        while self._misses:
+            oldest, expires = next(iter(self._misses.items()))
+            if expires > now and len(self._misses) <= self.miss_size:
+                break
+            del self._misses[oldest]
+
+    def lookup(self, idno, variant='thumb'):
+        """(path, version) of the best file for variant, or None"""
+        with self._lock:
+            entry = self._photos.get(idno)
+            retry = entry is None and self._misses.get(idno, 0) <= time.monotonic()
+
+        if retry:
+            entry = self.refresh(idno)
+
+        with self._lock:
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Fall back from the requested variant to the larger/master files
+        for candidate in (variant, 'display', None):
+            if candidate in entry:
+                return entry[candidate]
+        return next(iter(entry.values()))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'students': len(self._photos),
+                'known_missing': len(self._misses),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+photo_index = PhotoIndex()
@@ -0,0 +1,178 @@
+# photo_pipeline.py - Process student photos off the request thread
+#
+#   python photo_pipeline.py [--workers N] [static/image]
+#
+# reprocesses every photo already in the directory (masters and legacy
+# .jpeg/.png uploads) into the current variants.
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from student_assets import IMAGE_DIR, process_photo
+from app_logging import setup_logging
+
+log = logging.getLogger(__name__)
+
+# Per gunicorn worker. Pillow releases the GIL while resizing/encoding,
+# so a couple of threads keep up with webcam uploads
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', '2'))
+# Uploads waiting or in progress; beyond this the request does the work
+PHOTO_QUEUE_SIZE = int(os.environ.get('PHOTO_QUEUE_SIZE', '16'))
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+_pipeline = None
+_pipeline_pid = None
+_pipeline_lock = threading.Lock()
+
+
+class PhotoPipeline:
+    """Bounded thread pool that runs process_photo for uploads.
+
+    submit() never blocks on a full pool: when PHOTO_QUEUE_SIZE jobs are
+    already queued the photo is processed in the calling thread instead,
+    so memory stays bounded and uploads still succeed.
+    """
+
+    def __init__(self, workers=PHOTO_WORKERS, queue_size=PHOTO_QUEUE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photo')
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.inline = 0
+        self.total_seconds = 0.0
+
+    def submit(self, idno, data, callback=None):
+        """Process raw image bytes for idno; callback(idno, path) on success"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.inline += 1
+            self._run(idno, data, callback, release=False)
+            return False
+
+        self._executor.submit(self._run, idno, data, callback, True)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'inline': self.inline,
+                'avg_ms': round(self.total_seconds / self.processed * 1000, 1) if self.processed else 0.0,
+            }
+
+    def _run(self, idno, data, callback, release):
+        started = time.monotonic()
+        try:
+            path = process_photo(idno, data)
+            with self._lock:
+                self.processed += 1
+                self.total_seconds += time.monotonic() - started
+            log.info("✓ Photo processed for %s", idno)
+            if callback:
+                callback(idno, path)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log.error("✗ Photo processing failed for %s: %s", idno, e)
+        finally:
+            if release:
+                self._slots.release()
+
+
+def get_photo_pipeline():
+    """This worker's pipeline (recreated after fork)"""
+    global _pipeline, _pipeline_pid
+
+    pid = os.getpid()
+    if _pipeline is not None and _pipeline_pid == pid:
+        return _pipeline
+
+    with _pipeline_lock:
+        if _pipeline is None or _pipeline_pid != pid:
+            _pipeline = PhotoPipeline()
+            _pipeline_pid = pid
+        return _pipeline
+
+
+def submit_photo(idno, data, callback=None):
+    """Queue an uploaded photo (raw bytes) for processing"""
+    return get_photo_pipeline().submit(idno, data, callback)
+
+
+def find_photos(directory=IMAGE_DIR):
+    """idno -> source file for every photo in directory (top level only).
+
+    A normalized <idno>.jpg master wins over legacy .jpeg/.png uploads.
+    """
+    photos = {}
+    for name in sorted(os.listdir(directory)):
+        idno, extension = os.path.splitext(name)
+        path = os.path.join(directory, name)
+        if extension.lower() not in PHOTO_EXTENSIONS or not os.path.isfile(path):
+            continue
+        if idno not in photos or extension == '.jpg':
+            photos[idno] = path
+    return photos
+
+
+def _reprocess(item):
+    idno, path, directory = item
+    try:
+        with open(path, 'rb') as f:
+            process_photo(idno, f.read(), directory=directory)
+        return idno, None
+    except Exception as e:
+        return idno, str(e)
+
+
+def reprocess_directory(directory=IMAGE_DIR, workers=os.cpu_count() or 1):
+    """Rebuild masters and variants for every photo; returns a report"""
+    # CLI only; kept out of the web app's imports
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    started = time.monotonic()
+    photos = find_photos(directory)
+    items = [(idno, path, directory) for idno, path in photos.items()]
+
+    errors = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context) as executor:
+        chunksize = max(1, len(items) // (max(1, workers) * 8))
+        for idno, error in executor.map(_reprocess, items, chunksize=chunksize):
+            if error:
+                errors.append({'idno': idno, 'error': error})
+
+    elapsed = time.monotonic() - started
+    return {
+        'photos': len(items),
+        'failed': len(errors),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'photos_per_second': round(len(items) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess student photos into variants")
+    parser.add_argument('directory', nargs='?', default=IMAGE_DIR)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    report = reprocess_directory(args.directory, args.workers)
+    for error in report['errors']:
+        print(f"✗ {error['idno']}: {error['error']}")
+    print(f"✓ Reprocessed {report['photos'] - report['failed']} of {report['photos']} photos "
+          f"in {report['seconds']}s ({report['photos_per_second']}/s)")
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
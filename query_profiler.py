@@ -0,0 +1,350 @@
+# query_profiler.py - Opt-in per-statement profile with sampled EXPLAIN plans
+#
+# With QUERY_PROFILE=1 every statement run through dbhelper's cursors is
+# recorded under its fingerprint (the SQL with literals and value lists
+# collapsed): calls, total and max time, rows, and which functions issue
+# it. A statement slower than SLOW_QUERY_MS is also kept with redacted
+# parameters, and EXPLAIN_SAMPLE_RATE of those get their plan captured by
+# a background thread on its own connection, so the request that was
+# slow does not wait for it and its transaction is never touched. Only
+# plain SELECTs are re-run with EXPLAIN (ANALYZE, BUFFERS), in a read-only
+# transaction that is rolled back; anything else gets the plan alone.
+# The plan is run with the real parameters, so the values it prints in
+# its conditions are replaced by ? before it is kept.
+# Everything is per worker and bounded; see /admin/queries.
+import hashlib
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import psycopg2.extensions
+
+log = logging.getLogger(__name__)
+
+QUERY_PROFILE = os.environ.get('QUERY_PROFILE', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+EXPLAIN_SAMPLE_RATE = float(os.environ.get('EXPLAIN_SAMPLE_RATE', '0.1'))
+# One plan per fingerprint this often at most
+EXPLAIN_INTERVAL = float(os.environ.get('EXPLAIN_INTERVAL', '300'))
+# ANALYZE runs the query again; give up rather than pile on a struggling database
+EXPLAIN_TIMEOUT_MS = int(os.environ.get('EXPLAIN_TIMEOUT_MS', '10000'))
+QUERY_PROFILE_SIZE = int(os.environ.get('QUERY_PROFILE_SIZE', '500'))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', '100'))
+# Slow statements waiting for a plan; more are not explained
+EXPLAIN_QUEUE_SIZE = 20
+FINGERPRINT_CACHE_SIZE = 2000
+# Fingerprint text kept per statement (VALUES lists are already collapsed)
+FINGERPRINT_MAX_LENGTH = 4000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?(?![\w.])")
+_SPACE = re.compile(r"\s+")
+# Runs of parenthesized groups, e.g. the rows execute_values builds
+_GROUPS = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,)+\s*\?\s*\)", re.IGNORECASE)
+# Plan lines that print the query's values: Filter, Index Cond, Sort Key, Output, ...
+_PLAN_CONDITION = re.compile(r"^(\s*(?:->\s*)?(?!Rows Removed)[A-Z][\w -]*(?:Cond|Filter|Key|Output|Params)\b[^:]*:)(.*)$")
+_QUOTED = re.compile(r'"(?:[^"]|"")*"')
+# Never re-run: locks, notifications and settings outlive a read-only rollback
+_SIDE_EFFECTS = re.compile(r"\b(?:pg_(?:try_)?advisory\w*|pg_notify|set_config|nextval|setval|pg_sleep)\s*\(|"
+                           r"\bFOR\s+(?:NO\s+KEY\s+)?UPDATE\b|\bFOR\s+(?:KEY\s+)?SHARE\b", re.IGNORECASE)
+
+
+def fingerprint(sql):
+    """SQL text with literals as ?, whitespace collapsed and value lists shortened"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    sql = _GROUPS.sub(r'\1, ...', sql)
+    sql = _IN_LIST.sub('IN (?, ...)', sql)
+    return sql[:FINGERPRINT_MAX_LENGTH]
+
+
+def scrub_plan(text):
+    """EXPLAIN output with the literals in its conditions replaced by ?"""
+    lines = []
+    for line in text.split('\n'):
+        line = _STRING.sub('?', line)
+        match = _PLAN_CONDITION.match(line)
+        if match:
+            line = match.group(1) + _NUMBER.sub('?', match.group(2))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def scrub_error(error):
+    """First line of a database error without the values it quotes"""
+    first = str(error).strip().split('\n', 1)[0]
+    return _QUOTED.sub('?', _STRING.sub('?', first))
+
+
+def _redact(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def redact(params):
+    """Parameter types and sizes, never values"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {name: _redact(value) for name, value in params.items()}
+    return [_redact(value) for value in params]
+
+
+def _is_read_only(sql):
+    """A single SELECT (or WITH) that is safe to run a second time"""
+    text = sql.strip().rstrip(';')
+    if ';' in text or _SIDE_EFFECTS.search(text):
+        return False
+    head = text[:6].upper()
+    if head == 'SELECT':
+        return True
+    if head.startswith('WITH'):
+        return not re.search(r'\b(?:INSERT|UPDATE|DELETE|MERGE)\b', text, re.IGNORECASE)
+    return False
+
+
+def _is_explainable(sql):
+    # EXPLAIN takes exactly one statement
+    if ';' in sql.strip().rstrip(';'):
+        return False
+    head = sql.lstrip()[:6].upper()
+    return head in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') or head.startswith('WITH')
+
+
+class _Statement:
+    __slots__ = ('id', 'text', 'callers', 'calls', 'total', 'max', 'rows', 'slow_calls',
+                 'last_slow', 'plan', 'plan_requested')
+
+    def __init__(self, text):
+        self.id = hashlib.md5(text.encode()).hexdigest()[:12]
+        self.text = text
+        self.callers = set()
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow_calls = 0
+        self.last_slow = None
+        self.plan = None
+        self.plan_requested = 0.0
+
+    def as_dict(self, plans=True):
+        stats = {
+            'id': self.id,
+            'statement': self.text,
+            'callers': sorted(self.callers),
+            'calls': self.calls,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.total / self.calls * 1000, 3) if self.calls else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'rows': self.rows,
+            'slow_calls': self.slow_calls,
+            'last_slow': self.last_slow,
+        }
+        if plans:
+            stats['plan'] = self.plan
+        return stats
+
+
+class QueryProfiler:
+    """Bounded per-worker statement profile.
+
+    record() is called by dbhelper's TimedCursor after each statement.
+    When the profile is full, the statement with the least total time
+    makes room for a new one.
+    """
+
+    def __init__(self, enabled=QUERY_PROFILE, slow_ms=SLOW_QUERY_MS, sample_rate=EXPLAIN_SAMPLE_RATE,
+                 size=QUERY_PROFILE_SIZE, slow_log_size=SLOW_QUERY_LOG_SIZE):
+        self.enabled = enabled
+        self.slow = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self.size = size
+        self._lock = threading.Lock()
+        self._statements = {}                   # fingerprint -> _Statement
+        self._fingerprints = OrderedDict()      # raw SQL -> fingerprint, most recent last
+        self._slow_log = deque(maxlen=slow_log_size)
+        self._explain_queue = None
+        self._explain_pid = None
+        self.started_at = time.time()
+        self.evicted = 0
+        self.plans = 0
+        self.plans_skipped = 0
+
+    def record(self, caller, sql, params, seconds, rows, server_side=False):
+        if not isinstance(sql, (str, bytes)):
+            return
+        text = self._fingerprint(sql)
+        explain = False
+        with self._lock:
+            statement = self._statements.get(text)
+            if statement is None:
+                if len(self._statements) >= self.size:
+                    self._evict()
+                statement = self._statements[text] = _Statement(text)
+            statement.calls += 1
+            statement.total += seconds
+            statement.max = max(statement.max, seconds)
+            statement.rows += max(rows, 0)
+            if len(statement.callers) < 10:
+                statement.callers.add(caller)
+
+            if seconds >= self.slow:
+                statement.slow_calls += 1
+                statement.last_slow = {
+                    'at': datetime.now().isoformat(timespec='seconds'),
+                    'ms': round(seconds * 1000, 3),
+                    'rows': rows,
+                    'caller': caller,
+                    'params': redact(params),
+                }
+                self._slow_log.append(dict(statement.last_slow, id=statement.id))
+                now = time.monotonic()
+                # Server-side cursors only ran DECLARE here
+                if (not server_side and random.random() < self.sample_rate
+                        and now - statement.plan_requested >= EXPLAIN_INTERVAL):
+                    statement.plan_requested = now
+                    explain = True
+
+        if explain:
+            self._request_plan(statement, sql, params, seconds)
+
+    def top(self, n=20, order='total', plans=True):
+        """The n statements with the most total (or mean/max) time"""
+        key = {'total': lambda s: s.total, 'max': lambda s: s.max,
+               'mean': lambda s: s.total / s.calls if s.calls else 0, 'calls': lambda s: s.calls}[order]
+        with self._lock:
+            statements = sorted(self._statements.values(), key=key, reverse=True)[:n]
+            return [statement.as_dict(plans) for statement in statements]
+
+    def slow_log(self):
+        """Recent slow statements, newest first"""
+        with self._lock:
+            return list(reversed(self._slow_log))
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow_log.clear()
+            self.started_at = time.time()
+            self.evicted = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'slow_ms': self.slow * 1000,
+                'explain_sample_rate': self.sample_rate,
+                'statements': len(self._statements),
+                'max_statements': self.size,
+                'evicted': self.evicted,
+                'plans': self.plans,
+                'plans_skipped': self.plans_skipped,
+                'since': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+                'pid': os.getpid(),
+            }
+
+    def _fingerprint(self, sql):
+        with self._lock:
+            text = self._fingerprints.get(sql)
+            if text is not None:
+                self._fingerprints.move_to_end(sql)
+                return text
+        text = fingerprint(sql)
+        with self._lock:
+            self._fingerprints[sql] = text
+            if len(self._fingerprints) > FINGERPRINT_CACHE_SIZE:
+                self._fingerprints.popitem(last=False)
+        return text
+
+    def _evict(self):
+        victim = min(self._statements.values(), key=lambda s: s.total)
+        del self._statements[victim.text]
+        self.evicted += 1
+
+    # --- EXPLAIN capture --------------------------------------------------
+
+    def _request_plan(self, statement, sql, params, seconds):
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        if not _is_explainable(sql):
+            return
+        try:
+            self._explainer().put_nowait((statement, sql, params, seconds))
+        except queue.Full:
+            with self._lock:
+                self.plans_skipped += 1
+
+    def _explainer(self):
+        """This process's plan queue, with its thread (started on first use)"""
+        pid = os.getpid()
+        if self._explain_pid != pid:
+            with self._lock:
+                if self._explain_pid != pid:
+                    self._explain_queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+                    threading.Thread(target=self._run_explainer, args=(self._explain_queue,),
+                                     name='query-explainer', daemon=True).start()
+                    self._explain_pid = pid
+        return self._explain_queue
+
+    def _run_explainer(self, requests):
+        conn = None
+        while True:
+            statement, sql, params, seconds = requests.get()
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect()
+                plan = self._explain(conn, sql, params)
+            except Exception as e:
+                plan = {'error': scrub_error(e)}
+                if conn is not None and not conn.closed and isinstance(e, psycopg2.OperationalError):
+                    conn.close()
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+            plan.update(at=datetime.now().isoformat(timespec='seconds'), statement_ms=round(seconds * 1000, 3))
+            with self._lock:
+                statement.plan = plan
+                self.plans += 1
+            log.info("Captured plan for slow statement %s (%.0f ms)", statement.id, seconds * 1000)
+
+    def _connect(self):
+        # Lazy: dbhelper imports this module
+        from dbhelper import open_connection
+        conn = open_connection()
+        # Writes fail instead of happening twice; every explain is rolled back
+        conn.set_session(readonly=True)
+        cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        cursor.execute("SET statement_timeout = %s", (EXPLAIN_TIMEOUT_MS,))
+        cursor.close()
+        conn.commit()
+        return conn
+
+    def _explain(self, conn, sql, params):
+        analyze = _is_read_only(sql)
+        # A plain cursor: the profiler's own statements are not profiled
+        cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+            cursor.execute(prefix + sql, params)
+            # Run with the real parameters, which the plan prints back
+            text = scrub_plan('\n'.join(row[0] for row in cursor.fetchall()))
+        finally:
+            cursor.close()
+        return {'analyzed': analyze, 'text': text}
+
+
+query_profiler = QueryProfiler()
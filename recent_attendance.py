@@ -0,0 +1,99 @@
+# recent_attendance.py - Latest attendance records kept in memory
+import os
+import threading
+
+RECENT_ATTENDANCE_SIZE = int(os.environ.get('RECENT_ATTENDANCE_SIZE', '50'))
+
+
+def _record_key(record):
+    """Rows from the database have an id; file fallback rows do not"""
+    if record.get('id') is not None:
+        return record['id']
+    return (record.get('idno'), str(record.get('time_logged')))
+
+
+def _sort_key(record):
+    return (str(record.get('time_logged')), record.get('id') or 0)
+
+
+class RecentAttendance:
+    """Bounded buffer of the newest attendance records, newest first.
+
+    Holds at most `size` records, so reads never depend on how large the
+    attendance table is. Records are kept in (time_logged, id) order
+    because kiosk clocks can deliver scans slightly out of order.
+    """
+
+    def __init__(self, size=RECENT_ATTENDANCE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._records = []
+        self._keys = set()
+        self.seeded = False
+        # True once older records have been pushed out, i.e. a delete may
+        # leave the buffer short of rows that still exist in the table
+        self.truncated = False
+
+    def seed(self, records):
+        """Replace the contents with records from a LIMIT query"""
+        records = sorted(records, key=_sort_key, reverse=True)[:self.size]
+        with self._lock:
+            self._records = records
+            self._keys = {_record_key(record) for record in records}
+            self.truncated = len(records) >= self.size
+            self.seeded = True
+
+    def add(self, record):
+        """Insert a new record in order; duplicates are ignored"""
+        key = _record_key(record)
+        sort_key = _sort_key(record)
+        with self._lock:
+            if key in self._keys:
+                return
+
+            position = 0
+            while position < len(self._records) and _sort_key(self._records[position]) > sort_key:
+                position += 1
+            if position >= self.size:
+                return
+
+            self._records.insert(position, record)
+            self._keys.add(key)
+            if len(self._records) > self.size:
+                dropped = self._records.pop()
+                self._keys.discard(_record_key(dropped))
+                self.truncated = True
+
+    def remove(self, record_id=None, idno=None, time_logged=None):
+        """Drop a record by id, or by (idno, time_logged) as the delete route does"""
+        with self._lock:
+            kept = []
+            for record in self._records:
+                if record_id is not None and record.get('id') == record_id:
+                    continue
+                if (record_id is None and record.get('idno') == idno
+                        and str(record.get('time_logged')) == str(time_logged)):
+                    continue
+                kept.append(record)
+            self._records = kept
+            self._keys = {_record_key(record) for record in kept}
+
+    def apply_change(self, event):
+        """Hub listener: apply an insert/delete event from any worker"""
+        if event.get('op') == 'insert':
+            self.add(event['record'])
+        elif event.get('op') == 'delete':
+            self.remove(record_id=event['record'].get('id'))
+
+    def latest(self, n=1):
+        """Newest n records (fewer if the buffer holds fewer)"""
+        with self._lock:
+            return list(self._records[:max(0, n)])
+
+    def needs_reseed(self, n):
+        """True when n records were asked for but deletes left us short"""
+        with self._lock:
+            return not self.seeded or (self.truncated and len(self._records) < min(n, self.size))
+
+
+recent_attendance = RecentAttendance()
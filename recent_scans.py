@@ -0,0 +1,199 @@
+# recent_scans.py - Recent scans per worker, for answering duplicates from memory
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# A second scan of the same idno this close (by time_logged) to the last
+# one is a repeat detection or double tap, not a new attendance
+SCAN_DEBOUNCE_SECONDS = float(os.environ.get('SCAN_DEBOUNCE_SECONDS', '60'))
+# How long an idempotency key is remembered in memory (the unique index on
+# attendance.scan_key covers retries after that)
+SCAN_KEY_TTL = float(os.environ.get('SCAN_KEY_TTL', '600'))
+RECENT_SCANS_SIZE = int(os.environ.get('RECENT_SCANS_SIZE', '20000'))
+# Fits attendance.scan_key
+SCAN_KEY_MAX_LENGTH = 64
+# A duplicate arriving while the original is still being written waits
+# this long for its record
+SCAN_WAIT_SECONDS = 5.0
+
+
+def scan_time(time_logged):
+    """datetime of a 'YYYY-MM-DD HH:MM:SS' scan time (now if unparseable)"""
+    try:
+        return datetime.strptime(str(time_logged)[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return datetime.now()
+
+
+def valid_scan_key(scan_key):
+    """Keys are client-chosen: short, and letters, digits, '-' or '_'"""
+    return (isinstance(scan_key, str) and 0 < len(scan_key) <= SCAN_KEY_MAX_LENGTH
+            and all(c.isascii() and (c.isalnum() or c in '-_') for c in scan_key))
+
+
+class _Scan:
+    __slots__ = ('idno', 'scan_key', 'when', 'expires', 'record', 'done')
+
+    def __init__(self, idno, scan_key, when, expires, record=None):
+        self.idno = idno
+        self.scan_key = scan_key
+        self.when = when
+        self.expires = expires
+        self.record = record
+        self.done = threading.Event()
+        if record is not None:
+            self.done.set()
+
+
+class RecentScans:
+    """Idempotency keys and last scan per idno, kept for SCAN_KEY_TTL.
+
+    begin() either returns the record a duplicate should be answered with,
+    or reserves the scan so concurrent duplicates in this worker wait for
+    it instead of inserting. Scans from other workers arrive through the
+    attendance change feed (apply_change), so the idno debounce holds
+    across workers once the first scan is committed.
+    """
+
+    def __init__(self, window=SCAN_DEBOUNCE_SECONDS, ttl=SCAN_KEY_TTL, size=RECENT_SCANS_SIZE):
+        self.window = timedelta(seconds=window)
+        self.ttl = max(ttl, window)
+        self.size = size
+        self._lock = threading.Lock()
+        self._by_key = OrderedDict()    # scan_key -> _Scan, oldest first
+        self._by_idno = {}              # idno -> latest _Scan
+        self.duplicates = 0
+        self.debounced = 0
+        self.accepted = 0
+
+    def begin(self, idno, scan_key, time_logged):
+        """(original record, None) for a duplicate, else (None, reservation).
+
+        Pass the reservation to finish() with the stored record (or None
+        if saving failed) once the scan has been written.
+        """
+        when = scan_time(time_logged)
+        with self._lock:
+            self._prune()
+            original = self._by_key.get(scan_key)
+            if original is None:
+                latest = self._by_idno.get(idno)
+                if latest is not None and abs(latest.when - when) < self.window:
+                    original = latest
+                    self.debounced += 1
+            else:
+                self.duplicates += 1
+
+            if original is None:
+                scan = _Scan(idno, scan_key, when, time.monotonic() + self.ttl)
+                self._remember(scan)
+                self.accepted += 1
+                return None, scan
+
+        # Still being written by another request: wait for its record
+        if original.done.wait(SCAN_WAIT_SECONDS) and original.record is not None:
+            return original.record, None
+        # The original failed or is stuck; let the database decide
+        return self.begin(idno, scan_key, time_logged) if original.done.is_set() else (None, None)
+
+    def finish(self, scan, record):
+        """Attach the stored record to a reservation from begin()"""
+        if scan is None:
+            return
+        with self._lock:
+            if record is None:
+                # Failed: forget it so a retry is not answered with nothing
+                if self._by_key.get(scan.scan_key) is scan:
+                    del self._by_key[scan.scan_key]
+                if self._by_idno.get(scan.idno) is scan:
+                    del self._by_idno[scan.idno]
+            else:
+                scan.record = record
+        scan.done.set()
+
+    def collapse(self, scans):
+        """Split a kiosk batch into (first scans, {index: index of its original}).
+
+        scans are dicts with idno, scan_key and time_logged. A scan
+        repeating an earlier key, or within the debounce window of the
+        previous kept scan of its idno, maps to that scan's index.
+        """
+        order = sorted(range(len(scans)), key=lambda i: scan_time(scans[i]['time_logged']))
+        kept = []
+        repeats = {}
+        by_key = {}
+        by_idno = {}
+        for index in order:
+            scan = scans[index]
+            when = scan_time(scan['time_logged'])
+            original = by_key.get(scan['scan_key'])
+            if original is None and scan['idno'] in by_idno:
+                previous, previous_when = by_idno[scan['idno']]
+                if abs(when - previous_when) < self.window:
+                    original = previous
+            if original is not None:
+                repeats[index] = original
+                continue
+            kept.append(index)
+            by_key[scan['scan_key']] = index
+            by_idno[scan['idno']] = (index, when)
+        return kept, repeats
+
+    def apply_change(self, event):
+        """Hub listener: learn other workers' scans, forget deleted ones"""
+        record = event.get('record') or {}
+        idno = record.get('idno')
+        if not idno:
+            return
+        with self._lock:
+            latest = self._by_idno.get(idno)
+            if event.get('op') == 'insert':
+                when = scan_time(record.get('time_logged'))
+                if latest is None or (latest.done.is_set() and latest.when < when):
+                    scan = _Scan(idno, None, when, time.monotonic() + self.ttl, record)
+                    self._by_idno[idno] = scan
+            elif event.get('op') == 'delete':
+                # A deleted scan must not keep answering rescans
+                if latest is not None and latest.record and latest.record.get('id') == record.get('id'):
+                    del self._by_idno[idno]
+                    if latest.scan_key and self._by_key.get(latest.scan_key) is latest:
+                        del self._by_key[latest.scan_key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._by_key),
+                'students': len(self._by_idno),
+                'accepted': self.accepted,
+                'duplicates': self.duplicates,
+                'debounced': self.debounced,
+                'window_seconds': self.window.total_seconds(),
+            }
+
+    def _remember(self, scan):
+        self._by_key[scan.scan_key] = scan
+        self._by_idno[scan.idno] = scan
+        while len(self._by_key) > self.size:
+            self._forget(self._by_key.popitem(last=False)[1])
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._by_key:
+            scan = next(iter(self._by_key.values()))
+            if scan.expires > now:
+                break
+            del self._by_key[scan.scan_key]
+            self._forget(scan)
+        # Entries learned from the change feed have no key
+        if len(self._by_idno) > self.size:
+            for idno in [idno for idno, scan in self._by_idno.items() if scan.expires <= now]:
+                del self._by_idno[idno]
+
+    def _forget(self, scan):
+        if self._by_idno.get(scan.idno) is scan:
+            del self._by_idno[scan.idno]
+
+
+recent_scans = RecentScans()
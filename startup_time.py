@@ -0,0 +1,86 @@
+# startup_time.py - How long app.py takes to import (and a worker to start)
+#
+#   python startup_time.py [--runs N] [--worker] [--top N]
+#
+# Each run imports the app in a fresh interpreter, like a gunicorn boot.
+# Exits 1 when the median import time is over STARTUP_BUDGET_MS.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', '200'))
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_MEASURE = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+worker = app.start_worker() if {worker} else 0.0
+print('startup:', round((imported - started) * 1000, 1), round(worker * 1000, 1))
+"""
+
+
+def measure(worker=False):
+    """(import ms, start_worker ms) from one fresh interpreter"""
+    result = subprocess.run([sys.executable, '-c', _MEASURE.format(worker=worker)],
+                            cwd=APP_DIR, capture_output=True, text=True, check=True)
+    # App log lines share stdout with the result
+    line = next(line for line in result.stdout.splitlines() if line.startswith('startup:'))
+    imported, started = line.split()[1:]
+    return float(imported), float(started)
+
+
+def slowest_imports(top=10):
+    """[(cumulative ms, module)] for the app's heaviest imports"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=APP_DIR, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Only the app's direct imports (one level below app); nested
+        # ones are counted inside these
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == 'app':
+                break
+            # Interpreter startup (site, encodings), not the app
+            modules = []
+        elif depth == 1:
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure app import and worker startup time")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--worker', action='store_true', help="Also time start_worker() (connects to the database)")
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args(argv)
+
+    results = [measure(args.worker) for _ in range(max(1, args.runs))]
+    imports = [imported for imported, _ in results]
+    median = statistics.median(imports)
+
+    print(f"import app: median {median:.1f} ms, min {min(imports):.1f} ms over {len(imports)} runs "
+          f"(budget {STARTUP_BUDGET_MS:.0f} ms)")
+    if args.worker:
+        print(f"start_worker: median {statistics.median(started for _, started in results):.1f} ms")
+    if args.top:
+        print("Slowest imports:")
+        for ms, name in slowest_imports(args.top):
+            print(f"  {ms:8.1f} ms  {name}")
+
+    if median > STARTUP_BUDGET_MS:
+        print(f"✗ Over the {STARTUP_BUDGET_MS:.0f} ms budget")
+        return 1
+    print("✓ Within budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# student_assets.py - QR code and photo files for a student
+import base64
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+# Pillow and qrcode are imported inside the functions that draw: app
+# startup (and every gunicorn worker boot) skips them until first use
+
+# QR images are content-keyed: static/qrcode/<qr_code_key(payload)>.png
+QR_CODE_DIR = 'static/qrcode'
+IMAGE_DIR = 'static/image'
+# Same look as the api.qrserver.com codes the add-student form used before
+QR_CODE_SIZE = 150
+QR_CODE_MARGIN = 10
+# Photos: a normalized JPEG master plus WebP variants (width, height)
+PHOTO_MAX_SIZE = 1024
+PHOTO_QUALITY = 88
+PHOTO_VARIANTS = {
+    'thumb': (240, 240),      # kiosk card (120px CSS, 2x for sharp screens)
+    'display': (640, 640),
+}
+PHOTO_WEBP_QUALITY = 80
+
+
+def qr_payload(student):
+    """Text encoded in a student's QR code, as read by the kiosk"""
+    return ','.join(str(student[field]) for field in ('idno', 'lastname', 'firstname', 'course', 'level'))
+
+
+def qr_code_key(payload):
+    """Content key for a QR image: same payload and look, same file"""
+    text = f"{QR_CODE_SIZE}:{QR_CODE_MARGIN}:{payload}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]
+
+
+def qr_code_path(key, directory=QR_CODE_DIR):
+    return os.path.join(directory, f"{key}.png")
+
+
+def ensure_qr_code(payload, directory=QR_CODE_DIR):
+    """Return (key, path) of the cached QR image, rendering it if missing"""
+    key = qr_code_key(payload)
+    path = qr_code_path(key, directory)
+    if not os.path.exists(path):
+        render_qr_code(payload, path)
+    return key, path
+
+
+def draw_qr_code(payload):
+    """QR image for payload as a Pillow image"""
+    import qrcode
+    from PIL import Image
+
+    # One pixel per module, scaled up below: far cheaper than box_size=10
+    qr = qrcode.QRCode(box_size=1, border=0)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    code = qr.make_image(fill_color='black', back_color='white').get_image().convert('L')
+
+    inner = QR_CODE_SIZE - 2 * QR_CODE_MARGIN
+    image = Image.new('L', (QR_CODE_SIZE, QR_CODE_SIZE), 255)
+    image.paste(code.resize((inner, inner), Image.NEAREST), (QR_CODE_MARGIN, QR_CODE_MARGIN))
+    return image
+
+
+def render_qr_code(payload, path):
+    """Render a QR image for payload into path (atomically)"""
+    _save_atomic(draw_qr_code(payload), path, 'PNG', optimize=True)
+
+
+def qr_code_png(payload):
+    """PNG bytes for payload, without touching the cache directory"""
+    buffer = BytesIO()
+    draw_qr_code(payload).save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def make_qr_code(student, directory=QR_CODE_DIR):
+    """Cached QR image for a student's current details; returns its path"""
+    return ensure_qr_code(qr_payload(student), directory)[1]
+
+
+def remove_qr_code(payload, directory=QR_CODE_DIR):
+    """Drop the cached image for a payload nobody uses any more"""
+    try:
+        os.remove(qr_code_path(qr_code_key(payload), directory))
+    except OSError:
+        pass
+
+
+def load_photo(source, photo_dir=None):
+    """Open a photo given as a data: URL or a path (relative to photo_dir)"""
+    from PIL import Image
+
+    if source.startswith('data:image'):
+        return Image.open(BytesIO(base64.b64decode(source.split(',', 1)[1])))
+    if photo_dir and not os.path.isabs(source):
+        source = os.path.join(photo_dir, source)
+    return Image.open(source)
+
+
+def photo_path(idno, variant=None, directory=IMAGE_DIR):
+    """static/image/<idno>.jpg, or static/image/<variant>/<idno>.webp"""
+    if variant is None:
+        return os.path.join(directory, f"{idno}.jpg")
+    return os.path.join(directory, variant, f"{idno}.webp")
+
+
+def process_photo(idno, source, photo_dir=None, directory=IMAGE_DIR):
+    """Normalize a photo and write its variants; returns the display path.
+
+    EXIF orientation is applied and all metadata is dropped. The master
+    static/image/<idno>.jpg is capped at PHOTO_MAX_SIZE and is what
+    reprocessing starts from; the WebP variants are what pages load.
+    source is an open image, raw bytes, a data: URL or a path.
+    """
+    from PIL import Image, ImageOps
+
+    if isinstance(source, Image.Image):
+        image = source
+    elif isinstance(source, bytes):
+        image = Image.open(BytesIO(source))
+    else:
+        image = load_photo(source, photo_dir)
+
+    with image:
+        image = ImageOps.exif_transpose(image)
+        master = image.convert('RGB')
+        # Drop EXIF, ICC, comments etc. so save() has nothing to carry over
+        master.info = {}
+        master.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE), Image.LANCZOS)
+
+    for variant, (width, height) in PHOTO_VARIANTS.items():
+        if variant == 'thumb':
+            # Fixed square, cropped to fill like the kiosk's object-fit: cover
+            resized = ImageOps.fit(master, (width, height), Image.LANCZOS)
+        else:
+            resized = master.copy()
+            resized.thumbnail((width, height), Image.LANCZOS)
+        _save_atomic(resized, photo_path(idno, variant, directory), 'WEBP',
+                     quality=PHOTO_WEBP_QUALITY, method=4)
+
+    # Master last: its presence means the variants are complete
+    _save_atomic(master, photo_path(idno, None, directory), 'JPEG',
+                 quality=PHOTO_QUALITY, optimize=True)
+    return photo_path(idno, 'display', directory)
+
+
+def build_student_assets(student, photo_dir=None):
+    """Process-pool task: QR code plus photo for one student.
+
+    Returns (idno, error message or None) so one bad photo does not fail
+    the whole import.
+    """
+    try:
+        make_qr_code(student)
+        if student.get('photo'):
+            process_photo(student['idno'], student['photo'], photo_dir)
+        return student['idno'], None
+    except Exception as e:
+        return student['idno'], str(e)
+
+
+def _save_atomic(image, path, image_format, **options):
+    # Readers never see a half-written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(temp_path, image_format, **options)
+    os.replace(temp_path, path)
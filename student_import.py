@@ -0,0 +1,200 @@
+# student_import.py - Bulk student enrollment from CSV / JSONL
+#
+#   python student_import.py students.csv [--photos DIR] [--workers N] [--no-assets]
+#
+# Columns / keys: idno, lastname, firstname, course, level and an optional
+# photo (a path relative to --photos, or a data:image URL).
+import argparse
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from dbhelper import upsert_users_bulk, notify_photo_changes
+from student_assets import build_student_assets
+from app_logging import setup_logging
+
+log = logging.getLogger(__name__)
+
+STUDENT_FIELDS = ('idno', 'lastname', 'firstname', 'course', 'level')
+# Column sizes from the users table
+FIELD_LIMITS = {'idno': 50, 'lastname': 100, 'firstname': 100, 'course': 50, 'level': 10}
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Per-row errors returned in a report; the counts always cover every row
+IMPORT_MAX_ERRORS = 1000
+
+
+def detect_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt='csv'):
+    """Yield (row number, dict) from a text stream of CSV or JSON lines"""
+    if fmt == 'jsonl':
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, ValueError(f"Invalid JSON: {e}")
+                continue
+            yield number, row if isinstance(row, dict) else ValueError("Expected a JSON object")
+    else:
+        reader = csv.DictReader(stream)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        # Row 1 is the header
+        for number, row in enumerate(reader, 2):
+            yield number, row
+
+
+def validate_rows(rows, allow_photo_paths=True):
+    """Check and dedupe rows in memory.
+
+    Returns (students, errors). Each error is {'row', 'idno', 'error'};
+    a repeated idno keeps its first row and reports the others. Uploads
+    pass allow_photo_paths=False so only data:image photos are read.
+    """
+    students = []
+    errors = []
+    seen = {}
+
+    for number, row in rows:
+        if isinstance(row, Exception):
+            errors.append({'row': number, 'idno': None, 'error': str(row)})
+            continue
+
+        student = {field: str(row.get(field) or '').strip() for field in STUDENT_FIELDS}
+        problem = None
+        for field in STUDENT_FIELDS:
+            if not student[field]:
+                problem = f"Missing {field}"
+                break
+            if len(student[field]) > FIELD_LIMITS[field]:
+                problem = f"{field} longer than {FIELD_LIMITS[field]} characters"
+                break
+        if problem is None and ',' in ''.join(student.values()):
+            # The kiosk splits QR codes on commas
+            problem = "Commas are not allowed in student fields"
+        if problem is None and student['idno'] in seen:
+            problem = f"Duplicate idno (first seen on row {seen[student['idno']]})"
+        photo = str(row.get('photo') or '').strip()
+        if problem is None and photo and not allow_photo_paths and not photo.startswith('data:image'):
+            problem = "photo must be a data:image URL"
+
+        if problem:
+            errors.append({'row': number, 'idno': student['idno'] or None, 'error': problem})
+            continue
+
+        seen[student['idno']] = number
+        if photo:
+            student['photo'] = photo
+        students.append(student)
+
+    return students, errors
+
+
+def generate_assets(students, photo_dir=None, workers=IMPORT_WORKERS):
+    """Build QR codes and photos in a process pool; returns per-row errors"""
+    errors = []
+    if not students:
+        return errors
+
+    # spawn, not fork: gunicorn workers run threads (pool, listeners) that
+    # a forked child would inherit in an unknown state
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context) as executor:
+            chunksize = max(1, len(students) // (workers * 8))
+            results = list(executor.map(build_student_assets, students,
+                                        [photo_dir] * len(students), chunksize=chunksize))
+    except Exception as e:
+        # The users are already committed; still produce their files
+        log.warning("✗ Asset process pool failed (%s), generating in-process", e)
+        results = [build_student_assets(student, photo_dir) for student in students]
+
+    for idno, error in results:
+        if error:
+            errors.append({'idno': idno, 'error': error})
+    return errors
+
+
+def import_students(stream, fmt='csv', photo_dir=None, assets=True, workers=IMPORT_WORKERS,
+                    allow_photo_paths=True):
+    """Validate, upsert and build assets for a file of students.
+
+    Returns a report with counts, per-row errors and throughput. Raises
+    if the database is unavailable (nothing is imported in that case).
+    """
+    started = time.monotonic()
+
+    students, errors = validate_rows(read_rows(stream, fmt), allow_photo_paths)
+    rows = len(students) + len(errors)
+    validated = time.monotonic()
+
+    counts = upsert_users_bulk(students) if students else {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    loaded = time.monotonic()
+
+    asset_errors = generate_assets(students, photo_dir, workers) if assets else []
+    if assets:
+        # This may be the CLI: the workers' photo indexes refresh on the NOTIFY
+        notify_photo_changes(student['idno'] for student in students if student.get('photo'))
+    finished = time.monotonic()
+
+    elapsed = finished - started
+    report = {
+        'rows': rows,
+        'imported': len(students),
+        'rejected': len(errors),
+        'inserted': counts['inserted'],
+        'updated': counts['updated'],
+        'unchanged': counts['unchanged'],
+        'asset_failures': len(asset_errors),
+        'errors': errors[:IMPORT_MAX_ERRORS],
+        'asset_errors': asset_errors[:IMPORT_MAX_ERRORS],
+        'seconds': {
+            'validate': round(validated - started, 3),
+            'database': round(loaded - validated, 3),
+            'assets': round(finished - loaded, 3),
+            'total': round(elapsed, 3),
+        },
+        'rows_per_second': round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
+    log.info("✓ Student import: %d imported, %d rejected, %d asset failures in %ss",
+             report['imported'], report['rejected'], report['asset_failures'], report['seconds']['total'])
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import students from CSV or JSONL")
+    parser.add_argument('file', help="CSV or JSONL file, or - for stdin")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="Default: from the file extension")
+    parser.add_argument('--photos', help="Directory that photo paths are relative to")
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS)
+    parser.add_argument('--no-assets', action='store_true', help="Skip QR code and photo generation")
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    fmt = args.format or ('csv' if args.file == '-' else detect_format(args.file))
+    photo_dir = args.photos or (os.path.dirname(os.path.abspath(args.file)) if args.file != '-' else None)
+
+    if args.file == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    else:
+        stream = open(args.file, 'r', encoding='utf-8-sig', newline='')
+    with stream:
+        report = import_students(stream, fmt, photo_dir, not args.no_assets, args.workers)
+
+    print(json.dumps(report, indent=2))
+    return 1 if report['rejected'] or report['asset_failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from attendance_journal import AttendanceJournal, drain_journal, iter_journal, REPLAY_SUFFIX, REJECTED_SUFFIX
+
+
+class Unavailable(Exception):
+    pass
+
+
+def entry(n, time_logged='2026-10-18 08:00:00'):
+    return {'scan_key': f'key-{n}', 'idno': f'2021-{n:04d}', 'time_logged': time_logged}
+
+
+def store_rejecting(stored, bad_idnos):
+    """store_batch that fails a whole batch when it holds a bad entry, like one INSERT would"""
+    def store(batch):
+        if any(e['idno'] in bad_idnos for e in batch):
+            raise ValueError("invalid input syntax for type timestamp")
+        stored.extend(batch)
+    return store
+
+
+def test_append_and_drain(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = AttendanceJournal(path)
+    journal.append([entry(1), entry(2)])
+    journal.append([entry(3)])
+
+    stored = []
+    assert drain_journal(path, stored.extend) == 3
+    assert [e['scan_key'] for e in stored] == ['key-1', 'key-2', 'key-3']
+    assert not (tmp_path / ('journal.jsonl' + REPLAY_SUFFIX)).exists()
+
+    # Scans after the drain go to a fresh file
+    journal.append([entry(4)])
+    assert [e['scan_key'] for e in iter_journal(path)] == ['key-4']
+    journal.close()
+
+
+def test_bad_entry_is_rejected_not_retried_forever(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    lines = [json.dumps(entry(1)), json.dumps(entry(2, 'garbage')), '{"torn', json.dumps(entry(3))]
+    path.write_text('\n'.join(lines) + '\n')
+
+    stored = []
+    assert drain_journal(str(path), store_rejecting(stored, {'2021-0002'}), batch_size=10) == 2
+    assert [e['scan_key'] for e in stored] == ['key-1', 'key-3']
+    rejected = (tmp_path / ('journal.jsonl' + REJECTED_SUFFIX)).read_text().splitlines()
+    assert rejected == ['{"torn', json.dumps(entry(2, 'garbage'))]
+    assert not (tmp_path / ('journal.jsonl' + REPLAY_SUFFIX)).exists()
+
+    # Nothing is left to replay
+    assert drain_journal(str(path), store_rejecting(stored, set())) == 0
+
+
+def test_unavailable_database_keeps_the_replay_file(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    path.write_text(json.dumps(entry(1)) + '\n')
+
+    def down(batch):
+        raise Unavailable("connection refused")
+
+    with pytest.raises(Unavailable):
+        drain_journal(str(path), down, unavailable=(Unavailable,))
+    assert (tmp_path / ('journal.jsonl' + REPLAY_SUFFIX)).exists()
+    assert not (tmp_path / ('journal.jsonl' + REJECTED_SUFFIX)).exists()
+
+    stored = []
+    assert drain_journal(str(path), stored.extend) == 1
+    assert stored == [entry(1)]
@@ -0,0 +1,47 @@
+from datetime import date, timedelta
+
+import pytest
+
+from attendance_reports import parse_date_range, REPORT_DEFAULT_DAYS, REPORT_MAX_DAYS
+
+
+def test_explicit_range():
+    assert parse_date_range('2026-10-01', '2026-10-18') == (date(2026, 10, 1), date(2026, 10, 18))
+
+
+def test_single_day():
+    assert parse_date_range('2026-10-18', '2026-10-18') == (date(2026, 10, 18), date(2026, 10, 18))
+
+
+def test_defaults_end_today():
+    start, end = parse_date_range()
+    assert end == date.today()
+    assert (end - start).days == REPORT_DEFAULT_DAYS - 1
+
+
+def test_default_start_counts_back_from_to():
+    start, end = parse_date_range(date_to='2026-10-18', default_days=7)
+    assert (start, end) == (date(2026, 10, 12), date(2026, 10, 18))
+
+
+def test_longest_range_allowed():
+    end = date(2026, 10, 18)
+    start = end - timedelta(days=REPORT_MAX_DAYS - 1)
+    assert parse_date_range(start.isoformat(), end.isoformat()) == (start, end)
+
+
+@pytest.mark.parametrize('date_from, date_to', [
+    ('2026-10-19', '2026-10-18'),       # reversed
+    ('18/10/2026', None),               # not YYYY-MM-DD
+    ('2026-02-30', '2026-03-01'),       # no such day
+])
+def test_invalid_ranges(date_from, date_to):
+    with pytest.raises(ValueError):
+        parse_date_range(date_from, date_to)
+
+
+def test_range_too_long():
+    end = date(2026, 10, 18)
+    start = end - timedelta(days=REPORT_MAX_DAYS)
+    with pytest.raises(ValueError):
+        parse_date_range(start.isoformat(), end.isoformat())
@@ -0,0 +1,88 @@
+import os
+import uuid
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+import attendance_reports
+from dbhelper import ChangeHorizon
+from attendance_reports import _next_batch
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason='TEST_DATABASE_URL not set')
+
+
+@pytest.fixture
+def connect():
+    """Connections to a scratch schema holding only attendance_changes"""
+    schema = 'horizon_' + uuid.uuid4().hex[:8]
+    admin = psycopg2.connect(TEST_DATABASE_URL)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    admin.cursor().execute(f"CREATE TABLE {schema}.attendance_changes (seq BIGSERIAL PRIMARY KEY)")
+    opened = []
+
+    def _connect(autocommit=False):
+        conn = psycopg2.connect(TEST_DATABASE_URL, options=f'-c search_path={schema}')
+        conn.autocommit = autocommit
+        opened.append(conn)
+        return conn
+
+    yield _connect
+    for conn in opened:
+        conn.close()
+    admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    admin.close()
+
+
+@pytest.fixture
+def horizon(monkeypatch):
+    """A fresh horizon, also the one the rollup batches use"""
+    fresh = ChangeHorizon()
+    monkeypatch.setattr(attendance_reports, 'change_horizon', fresh)
+    return fresh
+
+
+def _log(conn):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO attendance_changes DEFAULT VALUES RETURNING seq")
+    return cursor.fetchone()[0]
+
+
+def test_uncommitted_low_seq_holds_the_horizon(connect, horizon):
+    slow, fast, reader = connect(), connect(autocommit=True), connect(autocommit=True)
+    assert _log(slow) == 1
+    assert _log(fast) == 2
+
+    assert horizon.settled(reader.cursor()) == 0
+    assert _next_batch(reader.cursor(), 0, 100) == (None, 0)
+
+    slow.commit()
+    assert horizon.settled(reader.cursor()) == 2
+    assert _next_batch(reader.cursor(), 0, 100) == (2, 2)
+
+
+def test_rolled_back_seq_is_skipped_once_its_writer_ends(connect, horizon):
+    slow, fast, reader = connect(), connect(autocommit=True), connect(autocommit=True)
+    _log(fast)
+    _log(slow)
+    _log(fast)
+
+    assert horizon.settled(reader.cursor()) == 1
+    slow.rollback()
+    assert horizon.settled(reader.cursor()) == 3
+
+
+def test_batch_stops_at_the_first_unsettled_seq(connect, horizon):
+    slow, fast, reader = connect(), connect(autocommit=True), connect(autocommit=True)
+    for _ in range(3):
+        _log(fast)
+    _log(slow)
+    _log(fast)
+
+    assert _next_batch(reader.cursor(), 0, 100) == (3, 3)
+    assert _next_batch(reader.cursor(), 3, 100) == (None, 0)
+    slow.commit()
+    assert _next_batch(reader.cursor(), 3, 100) == (5, 2)
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.closed = 0
+        self.rollbacks = 0
+        self.pings = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        if self.conn.closed:
+            raise RuntimeError("connection already closed")
+        self.conn.pings += 1
+
+    def close(self):
+        pass
+
+
+class FakeConnect:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self):
+        conn = FakeConnection(len(self.opened) + 1)
+        self.opened.append(conn)
+        return conn
+
+
+def make_pool(**options):
+    connect = FakeConnect()
+    options.setdefault('maxconn', 2)
+    options.setdefault('timeout', 0.1)
+    return ConnectionPool(connect, **options), connect
+
+
+def test_checkout_reuses_returned_connection():
+    pool, connect = make_pool()
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert len(connect.opened) == 1
+    assert conn.rollbacks == 1
+    assert pool.stats()['in_use'] == 1
+
+
+def test_warm_opens_minconn():
+    pool, connect = make_pool(minconn=2)
+    pool.warm()
+    assert len(connect.opened) == 2
+    assert pool.stats()['idle'] == 2
+
+
+def test_timeout_when_exhausted():
+    pool, _ = make_pool(maxconn=1, timeout=0.05)
+    pool.getconn()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.05
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_waiter_gets_returned_connection():
+    pool, _ = make_pool(maxconn=1, timeout=2)
+    conn = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.putconn(conn)
+    waiter.join(1)
+    assert got == [conn]
+    assert pool.stats()['saturated_checkouts'] == 1
+
+
+def test_expired_connection_is_recycled():
+    pool, connect = make_pool(max_lifetime=0.05)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    time.sleep(0.06)
+    fresh = pool.getconn()
+    assert fresh is not conn
+    assert conn.closed
+    assert pool.stats()['recycled'] == 1
+    assert len(connect.opened) == 2
+
+
+def test_broken_connection_is_discarded():
+    pool, _ = make_pool()
+    conn = pool.getconn()
+    pool.putconn(conn, discard=True)
+    assert conn.closed
+    assert pool.getconn() is not conn
+    assert pool.stats()['discarded'] == 1
+
+
+def test_idle_connection_is_pinged_and_replaced_if_dead():
+    pool, _ = make_pool(idle_ping=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert conn.pings == 1
+    pool.putconn(conn)
+    conn.closed = 1       # server went away while idle
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert pool.stats()['size'] == 1
+
+
+def test_failed_connect_frees_the_slot():
+    def refuse():
+        raise RuntimeError("connection refused")
+
+    pool = ConnectionPool(refuse, minconn=0, maxconn=1, timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            pool.getconn()
+    assert pool.stats()['size'] == 0
+
+
+def test_closed_pool_refuses_checkouts():
+    pool, _ = make_pool()
+    pool.closeall()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
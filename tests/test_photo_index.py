@@ -0,0 +1,39 @@
+import time
+
+from photo_index import PhotoIndex
+
+
+def test_unknown_idnos_are_bounded(tmp_path):
+    index = PhotoIndex(str(tmp_path), miss_ttl=60, miss_size=100)
+    for n in range(1000):
+        assert index.lookup(f'unknown-{n}') is None
+    assert index.stats()['known_missing'] == 100
+
+
+def test_expired_misses_are_dropped(tmp_path):
+    index = PhotoIndex(str(tmp_path), miss_ttl=0.05, miss_size=100)
+    for n in range(10):
+        index.lookup(f'unknown-{n}')
+    time.sleep(0.06)
+    index.lookup('another')
+    assert index.stats()['known_missing'] == 1
+
+
+def test_photo_found_after_upload(tmp_path):
+    index = PhotoIndex(str(tmp_path), miss_ttl=60)
+    assert index.lookup('2021-0001', None) is None
+    (tmp_path / '2021-0001.jpg').write_bytes(b'jpeg')
+    index.refresh('2021-0001')
+    path, version = index.lookup('2021-0001', None)
+    assert path.endswith('2021-0001.jpg')
+    assert index.stats()['known_missing'] == 0
+
+
+def test_photo_written_by_another_process(tmp_path):
+    index = PhotoIndex(str(tmp_path), miss_ttl=60)
+    assert index.lookup('2021-0001', None) is None
+    (tmp_path / '2021-0001.jpg').write_bytes(b'jpeg')
+    index.apply_roster_change({'idnos': ['2021-0001']})     # roster edit only
+    assert index.lookup('2021-0001', None) is None
+    index.apply_roster_change({'photos': ['2021-0001']})
+    assert index.lookup('2021-0001', None) is not None
@@ -0,0 +1,47 @@
+from recent_attendance import RecentAttendance
+
+
+def record(n, time_logged=None):
+    return {'id': n, 'idno': f'2021-{n:04d}', 'time_logged': time_logged or f'2026-10-18 08:{n:02d}:00'}
+
+
+def test_keeps_newest_in_order_and_drops_oldest():
+    recent = RecentAttendance(size=3)
+    for n in range(1, 6):
+        recent.add(record(n))
+    assert [r['id'] for r in recent.latest(10)] == [5, 4, 3]
+    assert recent.truncated
+
+
+def test_out_of_order_scan_is_placed_by_time():
+    recent = RecentAttendance(size=3)
+    recent.seed([record(1), record(3)])
+    recent.add(record(2))
+    assert [r['id'] for r in recent.latest(3)] == [3, 2, 1]
+
+
+def test_older_than_full_buffer_is_ignored():
+    recent = RecentAttendance(size=2)
+    recent.seed([record(5), record(6)])
+    recent.add(record(1))
+    assert [r['id'] for r in recent.latest(2)] == [6, 5]
+
+
+def test_duplicates_are_ignored():
+    recent = RecentAttendance(size=3)
+    recent.add(record(1))
+    recent.add(record(1))
+    assert len(recent.latest(3)) == 1
+
+
+def test_remove_and_reseed_after_truncation():
+    recent = RecentAttendance(size=2)
+    recent.seed([record(1), record(2)])
+    assert not recent.needs_reseed(2)
+    recent.apply_change({'op': 'delete', 'record': {'id': 2}})
+    assert [r['id'] for r in recent.latest(2)] == [1]
+    assert recent.needs_reseed(2)
+
+
+def test_unseeded_buffer_needs_seed():
+    assert RecentAttendance().needs_reseed(1)
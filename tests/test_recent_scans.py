@@ -0,0 +1,15 @@
+import pytest
+
+from recent_scans import valid_scan_key, SCAN_KEY_MAX_LENGTH
+
+
+@pytest.mark.parametrize('scan_key', ['a', 'f47ac10b-58cc-4372-a567-0e02b2c3d479', 'kiosk_1-42',
+                                      'x' * SCAN_KEY_MAX_LENGTH])
+def test_valid_scan_keys(scan_key):
+    assert valid_scan_key(scan_key)
+
+
+@pytest.mark.parametrize('scan_key', [None, '', 42, 'x' * (SCAN_KEY_MAX_LENGTH + 1), 'a b', 'a;b',
+                                      "a'--", 'clé', '１２３'])
+def test_invalid_scan_keys(scan_key):
+    assert not valid_scan_key(scan_key)
@@ -0,0 +1,63 @@
+import time
+
+from student_cache import StudentCache, StudentRecord, MISS
+
+
+def student(n):
+    return {'idno': f'2021-{n:04d}', 'lastname': 'Cruz', 'firstname': 'Ana', 'course': 'BSIT', 'level': '1'}
+
+
+def test_hit_and_miss():
+    cache = StudentCache(size=10)
+    assert cache.get('2021-0001') is MISS
+    cache.put(student(1))
+    assert cache.get('2021-0001') == StudentRecord('2021-0001', 'Cruz', 'Ana', 'BSIT', '1')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_evicts_least_recently_used():
+    cache = StudentCache(size=2)
+    cache.put(student(1))
+    cache.put(student(2))
+    cache.get('2021-0001')          # 2 is now the least recently used
+    cache.put(student(3))
+    assert cache.get('2021-0002') is MISS
+    assert cache.get('2021-0001') is not MISS
+    assert cache.get('2021-0003') is not MISS
+    assert cache.evictions == 1
+
+
+def test_negative_entries_and_expiry():
+    cache = StudentCache(size=10, ttl=60, negative_ttl=0.05)
+    cache.put_missing('9999')
+    assert cache.get('9999') is None
+    time.sleep(0.06)
+    assert cache.get('9999') is MISS
+
+
+def test_invalidate():
+    cache = StudentCache(size=10)
+    cache.put(student(1))
+    cache.invalidate('2021-0001')
+    assert cache.get('2021-0001') is MISS
+    assert cache.invalidations == 1
+
+
+def test_roster_change_drops_listed_idnos():
+    cache = StudentCache(size=10)
+    cache.put(student(1))
+    cache.put(student(2))
+    cache.put_missing('2021-0003')
+    cache.apply_roster_change({'idnos': ['2021-0001', '2021-0003']})
+    assert cache.get('2021-0001') is MISS
+    assert cache.get('2021-0002') is not MISS
+    assert cache.get('2021-0003') is MISS
+
+
+def test_roster_change_all_clears():
+    cache = StudentCache(size=10)
+    cache.put(student(1))
+    cache.put(student(2))
+    cache.apply_roster_change({'all': True})
+    assert cache.stats()['size'] == 0
+    assert cache.invalidations == 2